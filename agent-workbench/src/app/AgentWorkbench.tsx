@@ -295,6 +295,18 @@ function ChatPane({ width = 420, height = 720, fill = false }: { width?: number;
 
   const lastAssistantTextRef = useRef<string>(""); // 记录最新助手文本（给结束时解析 plotly）
 
+  // 服务端对话 id：历史保存在后端，每轮只上传新消息
+  const conversationIdRef = useRef<string | null>(null);
+  const ensureConversationId = useCallback(() => {
+    if (!conversationIdRef.current) {
+      conversationIdRef.current =
+        typeof crypto !== "undefined" && "randomUUID" in crypto
+          ? crypto.randomUUID()
+          : `${Date.now().toString(36)}${Math.random().toString(36).slice(2)}`;
+    }
+    return conversationIdRef.current;
+  }, []);
+
 
   const [messages, setMessages] = useState<ChatMessage[]>([
     { role: "assistant", content: "你好，我是你的现场 Agent。你可以问：‘我想看看北京的基站’。" },
@@ -415,7 +427,7 @@ type Station = {
     [key: string]: unknown; // 允许以后加更多字段
   }
   type StreamEvent =
-    | { type: "start" }
+    | { type: "start"; conversation_id?: string }
     | { type: "end" }
     | { type: "token"; delta: string }
     | { type: "log"; channel?: string; message: string }
@@ -442,6 +454,11 @@ type Station = {
       ];
       setMessages(initial);
       setInput("");
+      const oldId = conversationIdRef.current;
+      conversationIdRef.current = null;
+      if (oldId) {
+        fetch(`${API_BASE}/api/conversations/${encodeURIComponent(oldId)}`, { method: "DELETE" }).catch(() => {});
+      }
       bus.emit("log:append", { channel: "cmd", message: "会话已清空（不影响记忆）" });
       return;
     }
@@ -456,8 +473,8 @@ type Station = {
       bus.emit("tool:map:load", { query: ask, city: "北京" });
     }
   
-    // 稳定快照（避免异步 setState 造成丢历史）
-    const convo = [...messages, userMsg];
+    // 历史在服务端：只上传本轮消息
+    const conversationId = ensureConversationId();
   
     // 先插入“空气泡”，并记录索引到 ref
     setMessages((m) => {
@@ -475,7 +492,7 @@ type Station = {
       const response = await fetch(`${API_BASE}/api/chat/stream`, {
         method: "POST",
         headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
-        body: JSON.stringify({ messages: convo, context: ctx || null }),
+        body: JSON.stringify({ conversation_id: conversationId, message: ask, context: ctx || null }),
         signal: ac.signal,
         // 这三项能避免浏览器/中间层缓冲
         cache: "no-store",
@@ -503,7 +520,10 @@ type Station = {
           let ev: StreamEvent;
           try { ev = JSON.parse(jsonStr); } catch { continue; }
   
-          if (ev.type === "start") return;
+          if (ev.type === "start") {
+            if (ev.conversation_id) conversationIdRef.current = ev.conversation_id;
+            return;
+          }
   
           if (ev.type === "token") {
             const clean = stripThinkAndLog(ev.delta || "");
@@ -624,7 +644,7 @@ type Station = {
       requestAnimationFrame(() => endRef.current?.scrollIntoView({ block: "end" }));
     }
     
-  }, [bus, messages, streamActive]);
+  }, [bus, streamActive, ensureConversationId]);
   
   useEffect(() => {
     const off = bus.on("chat:ask-station", (payload) => {
@@ -633,30 +653,37 @@ type Station = {
       fetch("/api/geo/selection", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ station_id: station.id, session_id: "demo" }),
+        body: JSON.stringify({ station_id: station.id, session_id: ensureConversationId() }),
       }).catch(() => {});
   
       sendToAgent(question, { station });
     });
   
     return () => off && off();
-  }, [bus, sendToAgent]);
+  }, [bus, sendToAgent, ensureConversationId]);
   
   
   useEffect(() => {
     const off = bus.on("station:selected", (payload) => {
       const station = payload as Station;
+      const content = `已选中基站【${station.name}】（${station.id}）。你想了解其覆盖、负载还是告警历史？`;
       setMessages((m) => [
         ...m,
         {
           role: "assistant",
-          content: `已选中基站【${station.name}】（${station.id}）。你想了解其覆盖、负载还是告警历史？`,
+          content,
           meta: { suggest: "比如：‘它的覆盖半径是多少？’" },
         },
       ]);
+      // 本地提示也记入服务端历史（后端据此缓存“当前选中基站”）
+      fetch(`${API_BASE}/api/conversations/${encodeURIComponent(ensureConversationId())}/messages`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ role: "assistant", content }),
+      }).catch(() => {});
     });
     return () => off && off();
-  }, [bus]);
+  }, [bus, ensureConversationId]);
 
   useEffect(() => {
     return () => {
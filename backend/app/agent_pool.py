@@ -0,0 +1,115 @@
+
+# app/agent_pool.py
+"""
+按会话隔离的 Strands Agent 池（/api/chat 用）。
+- 每个 session 一个 Agent（各自的 SlidingWindowConversationManager），互不串话
+- 同一 session 的请求串行（Agent 不支持并发调用），不同 session 并行
+- 池大小是硬上限：新会话进来时淘汰最久未用且空闲的；全部在忙就排队等空位（计入超时）；
+  空闲超过 idle_ttl_s 的顺带清理
+- 异步驱动 + 超时（含排队等锁）；超时/异常的 Agent 直接丢弃，避免残缺的对话窗口；
+  已在排队的请求拿到锁后发现槽位已换，改用新 Agent
+"""
+from __future__ import annotations
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+
+class _Slot:
+    __slots__ = ("agent", "lock", "last_used")
+
+    def __init__(self, agent: Any):
+        self.agent = agent
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class AgentPool:
+    def __init__(self, factory: Callable[[], Any], *, max_agents: int = 64, idle_ttl_s: float = 900):
+        self.factory = factory
+        self.max_agents = max(1, int(max_agents))
+        self.idle_ttl_s = float(idle_ttl_s)
+        self._slots: "OrderedDict[str, _Slot]" = OrderedDict()
+        self._waiters: List[asyncio.Future] = []   # 池满且全忙时排队的新会话
+
+    def _evict(self, room: int = 0):
+        """清理空闲超时的槽位，再按最久未用淘汰空闲槽位，直到再放 room 个也不超上限。"""
+        now = time.monotonic()
+        for sid in [k for k, s in self._slots.items()
+                    if not s.lock.locked() and now - s.last_used > self.idle_ttl_s]:
+            del self._slots[sid]
+        for sid in list(self._slots):
+            if len(self._slots) + room <= self.max_agents:
+                break
+            if not self._slots[sid].lock.locked():
+                del self._slots[sid]
+
+    def _slot(self, session_id: str) -> Optional[_Slot]:
+        """取（或新建）会话的槽位；池满且全部在忙时返回 None。"""
+        slot = self._slots.get(session_id)
+        if slot is not None:
+            self._slots.move_to_end(session_id)
+            self._evict()
+            return slot
+        self._evict(room=1)
+        if len(self._slots) >= self.max_agents:
+            return None
+        slot = self._slots[session_id] = _Slot(self.factory())
+        return slot
+
+    async def _wait_free(self):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        finally:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+
+    def _wake(self):
+        # 全部叫醒重新争抢：个别等待者超时/取消不会吞掉唤醒
+        waiters, self._waiters = self._waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    def drop(self, session_id: str):
+        if self._slots.pop(session_id, None) is not None:
+            self._wake()
+
+    async def run(self, session_id: str, prompt: str, *, timeout_s: Optional[float] = None) -> str:
+        """超时覆盖排队等锁 + 调用本身。"""
+        return str(await asyncio.wait_for(self._run(session_id, prompt), timeout=timeout_s))
+
+    async def _run(self, session_id: str, prompt: str) -> Any:
+        while True:
+            slot = self._slot(session_id)
+            if slot is None:
+                await self._wait_free()   # 池满且全忙：等有槽位空出来再试
+                continue
+            try:
+                async with slot.lock:
+                    if self._slots.get(session_id) is not slot:
+                        continue   # 排队期间该 Agent 被丢弃/淘汰：换新槽位，不复用残缺的对话窗口
+                    try:
+                        return await slot.agent.invoke_async(prompt)
+                    except BaseException:
+                        # 超时/异常/取消：对话窗口可能不完整，丢掉重建
+                        if self._slots.get(session_id) is slot:
+                            self.drop(session_id)
+                        raise
+                    finally:
+                        slot.last_used = time.monotonic()
+            finally:
+                if self._waiters:
+                    self._wake()   # 锁已释放：该槽位可被淘汰，让排队的新会话重试
+
+    def stats(self) -> dict:
+        return {
+            "agents": len(self._slots),
+            "busy": sum(1 for s in self._slots.values() if s.lock.locked()),
+            "waiting": len(self._waiters),
+            "max_agents": self.max_agents,
+            "idle_ttl_s": self.idle_ttl_s,
+        }
@@ -0,0 +1,119 @@
+
+# app/ann_index.py
+"""
+向量 Top-K 检索后端（可插拔）：ExactIndex（全量点积）/ IVFIndex（倒排聚类，近似）。
+两者同一接口：search(q, k) -> (行号, 相似度)，按相似度降序；输入向量已归一化（点积 = 余弦）。
+IVF：
+- 球面 k-means 把示例分成 nlist 簇（质心归一化），每行归属最近的质心
+- 查询先和质心打分，只在最相近的 nprobe 个簇里精排；nprobe 是召回/延迟旋钮（= nlist 时退化为精确）
+- 只按簇号给行号排序（倒排表），不复制向量矩阵：建索引 = 一次 argsort，查询时只取探测簇的行
+- 质心可复用：示例增删时只给新行分簇（assign），规模翻倍后在后台重新训练（见 EmbeddingRouter）
+纯 NumPy，无第三方 ANN 依赖。
+"""
+from __future__ import annotations
+import math
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+ANN_BACKEND = os.environ.get("EMBED_ANN", "exact")              # exact | ivf
+ANN_MIN_ROWS = int(os.environ.get("EMBED_ANN_MIN_ROWS", 5000))  # 行数少于此值时 IVF 不划算，仍用精确
+ANN_NLIST = int(os.environ.get("EMBED_ANN_NLIST", 0))           # 0 = 按 4*sqrt(N) 自动
+ANN_NPROBE = int(os.environ.get("EMBED_ANN_NPROBE", 8))
+
+_CHUNK = 8192
+
+
+def _top(sims: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(sims))
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    idx = np.argpartition(-sims, k - 1)[:k] if k < len(sims) else np.arange(len(sims))
+    return idx[np.argsort(-sims[idx], kind="stable")]
+
+
+def default_nlist(n: int) -> int:
+    return max(1, min(n // 8, int(4 * math.sqrt(n)))) if n else 1
+
+
+def assign(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """每行归属相似度最高的质心（分块算，控制中间矩阵大小）。"""
+    out = np.empty(len(matrix), dtype=np.int32)
+    for i in range(0, len(matrix), _CHUNK):
+        out[i:i + _CHUNK] = np.argmax(matrix[i:i + _CHUNK] @ centroids.T, axis=1)
+    return out
+
+
+def train_centroids(matrix: np.ndarray, nlist: int, *, iters: int = 8, sample: int = 32,
+                    seed: int = 0) -> np.ndarray:
+    """球面 k-means：训练样本最多 nlist*sample 行；空簇用随机样本重新初始化。"""
+    rng = np.random.default_rng(seed)
+    n = len(matrix)
+    nlist = max(1, min(nlist, n))
+    pick = rng.choice(n, size=min(n, nlist * sample), replace=False) if n > nlist * sample else np.arange(n)
+    x = np.asarray(matrix[pick], dtype=np.float32)
+    c = x[rng.choice(len(x), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        a = assign(x, c)
+        order = np.argsort(a, kind="stable")
+        labels, first = np.unique(a[order], return_index=True)
+        sums = np.add.reduceat(x[order], first, axis=0)
+        c_new = c.copy()
+        c_new[labels] = sums
+        empty = np.setdiff1d(np.arange(nlist), labels)
+        if len(empty):
+            c_new[empty] = x[rng.choice(len(x), size=len(empty), replace=False)]
+        norms = np.linalg.norm(c_new, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        c = (c_new / norms).astype(np.float32)
+    return c
+
+
+class ExactIndex:
+    name = "exact"
+
+    def __init__(self, matrix: np.ndarray):
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.matrix)
+
+    def search(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        sims = self.matrix @ q
+        top = _top(sims, k)
+        return top, sims[top]
+
+
+class IVFIndex:
+    name = "ivf"
+
+    def __init__(self, matrix: np.ndarray, *, centroids: Optional[np.ndarray] = None,
+                 assignment: Optional[np.ndarray] = None, nlist: int = 0, nprobe: int = ANN_NPROBE):
+        n = len(matrix)
+        if centroids is None:
+            centroids = train_centroids(matrix, nlist or default_nlist(n))
+        if assignment is None:
+            assignment = assign(matrix, centroids)
+        self.centroids = centroids
+        self.nlist = len(centroids)
+        self.nprobe = max(1, nprobe)
+        self.matrix = matrix
+        order = np.argsort(assignment, kind="stable")
+        self._rows = order.astype(np.intp)                      # 按簇号排好的行号（倒排表）
+        self._offsets = np.searchsorted(assignment[order], np.arange(self.nlist + 1))
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def search(self, q: np.ndarray, k: int, *, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        p = min(self.nlist, max(1, nprobe or self.nprobe))
+        probes = _top(self.centroids @ q, p)
+        parts = [self._rows[self._offsets[c]:self._offsets[c + 1]] for c in probes]
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.intp)
+        if not len(rows):
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float32)
+        sims = self.matrix[rows] @ q
+        top = _top(sims, k)
+        return rows[top], sims[top]
+
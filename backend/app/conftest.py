@@ -0,0 +1,55 @@
+# app/conftest.py
+"""
+测试公共设置：
+- 存储路径指向临时目录，导入 app.main 时的种子数据/索引不落在工作目录
+- 假的 sentence_transformers（确定性向量），用于不下载模型地测 EmbeddingRouter
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import types
+
+import numpy as np
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="station_test_")
+for _var, _name in (("STATIONS_JSON", "stations.json"), ("POIS_JSON", "pois.json"),
+                    ("EMBED_INDEX_DIR", "embed_index"), ("EMBED_CACHE_DIR", "embed_cache")):
+    os.environ.setdefault(_var, os.path.join(_TMP, _name))
+
+
+class StubSentenceTransformer:
+    """每个文本一个按 sha1 播种的随机单位向量（同文本同向量）；calls 记录每次编码的条数。"""
+    dim = 32
+
+    def __init__(self, name: str = "stub"):
+        self.name = name
+        self.calls = []
+
+    def encode(self, xs, normalize_embeddings=True, **kw):
+        xs = list(xs)
+        self.calls.append(len(xs))
+        out = np.stack([np.random.default_rng(int(hashlib.sha1(x.encode("utf-8")).hexdigest()[:8], 16))
+                        .standard_normal(self.dim) for x in xs]).astype(np.float32)
+        return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def stub_sentence_transformers(monkeypatch):
+    mod = types.ModuleType("sentence_transformers")
+    mod.SentenceTransformer = StubSentenceTransformer
+    monkeypatch.setitem(sys.modules, "sentence_transformers", mod)
+    return mod
+
+
+@pytest.fixture
+def embed_router(stub_sentence_transformers, tmp_path):
+    """已就绪的 EmbeddingRouter：假编码器、独立的向量缓存目录、没有预置意图。"""
+    from app import router_embed
+    from app.embed_cache import EmbeddingCache
+    er = router_embed.EmbeddingRouter(model_name="stub-model")
+    er.cache = EmbeddingCache("stub-model", path=str(tmp_path))
+    assert er.warmup()
+    yield er
+    er.batcher.close()
@@ -0,0 +1,136 @@
+
+# app/context_packer.py
+"""
+按 token 预算打包给模型的检索上下文（TopK 表 / 附近代表点位）。
+- 粗估 token：CJK 每字约 1 token，其余约 4 字符 1 token（够做预算，不追求与分词器逐一对齐）
+- 行按调用方给的顺序即价值高低（TopK 分数 / 距离）；字段按优先级从低到高逐个舍弃
+- 先保证至少 min_rows 行能放下，再在该字段集下尽量多放行，直到预算用完
+- 每次打包记一个 span（context_pack：budget/used/rows/fields），并进 llm_context_tokens 直方图
+CPU 推理下 prompt 越短，首 token 越快。
+"""
+from __future__ import annotations
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Sequence
+
+from . import metrics
+from . import tracing
+
+TOPK_CONTEXT_BUDGET = int(os.environ.get("TOPK_CONTEXT_BUDGET_TOKENS", 320))
+NEARBY_CONTEXT_BUDGET = int(os.environ.get("NEARBY_CONTEXT_BUDGET_TOKENS", 240))
+MIN_ROWS = int(os.environ.get("CONTEXT_MIN_ROWS", 3))
+
+
+def _is_cjk(ch: str) -> bool:
+    o = ord(ch)
+    return 0x3000 <= o <= 0x9FFF or 0xF900 <= o <= 0xFAFF or 0xFF00 <= o <= 0xFFEF
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+
+@dataclass
+class Packed:
+    text: str
+    rows: List[Dict[str, Any]]
+    fields: List[str]
+    tokens: int
+    budget: int
+    total_rows: int
+    dropped_fields: List[str] = field(default_factory=list)
+
+
+def _pack(
+    name: str,
+    rows: Sequence[Dict[str, Any]],
+    fields: Sequence[str],
+    priority: Sequence[str],
+    budget: int,
+    render_row: Callable[[Dict[str, Any], List[str]], str],
+    render: Callable[[List[str], List[str]], str],
+    *,
+    min_rows: int,
+    keep: int,
+) -> Packed:
+    t0 = time.perf_counter()
+    want = min(len(rows), max(1, min_rows))
+    # 字段集：按优先级逐个去掉最不重要的，至少保留前 keep 个
+    drop_order = [f for f in reversed(priority) if f in fields]
+    best = None
+    for n_drop in range(0, max(1, len(drop_order) - keep + 1)):
+        dropped = set(drop_order[:n_drop])
+        cols = [f for f in fields if f not in dropped]
+        used = estimate_tokens(render(cols, []))
+        lines: List[str] = []
+        for r in rows:
+            line = render_row(r, cols)
+            cost = estimate_tokens(line) + 1
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+        best = (cols, lines, used, drop_order[:n_drop])
+        if len(lines) >= want:
+            break
+    cols, lines, used, dropped = best
+    text = render(cols, lines) if lines else ""
+    used = estimate_tokens(text)
+    tracing.record(name, (time.perf_counter() - t0) * 1000.0, budget=budget, used=used,
+                   rows=f"{len(lines)}/{len(rows)}", fields=len(cols))
+    metrics.observe("llm_context_tokens", used)
+    return Packed(text=text, rows=list(rows[:len(lines)]), fields=cols, tokens=used, budget=budget,
+                  total_rows=len(rows), dropped_fields=list(dropped))
+
+
+def pack_md_table(
+    rows: Sequence[Dict[str, Any]],
+    columns: Sequence[tuple],
+    *,
+    priority: Sequence[str],
+    budget: int = TOPK_CONTEXT_BUDGET,
+    min_rows: int = MIN_ROWS,
+    keep: int = 2,
+    name: str = "context_pack",
+) -> Packed:
+    """columns：[(字段, 表头)] 的展示顺序；priority：字段重要性从高到低。"""
+    labels = dict(columns)
+
+    def render_row(r, cols):
+        return "| " + " | ".join(str(r.get(k, "")) for k in cols) + " |"
+
+    def render(cols, lines):
+        head = "| " + " | ".join(labels[k] for k in cols) + " |"
+        sep = "|" + "|".join(["---"] * len(cols)) + "|"
+        return "\n".join([head, sep, *lines])
+
+    return _pack(name, rows, [k for k, _ in columns], priority, budget, render_row, render,
+                 min_rows=min_rows, keep=keep)
+
+
+def pack_json_rows(
+    rows: Sequence[Dict[str, Any]],
+    fields: Sequence[str],
+    *,
+    priority: Sequence[str],
+    budget: int = NEARBY_CONTEXT_BUDGET,
+    min_rows: int = MIN_ROWS,
+    keep: int = 2,
+    name: str = "context_pack",
+) -> Packed:
+    """打包成 JSON 数组文本；Packed.rows 同时给出已裁字段的行（供调用方嵌进更大的 JSON）。"""
+    def render_row(r, cols):
+        return json.dumps({k: r.get(k) for k in cols}, ensure_ascii=False)
+
+    def render(cols, lines):
+        return "[" + ",".join(lines) + "]"
+
+    p = _pack(name, rows, list(fields), priority, budget, render_row, render,
+              min_rows=min_rows, keep=keep)
+    p.rows = [{k: r.get(k) for k in p.fields} for r in p.rows]
+    return p
@@ -0,0 +1,104 @@
+
+# app/conversations.py
+"""
+服务端对话存储：客户端只上传新一轮的用户消息，历史由服务端维护。
+- 每个 conversation_id 一条有界消息日志（最多 CONV_MAX_MESSAGES 条，单条截断到 CONV_MAX_CHARS）
+- 派生状态随写入一次算好并缓存：助手消息里的“已选中基站…（ID）”→ station_id，
+  每轮不再倒序扫描全部历史
+- TTL + LRU + 内存上限 + 可选持久化由 SessionStore 负责
+"""
+from __future__ import annotations
+import os
+import re
+import threading
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional
+
+from .session_store import SessionStore
+
+CONV_TTL_S = float(os.environ.get("CONV_TTL_S", 60 * 60))
+CONV_MAX_MESSAGES = int(os.environ.get("CONV_MAX_MESSAGES", 40))
+CONV_MAX_CHARS = int(os.environ.get("CONV_MAX_CHARS", 4000))
+
+CONVERSATIONS = SessionStore(
+    ttl_s=CONV_TTL_S,
+    max_entries=int(os.environ.get("CONV_MAX_CONVERSATIONS", 2000)),
+    max_bytes=int(os.environ.get("CONV_MAX_BYTES", 64 * 1024 * 1024)),
+    persist_path=os.environ.get("CONV_STORE_PATH") or None,
+)
+
+# get → 改 → set 需要整体互斥（SessionStore 只保证单次调用原子）
+_LOCK = threading.Lock()
+
+SELECTED_MARK = "已选中基站"
+SELECTED_ID_RE = re.compile(r"（([A-Z]{2,5}-\d{3,6})）")
+
+
+def new_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _empty() -> Dict[str, Any]:
+    return {"messages": [], "station_id": None}
+
+
+def exists(cid: Optional[str]) -> bool:
+    return bool(cid) and CONVERSATIONS.get(cid) is not None
+
+
+def get(cid: str) -> Dict[str, Any]:
+    """返回对话快照（副本）；不存在时返回空对话（不写入）。"""
+    conv = CONVERSATIONS.get(cid)
+    if conv is None:
+        return _empty()
+    return {"messages": list(conv["messages"]), "station_id": conv.get("station_id")}
+
+
+def history(cid: str) -> List[Dict[str, str]]:
+    return get(cid)["messages"]
+
+
+def selected_station_id(cid: str) -> Optional[str]:
+    conv = CONVERSATIONS.get(cid)
+    return conv.get("station_id") if conv else None
+
+
+def append(cid: str, role: str, content: str) -> List[Dict[str, str]]:
+    """追加一条消息并更新派生状态；返回追加后的完整历史（副本）。"""
+    msg = {"role": role, "content": (content or "")[:CONV_MAX_CHARS]}
+    with _LOCK:
+        conv = CONVERSATIONS.get(cid) or _empty()
+        messages = (list(conv["messages"]) + [msg])[-CONV_MAX_MESSAGES:]
+        station_id = conv.get("station_id")
+        if role == "assistant" and SELECTED_MARK in msg["content"]:
+            # 与旧的历史扫描一致：最近一条“已选中基站”说了算，解析不到 ID 则不改
+            m = SELECTED_ID_RE.search(msg["content"])
+            if m:
+                station_id = m.group(1)
+        CONVERSATIONS.set(cid, {"messages": messages, "station_id": station_id})
+    return list(messages)
+
+
+def set_station(cid: str, station_id: Optional[str]):
+    with _LOCK:
+        conv = CONVERSATIONS.get(cid) or _empty()
+        CONVERSATIONS.set(cid, {"messages": list(conv["messages"]), "station_id": station_id})
+
+
+def clear(cid: str):
+    CONVERSATIONS.delete(cid)
+
+
+async def capture_reply(cid: str, events: AsyncGenerator[Dict[str, Any], None]) -> AsyncGenerator[Dict[str, Any], None]:
+    """透传事件流，同时拼接 token 文本；流结束（或被中断）时把助手回复写回对话。"""
+    parts: List[str] = []
+    try:
+        async for ev in events:
+            if ev.get("type") == "token":
+                parts.append(ev.get("delta") or "")
+            yield ev
+    finally:
+        await events.aclose()
+        text = "".join(parts)
+        if text:
+            append(cid, "assistant", text)
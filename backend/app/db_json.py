@@ -2,9 +2,13 @@
 # app/db_json.py
 from __future__ import annotations
 import os, json, tempfile, threading
-from typing import Iterable, List, Dict, Optional
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Iterable, List, Dict, Optional, Tuple
 from time import time
 
+from .search_index import BM25Index
+
 # 环境变量可改存储路径；默认 stations.json
 STORE_PATH = os.environ.get("STATIONS_JSON", "stations.json")
 
@@ -12,6 +16,9 @@ _LOCK = threading.RLock()
 _STATE = {
     "stations": [],   # list[dict]
     "_index": {},     # id -> dict
+    "version": 0,     # 每次数据变更 +1，供下游缓存判断失效
+    "_views": None,   # 按城市的有序游标索引 + 统计（全量载入后懒建，单条写入只修补受影响的城市）
+    "_search": BM25Index(),  # 全文倒排索引（写入时增量维护）
 }
 
 def _atomic_write(path: str, data: dict):
@@ -31,11 +38,19 @@ def _atomic_write(path: str, data: dict):
 
 def _rebuild_index():
     _STATE["_index"] = {s["id"]: s for s in _STATE["stations"]}
+    _STATE["_search"].rebuild(_STATE["stations"])
+    _STATE["_views"] = None
+    _bump_version()
+
+def _bump_version():
+    _STATE["version"] += 1
 
 def _load_from_disk():
     if not os.path.exists(STORE_PATH):
         _STATE["stations"] = []
         _STATE["_index"] = {}
+        _STATE["_search"].rebuild([])
+        _STATE["_views"] = None
         return
     with open(STORE_PATH, "r", encoding="utf-8") as f:
         obj = json.load(f)
@@ -66,6 +81,11 @@ def init_if_missing(seed_stations: Iterable[Dict]):
         _rebuild_index()
         _save_to_disk()
 
+def version() -> int:
+    """数据版本号：任何写入都会变化（缓存 key 的一部分）。"""
+    with _LOCK:
+        return _STATE["version"]
+
 def load_all() -> List[Dict]:
     """读取全部站点（从内存缓存；若未加载则先读盘）。"""
     with _LOCK:
@@ -88,12 +108,16 @@ def upsert_station(st: Dict):
         if not _STATE["_index"]:
             _load_from_disk()
         exists = _STATE["_index"].get(st["id"])
+        old = _view_pos(exists)
         if exists:
             # 原地更新（保留未提供字段）
             exists.update(st)
         else:
             _STATE["stations"].append(st)
             _STATE["_index"][st["id"]] = st
+        _STATE["_search"].upsert(exists or st)
+        _patch_views(exists or st, old)
+        _bump_version()
         _save_to_disk()
 
 def bulk_upsert(stations: Iterable[Dict]):
@@ -104,11 +128,15 @@ def bulk_upsert(stations: Iterable[Dict]):
             if "id" not in st:
                 continue
             exists = _STATE["_index"].get(st["id"])
+            old = _view_pos(exists)
             if exists:
                 exists.update(st)
             else:
                 _STATE["stations"].append(st)
                 _STATE["_index"][st["id"]] = st
+            _STATE["_search"].upsert(exists or st)
+            _patch_views(exists or st, old)
+        _bump_version()
         _save_to_disk()
 
 def update_status(station_id: str, status: str, updated_at: Optional[int] = None):
@@ -118,8 +146,12 @@ def update_status(station_id: str, status: str, updated_at: Optional[int] = None
         s = _STATE["_index"].get(station_id)
         if not s:
             return
+        old = _view_pos(s)
         s["status"] = status
         s["updated_at"] = int(updated_at or time())
+        _STATE["_search"].upsert(s)
+        _patch_views(s, old)
+        _bump_version()
         _save_to_disk()
 
 def replace_all(stations: Iterable[Dict]):
@@ -172,4 +204,134 @@ def search_stations(
 
         results.sort(key=lambda x: (x.get("updated_at") or 0),
                      reverse=order_desc_by_updated)
-        return [dict(r) for r in results[offset: offset + limit]]
\ No newline at end of file
+        return [dict(r) for r in results[offset: offset + limit]]
+
+# ---------- 按城市的有序游标（分页报告用） ----------
+
+OrderKey = Tuple[int, str]
+
+
+def order_key(s: Dict) -> OrderKey:
+    """报告明细的排序键：updated_at 倒序，同值按 id；键唯一，可直接作分页游标。"""
+    return (-int(s.get("updated_at") or 0), str(s.get("id") or ""))
+
+
+def _city_views() -> Dict:
+    """city -> {"keys": [...], "rows": [...]}（按 order_key 升序）；全量载入后首次用到时建一次。调用方需持锁。"""
+    v = _STATE["_views"]
+    if v is not None:
+        return v
+    grouped: Dict[Optional[str], list] = {}
+    for s in _STATE["stations"]:
+        grouped.setdefault(s.get("city"), []).append((order_key(s), s))
+    by_city = {}
+    for city, pairs in grouped.items():
+        pairs.sort(key=lambda x: x[0])
+        by_city[city] = {"keys": [k for k, _ in pairs], "rows": [r for _, r in pairs]}
+    v = _STATE["_views"] = {"by_city": by_city, "stats": {}}
+    return v
+
+
+def _view_pos(s: Optional[Dict]) -> Optional[Tuple[Optional[str], OrderKey]]:
+    """写入前记下该行在视图里的位置（城市 + 排序键），供 _patch_views 摘除。"""
+    return (s.get("city"), order_key(s)) if s else None
+
+
+def _patch_views(s: Dict, old: Optional[Tuple[Optional[str], OrderKey]]):
+    """单条写入后只修补受影响城市的有序视图（摘旧位置、按新键插入），并丢掉这些城市的统计缓存。调用方需持锁。"""
+    v = _STATE["_views"]
+    if v is None:
+        return
+    touched = {s.get("city")}
+    if old is not None:
+        city, key = old
+        touched.add(city)
+        view = v["by_city"].get(city)
+        if view:
+            i = bisect_left(view["keys"], key)
+            if i < len(view["keys"]) and view["keys"][i] == key:
+                del view["keys"][i], view["rows"][i]
+            if not view["rows"]:
+                del v["by_city"][city]
+    view = v["by_city"].setdefault(s.get("city"), {"keys": [], "rows": []})
+    key = order_key(s)
+    i = bisect_right(view["keys"], key)
+    view["keys"].insert(i, key)
+    view["rows"].insert(i, s)
+    for k in [k for k in v["stats"] if k[0] in touched]:
+        del v["stats"][k]
+
+
+def scan_city(
+    city: str,
+    *,
+    status: Optional[str] = None,
+    after: Optional[OrderKey] = None,
+    limit: int = 50,
+) -> Tuple[List[Dict], Optional[OrderKey]]:
+    """
+    从游标 after（不含）开始按 order_key 顺序取最多 limit 条（可按 status 过滤）。
+    返回 (rows, next_after)：还有后续时 next_after 为本批最后一条的键，否则 None。
+    游标是键而不是下标：翻页期间有写入时，未被改动的行既不重复也不跳过（被更新的行按新位置出现）。
+    """
+    with _LOCK:
+        if not _STATE["_index"]:
+            _load_from_disk()
+        view = _city_views()["by_city"].get(city)
+        if not view:
+            return [], None
+        keys, rows = view["keys"], view["rows"]
+        i = bisect_right(keys, tuple(after)) if after is not None else 0
+        out: List[Dict] = []
+        while i < len(rows):
+            s = rows[i]
+            if status is None or s.get("status") == status:
+                if len(out) >= limit:
+                    return out, order_key(out[-1])
+                out.append(dict(s))
+            i += 1
+        return out, None
+
+
+def city_stats(city: str, status: Optional[str] = None) -> Dict:
+    """城市（+状态）的总数与厂商/频段/状态分布；缓存到该城市下次有写入为止。"""
+    with _LOCK:
+        if not _STATE["_index"]:
+            _load_from_disk()
+        v = _city_views()
+        key = (city, status)
+        hit = v["stats"].get(key)
+        if hit is None:
+            view = v["by_city"].get(city) or {"rows": []}
+            rows = [s for s in view["rows"] if status is None or s.get("status") == status]
+            hit = v["stats"][key] = {
+                "total": len(rows),
+                "status": Counter((s.get("status") or "").lower() for s in rows),
+                "vendor": Counter(s.get("vendor", "") for s in rows),
+                "band": Counter(s.get("band", "") for s in rows),
+            }
+        return hit
+
+
+def search_text(
+    q: str,
+    *,
+    k: int = 20,
+    vendor: Optional[str] = None,
+    band: Optional[str] = None,
+    status: Optional[str] = None,
+    require_phrase: bool = False,
+) -> List[Dict]:
+    """
+    全文检索（BM25 + 最近更新加权），vendor/band/status 为不区分大小写的精确过滤。
+    require_phrase：只要“查询中某段原文出现在站点字段里”的结果（见 search_index）。
+    """
+    def ci(v): return str(v or "").lower()
+    filters = [(f, ci(v)) for f, v in (("vendor", vendor), ("band", band), ("status", status)) if v]
+    with _LOCK:
+        if not _STATE["_index"]:
+            _load_from_disk()
+        index = _STATE["_index"]
+        where = (lambda sid: all(ci(index[sid].get(f)) == v for f, v in filters)) if filters else None
+        hits = _STATE["_search"].search(q or "", k=k, where=where, require_phrase=require_phrase)
+        return [dict(index[sid]) for _, sid in hits]
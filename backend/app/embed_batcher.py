@@ -0,0 +1,135 @@
+
+# app/embed_batcher.py
+"""
+查询向量化的 LRU 缓存 + 动态微批（embed router 用）。
+- 查询先归一化（NFKC + 小写 + 折叠空白）再查缓存；同一句话不重复过模型
+- 未命中的请求进队列，专用工作线程取到第一条后最多再等 max_wait_ms 凑批（到 max_batch 立即发），
+  一次 encode 整批；CPU 上每次 encode 的固定开销（分词、调度、线程同步）被整批摊薄
+- 批内重复文本只编码一次；调用方阻塞在 Future 上（同步 handler 所在的线程池线程里等）
+"""
+from __future__ import annotations
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from . import metrics
+from .search_index import normalize
+
+log = logging.getLogger(__name__)
+
+EMBED_BATCH_MAX = int(os.environ.get("EMBED_BATCH_MAX", 32))
+EMBED_BATCH_WAIT_MS = float(os.environ.get("EMBED_BATCH_WAIT_MS", 3))
+EMBED_QUERY_CACHE = int(os.environ.get("EMBED_QUERY_CACHE", 2048))
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(normalize(text).split())
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        encode: Callable[[List[str]], np.ndarray],
+        *,
+        max_batch: int = EMBED_BATCH_MAX,
+        max_wait_ms: float = EMBED_BATCH_WAIT_MS,
+        cache_size: int = EMBED_QUERY_CACHE,
+        name: str = "embed-batcher",
+    ):
+        self._encode = encode
+        self.max_batch = max(1, max_batch)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._q: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name=name, daemon=True)
+        self._thread.start()
+
+    # ---------- 缓存 ----------
+    def _cache_get(self, key: str) -> Optional[np.ndarray]:
+        with self._cache_lock:
+            v = self._cache.get(key)
+            if v is not None:
+                self._cache.move_to_end(key)
+            return v
+
+    def _cache_put(self, key: str, v: np.ndarray):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = v
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # ---------- 对外 ----------
+    def submit(self, text: str) -> Future:
+        key = normalize_query(text)
+        fut: Future = Future()
+        hit = self._cache_get(key)
+        if hit is not None:
+            metrics.inc("embed_query_cache_hit")
+            fut.set_result(hit)
+            return fut
+        metrics.inc("embed_query_cache_miss")
+        self._q.put((key, fut))
+        return fut
+
+    def encode(self, text: str, timeout: Optional[float] = None) -> np.ndarray:
+        """阻塞直到拿到向量（命中缓存时立即返回）。"""
+        return self.submit(text).result(timeout=timeout)
+
+    def encode_many(self, texts: Sequence[str]) -> List[np.ndarray]:
+        futs = [self.submit(t) for t in texts]
+        return [f.result() for f in futs]
+
+    def close(self):
+        self._q.put(None)
+        self._thread.join(timeout=1.0)
+
+    # ---------- 工作线程 ----------
+    def _collect(self, first: tuple) -> List[tuple]:
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait_s
+        while len(batch) < self.max_batch:
+            left = deadline - time.perf_counter()
+            try:
+                item = self._q.get(timeout=left) if left > 0 else self._q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._q.put(None)   # 留给主循环退出
+                break
+            batch.append(item)
+        return batch
+
+    def _worker(self):
+        while True:
+            first = self._q.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            texts = list(dict.fromkeys(k for k, _ in batch))
+            t0 = time.perf_counter()
+            try:
+                vecs = np.asarray(self._encode(texts), dtype=np.float32)
+            except BaseException as e:   # 失败时整批的调用方都拿到异常
+                log.warning("embed batch failed (%d texts): %s", len(texts), e)
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            metrics.observe("embed_batch_size", len(batch))
+            metrics.observe("embed_batch_ms", (time.perf_counter() - t0) * 1000.0)
+            by_key = dict(zip(texts, vecs))
+            for k, v in by_key.items():
+                self._cache_put(k, v)
+            for k, fut in batch:
+                fut.set_result(by_key[k])
@@ -0,0 +1,104 @@
+
+# app/embed_cache.py
+"""
+按内容寻址的向量缓存：key = sha1(模型名 + 文本)，值为归一化后的 float32 向量。
+- 每个模型一个 .npz（keys + vecs），整体原子替换；进程启动时一次读入
+- get_many 只把未命中的文本交给 encode（一次批量），新向量追加后落盘
+- 超过 max_entries 时按最近使用淘汰（本进程用到的 key 先保留）
+用于意图示例句：示例不变时 worker 启动不再重新编码整个意图库。
+"""
+from __future__ import annotations
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", "embed_cache")
+EMBED_CACHE_MAX = int(os.environ.get("EMBED_CACHE_MAX", 50_000))
+
+
+def _slug(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_") or "model"
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, *, path: str = EMBED_CACHE_DIR, max_entries: int = EMBED_CACHE_MAX):
+        self.model_name = model_name
+        self.file = os.path.join(path, _slug(model_name) + ".npz")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._rows: Optional[OrderedDict] = None   # key -> np.ndarray(dim,)，按最近使用排序
+
+    def key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def _load(self) -> OrderedDict:
+        if self._rows is not None:
+            return self._rows
+        rows: OrderedDict = OrderedDict()
+        try:
+            with np.load(self.file, allow_pickle=False) as z:
+                keys, vecs = z["keys"], z["vecs"]
+                if len(keys) == len(vecs):
+                    for k, v in zip(keys.tolist(), vecs):
+                        rows[k] = v
+        except (OSError, ValueError, KeyError):
+            pass   # 没有缓存文件或已损坏：当作空缓存
+        self._rows = rows
+        return rows
+
+    def _save(self, rows: OrderedDict):
+        d = os.path.dirname(self.file) or "."
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_embcache_", suffix=".npz", dir=d)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, keys=np.array(list(rows.keys()), dtype="U40"),
+                         vecs=np.stack(list(rows.values())).astype(np.float32, copy=False))
+            os.replace(tmp, self.file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def get_many(self, texts: Sequence[str], encode: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+        """返回与 texts 逐行对齐的向量矩阵；只编码缓存里没有的文本（去重后一次批量）。"""
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        keys = [self.key(t) for t in texts]
+        with self._lock:
+            rows = self._load()
+            # 命中的向量在这一段锁内就取出来：编码期间别的调用可能把它们淘汰掉
+            found = {k: rows[k] for k in dict.fromkeys(keys) if k in rows}
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+        if missing:
+            by_key = dict(zip(keys, texts))
+            fresh = np.asarray(encode([by_key[k] for k in missing]), dtype=np.float32)
+            found.update(zip(missing, fresh))
+        metrics.inc("embed_cache_hit", len(keys) - len(missing))
+        metrics.inc("embed_cache_miss", len(missing))
+        out = np.stack([found[k] for k in keys])
+        with self._lock:
+            rows = self._load()
+            for k in missing:
+                rows[k] = found[k]
+            for k in keys:
+                if k in rows:
+                    rows.move_to_end(k)
+            if missing:
+                while len(rows) > self.max_entries:
+                    rows.popitem(last=False)
+                try:
+                    self._save(rows)
+                except OSError:
+                    log.warning("embed cache write failed: %s", self.file, exc_info=True)
+        return out
@@ -0,0 +1,316 @@
+
+# app/embed_index.py
+"""
+站点 / POI 文本的向量索引（语义检索，补 BM25 字面匹配的不足：“晚高峰很卡” ≈ “早晚高峰有干扰告警”）。
+- 向量矩阵落盘为 .npy（float32 或 int8 + 每行 scale），启动时 np.load(mmap_mode="r") 映射，不整体读入内存
+- manifest.json 记录 key（station:<id> / poi:<id>）、文本 sha1、模型名与维度；同步时只重编码新增/变化的记录
+- 每次同步写新一代文件（vectors-<gen>.npy），manifest 原子替换后再删旧文件：进程中途崩溃不会留下错位的矩阵
+- 检索为归一化向量点积（= 余弦相似度）的 Top-K；int8 时按行 scale 还原
+- sentence-transformers 为可选依赖：未安装或模型加载失败时索引停用，search 返回空（调用方只剩 BM25）
+"""
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import metrics
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+EMBED_INDEX_DIR = os.environ.get("EMBED_INDEX_DIR", "embed_index")
+EMBED_INDEX_DTYPE = os.environ.get("EMBED_INDEX_DTYPE", "float32")   # float32 | int8
+EMBED_BATCH = int(os.environ.get("EMBED_BATCH", 64))
+EMBED_MIN_SCORE = float(os.environ.get("EMBED_MIN_SCORE", 0.35))
+EMBED_INDEX_RETRY_S = float(os.environ.get("EMBED_INDEX_RETRY_S", 60))   # 同步/模型加载失败后多久再试
+
+Encoder = Callable[[Sequence[str]], np.ndarray]
+
+
+def _sha1(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def station_text(st: Dict) -> str:
+    """参与编码的站点文本；不含 status/updated_at，状态切换不触发重编码（状态过滤交给调用方）。"""
+    parts = [st.get("name"), st.get("city"), st.get("vendor"), st.get("band"), st.get("desc")]
+    return " ".join(str(p) for p in parts if p)
+
+
+def poi_text(p: Dict) -> str:
+    parts = [p.get("name"), *(p.get("aliases") or []), p.get("city"), p.get("district"),
+             p.get("addr_hint"), p.get("category")]
+    return " ".join(str(x) for x in parts if x)
+
+
+def records(stations: Iterable[Dict], pois: Iterable[Dict]) -> List[Tuple[str, str]]:
+    out = [(f"station:{s['id']}", station_text(s)) for s in stations if s.get("id")]
+    out += [(f"poi:{p['id']}", poi_text(p)) for p in pois if p.get("id")]
+    return out
+
+
+def _quantize(vecs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """逐行对称量化到 int8：x ≈ q * scale。"""
+    scale = np.abs(vecs).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.rint(vecs / scale[:, None]), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+class EmbeddingIndex:
+    def __init__(self, path: str, *, model_name: str, dtype: str = "float32",
+                 encoder: Optional[Encoder] = None):
+        if dtype not in ("float32", "int8"):
+            raise ValueError(f"unsupported dtype: {dtype}")
+        self.path = path
+        self.model_name = model_name
+        self.dtype = dtype
+        self._encoder = encoder
+        self._model_lock = threading.Lock()      # 模型只实例化一次（同步线程与请求线程可能同时触发）
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()       # 同一时刻只跑一个 sync
+        self._keys: List[str] = []
+        self._hashes: List[str] = []
+        self._pos: Dict[str, int] = {}
+        self._mat: Optional[np.ndarray] = None   # memmap（只读）
+        self._scale: Optional[np.ndarray] = None
+        self._gen = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # ---------- 编码器 ----------
+    @property
+    def has_encoder(self) -> bool:
+        return self._encoder is not None
+
+    def ensure_encoder(self):
+        if self._encoder is not None:
+            return
+        with self._model_lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer   # 可选依赖，首次用到才加载
+                model = SentenceTransformer(self.model_name)
+                self._encoder = lambda xs: model.encode(list(xs), batch_size=EMBED_BATCH,
+                                                        normalize_embeddings=True)
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        self.ensure_encoder()
+        return np.asarray(self._encoder(texts), dtype=np.float32)
+
+    # ---------- 磁盘 ----------
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def load(self) -> bool:
+        """映射磁盘上的索引；模型/精度与当前配置不符或文件缺失时返回 False（下次 sync 全量编码）。"""
+        try:
+            with open(self._file("manifest.json"), "r", encoding="utf-8") as f:
+                man = json.load(f)
+            if man.get("model") != self.model_name or man.get("dtype") != self.dtype:
+                return False
+            mat = np.load(self._file(man["vectors"]), mmap_mode="r")
+            scale = np.load(self._file(man["scales"])) if man.get("scales") else None
+            if mat.shape[0] != len(man["keys"]):
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+        with self._lock:
+            self._keys, self._hashes = list(man["keys"]), list(man["hashes"])
+            self._pos = {k: i for i, k in enumerate(self._keys)}
+            self._mat, self._scale, self._gen = mat, scale, int(man.get("gen", 0))
+        return True
+
+    def _write(self, keys: List[str], hashes: List[str], vecs: np.ndarray) -> Dict:
+        os.makedirs(self.path, exist_ok=True)
+        gen = self._gen + 1
+        vec_name, scale_name = f"vectors-{gen}.npy", None
+        if self.dtype == "int8":
+            q, scale = _quantize(vecs)
+            np.save(self._file(vec_name), q)
+            scale_name = f"scales-{gen}.npy"
+            np.save(self._file(scale_name), scale)
+        else:
+            np.save(self._file(vec_name), vecs.astype(np.float32, copy=False))
+        man = {"model": self.model_name, "dtype": self.dtype, "dim": int(vecs.shape[1]) if vecs.ndim == 2 else 0,
+               "gen": gen, "vectors": vec_name, "scales": scale_name, "keys": keys, "hashes": hashes,
+               "updated_at": int(time.time())}
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_manifest_", dir=self.path)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(man, f, ensure_ascii=False)
+            os.replace(tmp, self._file("manifest.json"))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return man
+
+    def _cleanup(self, keep_gen: int):
+        for name in os.listdir(self.path):
+            if name.startswith(("vectors-", "scales-")) and name.endswith(".npy"):
+                try:
+                    if int(name.split("-", 1)[1][:-4]) != keep_gen:
+                        os.remove(self._file(name))
+                except (ValueError, OSError):
+                    pass
+
+    def _rows(self, idx: List[int]) -> np.ndarray:
+        """按下标取出旧矩阵的行并还原为 float32。"""
+        rows = np.asarray(self._mat[idx], dtype=np.float32)
+        if self._scale is not None:
+            rows *= self._scale[idx][:, None]
+        return rows
+
+    # ---------- 增量同步 ----------
+    def sync(self, recs: Iterable[Tuple[str, str]]) -> Dict[str, int]:
+        """
+        recs：[(key, text)] 全量记录。只编码 sha1 变化或新增的记录，删除已不存在的 key，
+        其余行从旧矩阵原样拷贝；写新一代文件后切换映射。
+        """
+        with self._sync_lock:
+            recs = list(dict(recs).items())   # 同 key 取最后一条
+            keys = [k for k, _ in recs]
+            hashes = [_sha1(t) for _, t in recs]
+            with self._lock:
+                old_pos, old_hashes = dict(self._pos), list(self._hashes)
+            keep = [(i, old_pos[k]) for i, k in enumerate(keys)
+                    if k in old_pos and old_hashes[old_pos[k]] == hashes[i]]
+            todo = sorted(set(range(len(keys))) - {i for i, _ in keep})
+            removed = len(set(old_pos) - set(keys))
+            if not todo and not removed:
+                return {"encoded": 0, "removed": 0, "total": len(keys)}
+
+            t0 = time.perf_counter()
+            fresh = self.encode([recs[i][1] for i in todo]) if todo else None
+            dim = (fresh.shape[1] if fresh is not None else
+                   (self._mat.shape[1] if self._mat is not None else 0))
+            vecs = np.zeros((len(keys), dim), dtype=np.float32)
+            if keep:
+                vecs[[i for i, _ in keep]] = self._rows([j for _, j in keep])
+            if fresh is not None:
+                vecs[todo] = fresh
+            man = self._write(keys, hashes, vecs)
+            self.load()
+            self._cleanup(man["gen"])
+            metrics.observe("embed_sync_ms", (time.perf_counter() - t0) * 1000.0)
+            log.info("embed index synced: encoded=%d removed=%d total=%d", len(todo), removed, len(keys))
+            return {"encoded": len(todo), "removed": removed, "total": len(keys)}
+
+    # ---------- 检索 ----------
+    def search(self, query: str, *, k: int = 10, prefix: Optional[str] = None,
+               min_score: float = EMBED_MIN_SCORE) -> List[Tuple[float, str]]:
+        """返回 [(score, key)]，分数降序；prefix（如 "station:"）限定记录类型。"""
+        with self._lock:
+            mat, scale, keys = self._mat, self._scale, self._keys
+        if mat is None or not keys or not (query or "").strip():
+            return []
+        q = self.encode([query])[0]
+        sims = np.asarray(mat @ q, dtype=np.float32)   # int8 矩阵与 float32 查询相乘会提升为 float32
+        if scale is not None:
+            sims *= scale
+        if prefix is not None:
+            mask = np.fromiter((key.startswith(prefix) for key in keys), dtype=bool, count=len(keys))
+            sims = np.where(mask, sims, -np.inf)
+        n = min(k, len(keys))
+        top = np.argpartition(-sims, n - 1)[:n] if n < len(keys) else np.arange(len(keys))
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(float(sims[i]), keys[i]) for i in top if sims[i] >= min_score]
+
+
+INDEX = EmbeddingIndex(EMBED_INDEX_DIR, model_name=EMBED_MODEL, dtype=EMBED_INDEX_DTYPE)
+
+_STATE = {
+    "loaded": False,
+    "synced_version": None,   # 上次同步时的数据版本（db_json.version()）
+    "running": False,
+    "disabled": None,         # sentence-transformers 未安装（不再重试）
+    "error": None,            # 最近一次失败（模型加载/同步/检索），EMBED_INDEX_RETRY_S 内不再重试
+    "failed_at": 0.0,
+}
+_LOCK = threading.Lock()
+
+
+def _fail(e: BaseException):
+    with _LOCK:
+        if isinstance(e, ImportError):
+            _STATE["disabled"] = f"sentence-transformers 不可用：{e}"
+        _STATE["error"], _STATE["failed_at"] = f"{type(e).__name__}: {e}", time.time()
+
+
+def _backing_off() -> bool:
+    return bool(_STATE["error"]) and time.time() - _STATE["failed_at"] < EMBED_INDEX_RETRY_S
+
+
+def _sync(version, load_records: Callable[[], List[Tuple[str, str]]]):
+    try:
+        # 模型在后台加载（即使本次无需重编码），请求线程不承担首次加载
+        INDEX.ensure_encoder()
+        INDEX.sync(load_records())
+        with _LOCK:
+            _STATE["synced_version"] = version
+            _STATE["error"] = None
+    except ImportError as e:
+        _fail(e)
+        log.warning("embed index disabled: %s", e)
+    except Exception as e:
+        _fail(e)
+        log.exception("embed index sync failed")
+    finally:
+        with _LOCK:
+            _STATE["running"] = False
+
+
+def is_current(version) -> bool:
+    """索引已按该数据版本同步（或已停用、无需同步）；不加锁，只用于请求路径上的快速判断。"""
+    return bool(_STATE["disabled"]) or (_STATE["synced_version"] == version and INDEX.has_encoder)
+
+
+def refresh_async(version, load_records: Callable[[], List[Tuple[str, str]]]) -> bool:
+    """
+    数据版本变化时在后台线程增量同步（不阻塞请求：同步期间检索用旧矩阵，已删除的记录由调用方回表过滤）。
+    首次调用先映射磁盘上已有的索引。返回是否启动了同步。
+    """
+    with _LOCK:
+        if _STATE["disabled"] or _STATE["running"] or _backing_off():
+            return False
+        if _STATE["synced_version"] == version and INDEX.has_encoder:
+            return False
+        _STATE["running"] = True
+        if not _STATE["loaded"]:
+            _STATE["loaded"] = True
+            INDEX.load()
+    threading.Thread(target=_sync, args=(version, load_records), name="embed-sync", daemon=True).start()
+    return True
+
+
+def search(query: str, *, k: int = 10, kind: Optional[str] = None) -> List[Tuple[float, str]]:
+    """
+    kind：station / poi / None（全部）。索引停用、模型尚未在后台加载好、或处于失败退避期时返回空；
+    检索本身出错（如模型推理异常）也只记录并退避，调用方照常只用 BM25。
+    """
+    if _STATE["disabled"] or _backing_off() or not len(INDEX) or not INDEX.has_encoder:
+        return []
+    with tracing.span("embed_search", kind=kind or "all") as sp:
+        try:
+            hits = INDEX.search(query, k=k, prefix=f"{kind}:" if kind else None)
+        except Exception as e:
+            _fail(e)
+            log.warning("embed search failed, backing off %.0fs: %s", EMBED_INDEX_RETRY_S, e)
+            sp["error"] = type(e).__name__
+            return []
+        sp["hits"] = len(hits)
+    return hits
+
+
+def status() -> Dict:
+    return {"records": len(INDEX), "model": INDEX.model_name, "dtype": INDEX.dtype,
+            "synced_version": _STATE["synced_version"], "running": _STATE["running"],
+            "encoder": INDEX.has_encoder, "disabled": _STATE["disabled"], "error": _STATE["error"]}
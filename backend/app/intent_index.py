@@ -0,0 +1,53 @@
+
+# app/intent_index.py
+"""
+意图打分的向量化实现（EmbeddingRouter 用；不依赖模型，可单独做基准）。
+示例向量按意图连续存放：意图 i 占 [starts[i], starts[i+1]) 行。
+- 点积一次算出所有示例的相似度
+- np.maximum.reduceat 做分段取最大（每个意图一个分数），不再逐示例 Python 循环
+- argpartition 只取前 n 个候选再排序，意图数再多也不做全量 sort
+- 示例库很大时可传入近似索引（ann_index.IVFIndex）：只取前 candidates 个最近示例，按所属意图取最大
+"""
+from __future__ import annotations
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+def segment_max(sims: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """starts 升序且每段非空；返回每段的最大值。"""
+    return np.maximum.reduceat(sims, starts)
+
+
+def top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    """分数最高的 n 个下标（降序；同分时按下标，结果稳定）。"""
+    n = min(n, len(scores))
+    if n <= 0:
+        return np.zeros(0, dtype=np.intp)
+    idx = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+    return idx[np.lexsort((idx, -scores[idx]))]
+
+
+def rank_intents(
+    matrix: np.ndarray,
+    starts: np.ndarray,
+    names: Sequence[str],
+    q: np.ndarray,
+    n: int,
+    *,
+    index=None,
+    candidates: int = 64,
+) -> List[Tuple[str, float]]:
+    """q 为归一化查询向量；返回按最大相似度降序的前 n 个 (意图, 分数)。"""
+    if matrix is None or not len(starts):
+        return []
+    if index is not None:
+        rows, sims = index.search(q, max(candidates, n))
+        seg = np.searchsorted(starts, rows, side="right") - 1
+        # 结果已按相似度降序：每个意图第一次出现的位置就是它的最大值
+        _, first = np.unique(seg, return_index=True)
+        first.sort()
+        return [(names[seg[i]], float(sims[i])) for i in first[:n]]
+    sims = matrix @ q               # 余弦相似度（归一化后点积）
+    best = segment_max(sims, starts)
+    return [(names[i], float(best[i])) for i in top_n(best, n)]
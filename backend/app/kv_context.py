@@ -0,0 +1,72 @@
+# app/kv_context.py
+"""
+按对话缓存 Ollama 的 context（/api/generate 在 done 时返回的 token 状态）。
+键只取稳定段：模型 + 前缀（护栏/系统指令 + 选中站点等跨轮不变的部分）。每轮都变的内容
+（TopK 表、地标、问题）由调用方放在本轮消息里，不进前缀，否则哈希每轮都变、永远续用不上。
+下一轮模型与前缀都没变，就带上 context、只发本轮消息，Ollama 可跳过前缀的重新计算。
+两段 LRU：首轮写入的先进小的试用区（KV_CONTEXT_PROBATION），下一轮真的续用才转正进主区；
+只问一次的匿名对话只在试用区里轮换，挤不掉正在多轮对话的条目。LRU + TTL + 内存上限由 SessionStore 负责。
+"""
+from __future__ import annotations
+import hashlib
+import os
+from typing import List, Optional
+
+from .session_store import SessionStore
+
+KV_CONTEXT_TTL_S = float(os.environ.get("KV_CONTEXT_TTL_S", 15 * 60))
+KV_CONTEXT_MAX_TOKENS = int(os.environ.get("KV_CONTEXT_MAX_TOKENS", 6000))  # 超长就不再续用，防止撑爆窗口
+
+KV_CONTEXTS = SessionStore(
+    ttl_s=KV_CONTEXT_TTL_S,
+    max_entries=int(os.environ.get("KV_CONTEXT_MAX", 512)),
+    max_bytes=int(os.environ.get("KV_CONTEXT_MAX_BYTES", 32 * 1024 * 1024)),
+)
+KV_PROBATION = SessionStore(
+    ttl_s=float(os.environ.get("KV_CONTEXT_PROBATION_TTL_S", 5 * 60)),
+    max_entries=int(os.environ.get("KV_CONTEXT_PROBATION", 64)),
+    max_bytes=int(os.environ.get("KV_CONTEXT_PROBATION_MAX_BYTES", 4 * 1024 * 1024)),
+)
+
+
+def _key(conversation_id: str, channel: str) -> str:
+    return f"{conversation_id}|{channel}"
+
+
+def _prefix_hash(prefix: str, model: str) -> str:
+    return hashlib.sha1(f"{model}\n{prefix or ''}".encode("utf-8")).hexdigest()
+
+
+def lookup(conversation_id: str, channel: str, prefix: str, *, model: str = "") -> Optional[List[int]]:
+    """同一对话、同一通道，模型与前缀都未变 → 返回可续用的 context（试用区命中即转正）；否则 None。"""
+    key = _key(conversation_id, channel)
+    rec = KV_CONTEXTS.get(key)
+    if rec is None:
+        rec = KV_PROBATION.get(key)
+        if rec is not None:
+            KV_PROBATION.delete(key)
+            KV_CONTEXTS.set(key, rec)
+    if not rec or rec.get("prefix") != _prefix_hash(prefix, model):
+        return None
+    return rec.get("context")
+
+
+def remember(conversation_id: str, channel: str, prefix: str, context: Optional[List[int]], *, model: str = ""):
+    """记下本轮结束时的 context：已转正的对话写主区，其它先进试用区。"""
+    key = _key(conversation_id, channel)
+    if not context or len(context) > KV_CONTEXT_MAX_TOKENS:
+        KV_CONTEXTS.delete(key)
+        KV_PROBATION.delete(key)
+        return
+    rec = {"prefix": _prefix_hash(prefix, model), "context": list(context)}
+    (KV_CONTEXTS if key in KV_CONTEXTS else KV_PROBATION).set(key, rec)
+
+
+def forget(conversation_id: str, channel: Optional[str] = None):
+    for store in (KV_CONTEXTS, KV_PROBATION):
+        if channel is not None:
+            store.delete(_key(conversation_id, channel))
+            continue
+        for key, _ in store.items():
+            if key.startswith(f"{conversation_id}|"):
+                store.delete(key)
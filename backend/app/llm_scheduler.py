@@ -0,0 +1,121 @@
+
+# app/llm_scheduler.py
+"""
+Ollama 前置的准入控制：限制并发生成数，其余按优先级排队。
+- 数字越小优先级越高；同优先级先来先服务
+- 队列超过上限直接拒绝（QueueFull），由调用方回一条明确的事件
+- 排队期间通过 Ticket.wait() 推送“当前排第几位”
+"""
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import os
+from typing import AsyncIterator, List, Optional
+
+# 优先级：短的直接解读在前，长的兜底生成在后
+PRIORITY_SHORT = 0      # 图表解读 / 附近流回答
+PRIORITY_LONG = 10      # TopK 兜底长回答
+
+
+class QueueFull(Exception):
+    """排队数已达上限。"""
+
+
+class Ticket:
+    def __init__(self, sched: "GenerationScheduler", priority: int, seq: int):
+        self.sched = sched
+        self.priority = priority
+        self.seq = seq
+        self.admitted = False
+        self.released = False
+        self._changed: Optional[asyncio.Event] = None
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    async def wait(self) -> AsyncIterator[int]:
+        """等待放行；排队位置变化时 yield 新位置（1 起）。已放行则不 yield。"""
+        last = None
+        while True:
+            # 先挂好事件再检查状态，避免 yield 期间的唤醒丢失
+            self._changed = asyncio.Event()
+            if self.admitted:
+                return
+            pos = self.sched.position(self)
+            if pos != last:
+                last = pos
+                yield pos
+                continue
+            await self._changed.wait()
+
+    def release(self):
+        self.sched._release(self)
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 32):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self._active = 0
+        self._heap: List[Ticket] = []
+        self._seq = itertools.count()
+
+    def enqueue(self, priority: int = PRIORITY_LONG) -> Ticket:
+        """申请一个生成槽位：有空位立即放行，否则入队；队满抛 QueueFull。"""
+        t = Ticket(self, priority, next(self._seq))
+        if self._active < self.max_concurrent and not self._heap:
+            self._active += 1
+            t.admitted = True
+            return t
+        if len(self._heap) >= self.max_queue:
+            raise QueueFull(f"queue full ({self.max_queue})")
+        heapq.heappush(self._heap, t)
+        # 插队会让排在后面的人位置后移
+        for x in self._heap:
+            if t < x and x._changed is not None:
+                x._changed.set()
+        return t
+
+    def position(self, t: Ticket) -> int:
+        if t.admitted:
+            return 0
+        return 1 + sum(1 for x in self._heap if x < t)
+
+    def _release(self, t: Ticket):
+        if t.released:
+            return
+        t.released = True
+        if t.admitted:
+            self._active -= 1
+        else:
+            # 排队中被取消：从堆里摘掉
+            try:
+                self._heap.remove(t)
+                heapq.heapify(self._heap)
+            except ValueError:
+                pass
+        woken = []
+        while self._heap and self._active < self.max_concurrent:
+            nxt = heapq.heappop(self._heap)
+            nxt.admitted = True
+            self._active += 1
+            woken.append(nxt)
+        # 放行的 + 仍在排队的（位置变了）都唤醒一次
+        for x in woken + self._heap:
+            if x._changed is not None:
+                x._changed.set()
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "queued": len(self._heap),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
+
+
+SCHEDULER = GenerationScheduler(
+    max_concurrent=int(os.environ.get("LLM_MAX_CONCURRENT", 2)),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", 32)),
+)
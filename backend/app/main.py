@@ -2,10 +2,11 @@
 
 # app/main.py
 import json
-from typing import Any, Dict, List, AsyncGenerator
-from fastapi import FastAPI, Body, Query
+from typing import Any, Callable, Dict, List, AsyncGenerator
+from dataclasses import dataclass
+from fastapi import FastAPI, Body, Query, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from app import mock_geo  # 就是上面新建的模块
 from app import db_json
 from pydantic import BaseModel
@@ -14,9 +15,24 @@ import anyio
 import base64
 import httpx
 from collections import Counter
+from contextlib import asynccontextmanager, aclosing
 from .mock_geo import BASE as POI_SEED
 from . import pois_json
+from . import ollama_client
+from . import llm_scheduler
+from . import metrics
+from . import kv_context
+from . import tracing
+from . import conversations
+from . import ws_mux
+from . import context_packer
+from . import embed_index
+from .sse_coalesce import coalesce_into, coalesce_stream, pump
+from .session_store import SessionStore
 import time
+import os
+import threading
+import logging
 
 
 
@@ -30,6 +46,8 @@ from strands.models.ollama import OllamaModel
 import hashlib
 from math import isnan
 
+log = logging.getLogger(__name__)
+
 
 # === 图表解读小工具 ===
 def _aggregate_stats(rows: list[dict]) -> dict:
@@ -70,41 +88,62 @@ def _classify_kind(prompt: str) -> str:
 
 
 # 连接本地 Ollama（确保 ollama serve 在跑，且已 pull 对应模型）
+# OLLAMA_HOST 可指向 bench/fake_ollama.py 做离线压测
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+if "://" not in OLLAMA_HOST:  # 与 ollama CLI 的写法兼容（如 127.0.0.1:11434）
+    OLLAMA_HOST = "http://" + OLLAMA_HOST
+OLLAMA_MODEL_ID = os.environ.get("OLLAMA_MODEL_ID", "qwen3:1.7b")   # 改成你本机可用模型
 model = OllamaModel(
-    host="http://127.0.0.1:11434",
-    model_id="qwen3:1.7b",   # 改成你本机可用模型
+    host=OLLAMA_HOST,
+    model_id=OLLAMA_MODEL_ID,
 )
-OLLAMA_HOST = "http://127.0.0.1:11434"
-OLLAMA_MODEL_ID = "qwen3:1.7b"
 
 
-agent = Agent(
-    model=model,
-    conversation_manager=SlidingWindowConversationManager(window_size=2),
-    system_prompt="You are a helpful assistant that provides concise responses.",
-    callback_handler=None,
+def _make_agent() -> Agent:
+    return Agent(
+        model=model,
+        conversation_manager=SlidingWindowConversationManager(window_size=2),
+        system_prompt="You are a helpful assistant that provides concise responses.",
+        callback_handler=None,
+    )
+
+# /api/chat：每个会话一个 Agent（有界 + 空闲淘汰），不再共用一个对话窗口
+from .agent_pool import AgentPool
+AGENT_POOL = AgentPool(
+    _make_agent,
+    max_agents=int(os.environ.get("CHAT_AGENT_POOL_MAX", 64)),
+    idle_ttl_s=float(os.environ.get("CHAT_AGENT_IDLE_TTL_S", 900)),
 )
+CHAT_TIMEOUT_S = float(os.environ.get("CHAT_TIMEOUT_S", 120))
 
 # ===== 放在 main.py 顶部其它函数旁 =====
 import re
 from . import chart_specs
 
 
-async def stream_from_ollama(prompt: str):
+async def stream_from_ollama(prompt: str, *, context: list[int] | None = None, on_context=None, on_done=None):
     """
     直接对接 Ollama /api/generate 的流式接口：
-    一行一个 JSON：{"response": "...", "done": false} ... {"done": true}
+    一行一个 JSON：{"response": "...", "done": false} ... {"done": true, "context": [...]}
+    复用 ollama_client 的进程级连接池（keep-alive + 超时 + 连接上限）。
+    被取消/关闭时（客户端断开）立即退出 async with，上游 HTTP 流随之关闭。
+    context：上一轮返回的 KV 状态（续用时 prompt 只需新内容）；on_context：done 时回调新的 context。
+    on_done：收到 done:true（生成完整结束）时回调；响应体中途结束不会触发。
     """
-    async with httpx.AsyncClient(timeout=None) as client:
+    client = ollama_client.get_client()
+    body = {
+        "model": OLLAMA_MODEL_ID,
+        "prompt": prompt,
+        "stream": True,
+    }
+    if context:
+        body["context"] = context
+    n_tokens = 0
+    try:
         async with client.stream(
             "POST",
             f"{OLLAMA_HOST}/api/generate",
-            json={
-                "model": OLLAMA_MODEL_ID,
-                "prompt": prompt,
-                "stream": True,
-            },
-            headers={"Accept": "application/json"},
+            json=body,
         ) as resp:
             resp.raise_for_status()
             async for line in resp.aiter_lines():
@@ -116,9 +155,125 @@ async def stream_from_ollama(prompt: str):
                     continue
                 if "response" in obj:
                     # 这里返回“增量”
+                    n_tokens += 1
                     yield obj["response"]
                 if obj.get("done"):
+                    metrics.observe_mean("llm_completion_tokens", obj.get("eval_count") or n_tokens)
+                    if on_context and obj.get("context"):
+                        on_context(obj["context"])
+                    if on_done:
+                        on_done()
                     break
+    except (GeneratorExit, anyio.get_cancelled_exc_class()):
+        # 省下的 token 按历史平均生成长度估算
+        metrics.inc("llm_generations_cancelled")
+        metrics.inc("llm_tokens_saved_est", max(0.0, metrics.mean("llm_completion_tokens") - n_tokens))
+        raise
+
+
+async def llm_events(prompt: str, *, priority: int = llm_scheduler.PRIORITY_LONG,
+                     context: list[int] | None = None, on_context=None, on_done=None):
+    """
+    经准入控制调用模型（事件流）：
+    - 有空位立即生成；否则排队，并推送当前排队位置
+    - 队列已满：发一条 error(queue_full) 事件 + 可读提示，不再调用模型
+    - on_done：模型确认生成完整结束（Ollama done:true）时回调
+    """
+    t_enq = time.perf_counter()
+    try:
+        ticket = llm_scheduler.SCHEDULER.enqueue(priority)
+    except llm_scheduler.QueueFull:
+        metrics.inc("llm_queue_rejected")
+        msg = "当前请求较多，模型队列已满，请稍后再试。"
+        yield {"type": "error", "code": "queue_full", "message": msg}
+        yield {"type": "token", "delta": msg}
+        return
+    try:
+        async for pos in ticket.wait():
+            yield {"type": "log", "channel": "queue", "position": pos, "message": f"模型繁忙，排队中：第 {pos} 位"}
+        t_start = time.perf_counter()
+        tracing.record("queue_wait", (t_start - t_enq) * 1000.0, priority=priority)
+        t_first, n = None, 0
+        try:
+            async with aclosing(stream_from_ollama(prompt, context=context, on_context=on_context,
+                                                   on_done=on_done)) as gen:
+                async for delta in gen:
+                    if t_first is None:
+                        t_first = time.perf_counter()
+                        tracing.record("llm_ttft", (t_first - t_start) * 1000.0)
+                    n += 1
+                    yield {"type": "token", "delta": delta}
+        except httpx.HTTPError as e:
+            # 上游 5xx / 断连：回一条明确的错误事件，而不是让整条 SSE 异常中断
+            metrics.inc("llm_upstream_errors")
+            msg = "（模型输出中断）" if n else "模型服务暂时不可用，请稍后再试。"
+            yield {"type": "error", "code": "llm_unavailable", "message": str(e) or type(e).__name__}
+            yield {"type": "token", "delta": msg}
+            return
+        t_end = time.perf_counter()
+        gen_s = t_end - (t_first or t_start)
+        tps = n / gen_s if n and gen_s > 0 else 0.0
+        metrics.observe("llm_tokens_per_s", tps, buckets=metrics.RATE_BUCKETS)
+        tracing.record("llm_total", (t_end - t_start) * 1000.0, tokens=n, tokens_per_s=round(tps, 1))
+    finally:
+        ticket.release()
+
+
+async def llm_events_with_kv(prefix: str, question: str, *, conversation_id: str | None,
+                             channel: str, priority: int = llm_scheduler.PRIORITY_LONG):
+    """
+    prompt = prefix + question。prefix 只放跨轮稳定的部分（护栏/系统指令/选中站点），
+    每轮都变的上下文（TopK 表等）放进 question。同一对话上轮的模型与 prefix 都没变时，
+    带上 Ollama 返回的 context，只发送 question（跳过前缀重算）；否则发完整 prompt。没有对话 id 时不续用。
+    """
+    cid = conversation_id
+    reuse = bool(cid)
+    ctx_tokens = kv_context.lookup(cid, channel, prefix, model=OLLAMA_MODEL_ID) if reuse else None
+    if ctx_tokens:
+        metrics.inc("llm_kv_context_reused")
+        yield {"type": "log", "channel": "router", "message": f"续用对话 KV 上下文（{len(ctx_tokens)} tokens），仅发送新问题"}
+
+    def _remember(tokens):
+        if reuse:
+            kv_context.remember(cid, channel, prefix, tokens, model=OLLAMA_MODEL_ID)
+
+    async for ev in llm_events(question if ctx_tokens else prefix + question, priority=priority,
+                               context=ctx_tokens, on_context=_remember):
+        yield ev
+
+
+# === 图表解读缓存：prompt（模板 + facts）哈希 → 完整输出 token 序列 ===
+# facts 只由站点数据决定，所以值里记下 db_json.version()，数据一变即失效
+EXPLAIN_CACHE = SessionStore(
+    ttl_s=float(os.environ.get("EXPLAIN_CACHE_TTL_S", 6 * 3600)),
+    max_entries=int(os.environ.get("EXPLAIN_CACHE_MAX", 256)),
+    max_bytes=int(os.environ.get("EXPLAIN_CACHE_MAX_BYTES", 4 * 1024 * 1024)),
+    touch_on_read=False,
+)
+
+def _explain_key(prompt: str) -> str:
+    return hashlib.sha1(f"{OLLAMA_MODEL_ID}\n{prompt}".encode("utf-8")).hexdigest()
+
+async def stream_explanation(prompt: str):
+    """图表解读事件流：命中缓存直接回放 token；未命中则调模型，完整结束后写入缓存。"""
+    key = _explain_key(prompt)
+    ver = db_json.version()
+    hit = EXPLAIN_CACHE.get(key)
+    if hit and hit.get("version") == ver:
+        yield {"type": "log", "channel": "router", "message": f"命中图表解读缓存（{len(hit['tokens'])} 段）"}
+        for delta in hit["tokens"]:
+            yield {"type": "token", "delta": delta}
+        return
+    buf, rejected, done = [], False, []
+    async for ev in llm_events(prompt, priority=llm_scheduler.PRIORITY_SHORT, on_done=lambda: done.append(True)):
+        if ev["type"] == "token":
+            buf.append(ev["delta"])
+        elif ev["type"] == "error":
+            rejected = True
+        yield ev
+    # 只缓存模型确认结束（done:true）且有内容的生成：上游中途断开/空回答/被拒绝都不缓存
+    if done and not rejected and "".join(buf).strip():
+        EXPLAIN_CACHE.set(key, {"version": ver, "tokens": buf})
 
 
 # === 在 main.py 顶部 regex 区域附近新增 ===
@@ -152,8 +307,8 @@ def resolve_station_from_prompt(prompt: str) -> dict | None:
     # 再按名字（可结合城市缩小范围）
     name = extract_station_name(prompt or "")
     if not name:
-        # 没有明确名字，就用现有 TopK 逻辑挑一个强相关候选（避免瞎猜）
-        topk = topk_context_for_prompt(prompt, k=1)
+        # 没有明确名字，就用现有 TopK 逻辑挑一个强相关候选（要求原文命中，避免瞎猜）
+        topk = topk_context_for_prompt(prompt, k=1, require_phrase=True)
         return topk[0] if topk else None
     city = extract_city(prompt or "")
     items = db_json.load_all()
@@ -183,25 +338,25 @@ def normalize_status(s: str) -> str | None:
             return k
     return None
 
-def extract_city_status_count(prompt: str):
+# 统一状态词；两种顺序：① 先状态后“几个/多少/几”；② 先“几个/多少/几”后状态
+STATUS_WORDS = r"(在线|离线|维护|online|offline|maintenance)"
+CITY_STATUS_COUNT_RE = re.compile(
+    rf"(?:(?P<status1>{STATUS_WORDS}).{{0,8}}?(?:几个|多少|几))|(?:(?:几个|多少|几).{{0,8}}?(?P<status2>{STATUS_WORDS}))",
+    re.IGNORECASE,
+)
+
+def extract_city_status_count(prompt: str, city: str | None = None):
     """
     解析：'上海几个是online的' / '北京在线有多少个' / '杭州维护的有几站' 等
-    返回: (city, status) 或 None
+    返回: (city, status) 或 None；city 可由调用方预先解析好传入
     """
     if not prompt:
         return None
-    city = extract_city(prompt)
+    city = city or extract_city(prompt)
     if not city:
         return None
 
-    # 统一状态词
-    STATUS_WORDS = r"(在线|离线|维护|online|offline|maintenance)"
-    # 两种顺序：① 先状态后“几个/多少/几”；② 先“几个/多少/几”后状态
-    pat = re.compile(
-        rf"(?:(?P<status1>{STATUS_WORDS}).{{0,8}}?(?:几个|多少|几))|(?:(?:几个|多少|几).{{0,8}}?(?P<status2>{STATUS_WORDS}))",
-        re.IGNORECASE,
-    )
-    m = pat.search(prompt)
+    m = CITY_STATUS_COUNT_RE.search(prompt)
     if not m:
         return None
     status_raw = m.group("status1") or m.group("status2")
@@ -221,6 +376,8 @@ ROAD_SUFFIX_RE   = re.compile(r"(路|街|巷|大道|环路|高速|省道|国道|
 ADMIN_SUFFIX_RE  = re.compile(r"(市|区|县)$")
 POI_SUFFIX       = r"(中心|广场|商圈|医院|车站|公园|体育场|体育馆|步行街|机场|大厦|园区|科技园|园|市场|码头|港|会展中心|博物馆|美术馆|图书馆|大学|学院|来福士|万象城|太古里|万达广场)"
 LOOSE_POI_BEFORE_NEAR = re.compile(r"([\u4e00-\u9fffA-Za-z0-9·]{2,24})(?=(?:的)?(?:一?公里内|方圆|范围内)?(?:附近|周边|周围))")
+QUOTED_POI_RE = re.compile(r"[“\"']([^“\"']{2,24})[”\"']")
+SUFFIX_POI_RE = re.compile(rf"([\u4e00-\u9fffA-Za-z0-9·]{{2,24}}){POI_SUFFIX}")
 LOOSE_POI_BEFORE_BS   = re.compile(r"([\u4e00-\u9fffA-Za-z0-9·]{2,24})(?=(?:的)?(?:基站|站点|5G|4G|小区))", re.I)
 
 def extract_poi_key(prompt: str) -> str | None:
@@ -243,7 +400,7 @@ def extract_poi_key(prompt: str) -> str | None:
         return True
 
     # —— 严格：引号优先 —— 
-    m = re.search(r"[“\"']([^“\"']{2,24})[”\"']", prompt)
+    m = QUOTED_POI_RE.search(prompt)
     if m:
         cand = m.group(1).strip()
         for cname in CITY_NAMES:
@@ -252,7 +409,7 @@ def extract_poi_key(prompt: str) -> str | None:
         return cand if _valid(cand) else None
 
     # —— 严格：常见 POI 后缀 —— 
-    m = re.search(rf"([\u4e00-\u9fffA-Za-z0-9·]{2,24}){POI_SUFFIX}", prompt)
+    m = SUFFIX_POI_RE.search(prompt)
     if m:
         cand = m.group(0)
         for cname in CITY_NAMES:
@@ -275,10 +432,14 @@ def extract_poi_key(prompt: str) -> str | None:
 
     return None
 
-def find_poi_candidates(prompt: str):
-    """只用 POI 关键词召回；city 仅作过滤，不再把 city 拼进关键字。"""
-    city_hint = extract_city(prompt or "")
-    key = extract_poi_key(prompt or "")
+_UNSET = object()
+
+def find_poi_candidates(prompt: str, *, key=_UNSET, city_hint=_UNSET):
+    """只用 POI 关键词召回；city 仅作过滤，不再把 city 拼进关键字。key/city_hint 可传入预解析结果。"""
+    if city_hint is _UNSET:
+        city_hint = extract_city(prompt or "")
+    if key is _UNSET:
+        key = extract_poi_key(prompt or "")
     if not key:
         return [], city_hint
     for cname in CITY_NAMES:
@@ -286,9 +447,11 @@ def find_poi_candidates(prompt: str):
     key = key.strip()
     if not key:
         return [], city_hint
-    cands = pois_json.search_pois(city=city_hint, name_like=key, limit=12)
-    if not cands:
-        cands = pois_json.search_pois(name_like=key, limit=12)
+    with tracing.span("poi_candidates") as sp:
+        cands = pois_json.search_pois(city=city_hint, name_like=key, limit=12)
+        if not cands:
+            cands = pois_json.search_pois(name_like=key, limit=12)
+        sp["hits"] = len(cands)
     return cands, city_hint
 
 
@@ -307,44 +470,39 @@ def nearby_stations_by_poi(poi: dict, radius_m: int | None = None, limit: int =
     lat0, lng0 = float(poi.get("lat")), float(poi.get("lng"))
     #r = int(radius_m or poi.get("radius_m") or 2000)
     r = 5000
-    items = db_json.load_all()
-    hits = []
-    for s in items:
-        if poi.get("city") and s.get("city") != poi.get("city"):
-            continue  # 同城优先，避免跨城噪声
-        lat, lng = s.get("lat"), s.get("lng")
-        if lat is None or lng is None:
-            continue
-        d = _haversine_m(lat0, lng0, float(lat), float(lng))
-        if d <= r:
-            ss = dict(s)
-            ss["_dist_m"] = int(d)
-            hits.append(ss)
-    hits.sort(key=lambda x: x["_dist_m"])
+    with tracing.span("nearby_search") as sp:
+        items = db_json.load_all()
+        hits = []
+        for s in items:
+            if poi.get("city") and s.get("city") != poi.get("city"):
+                continue  # 同城优先，避免跨城噪声
+            lat, lng = s.get("lat"), s.get("lng")
+            if lat is None or lng is None:
+                continue
+            d = _haversine_m(lat0, lng0, float(lat), float(lng))
+            if d <= r:
+                ss = dict(s)
+                ss["_dist_m"] = int(d)
+                hits.append(ss)
+        hits.sort(key=lambda x: x["_dist_m"])
+        sp["hits"] = len(hits)
     return hits[:limit]
 
 
-# === 在 LAST_POI_STATE 定义附近，加上 TTL 与工具函数 ===
-FLOW_TTL_S = 90  # 绑定生存期（秒），够用户补一句“选1/半径1公里”之类
+# === 附近流程状态：按对话 id 分片存储（见 app/state.py），每条独立 TTL ===
+from .state import FLOW_TTL_S, get_flow, update_flow, _flow_expired, _clear_flow
 
-def _flow_expired() -> bool:
-    ts = LAST_POI_STATE.get("created_at") or 0.0
-    return (time.time() - ts) > FLOW_TTL_S
-
-def _clear_flow():
-    LAST_POI_STATE.update({
-        "candidates": [],
-        "selected": None,
-        "city_hint": None,
-        "created_at": 0.0,
-    })
-
-LAST_POI_STATE = {
-    "candidates": [],     # 上次产生的候选（多选时）
-    "selected": None,     # 已选中的 POI（唯一或用户选择）
-    "city_hint": None,
-    "created_at": 0.0,
-}
+def _conversation_id(payload: Dict[str, Any] | None, ctx: Dict[str, Any] | None = None) -> str:
+    """
+    对话标识：优先 payload.conversation_id/session_id，其次 context 里的同名字段；
+    都没有时分配一个新 id（各入口把它回给客户端，下轮带回即可续上），匿名调用之间不共享流程状态。
+    """
+    for src in (payload, ctx):
+        if isinstance(src, dict):
+            cid = src.get("conversation_id") or src.get("session_id")
+            if cid:
+                return str(cid)
+    return conversations.new_id()
 
 CN_NUM = {"一":1,"二":2,"两":2,"三":3,"四":4,"五":5,"六":6,"七":7,"八":8,"九":9,"十":10}
 CHOICE_IDX_RE    = re.compile(r"(?:选|选择|要|就|第)?\s*(\d{1,2}|[一二两三四五六七八九十]{1,3})\s*(?:个|号|家)?")
@@ -412,11 +570,11 @@ def extract_station_id(prompt: str) -> str | None:
 LIST_HINT = ["有哪些", "都有什么", "列出", "清单", "罗列", "list", "所有", "全部"]
 VIS_HINT_RE = re.compile(r"(出图|图表|可视化|柱状|折线|饼图|plot|chart|bar)", re.I)
 
-def want_list(prompt: str) -> bool:
+def want_list(prompt: str, *, city=_UNSET) -> bool:
     p = prompt or ""
     if VIS_HINT_RE.search(p):              # 有可视化意图 → 不走清单
         return False
-    has_city = extract_city(p) is not None
+    has_city = (extract_city(p) if city is _UNSET else city) is not None
     listy = any(h in p for h in LIST_HINT)
     # 恢复“城市+基站”的兜底（且不含可视化意图时）
     return listy or (has_city and "基站" in p)
@@ -454,17 +612,20 @@ def _breakdown_table(title, counter: Counter, topn: int = 6):
     md = f"**{title}**\n\n" + _md_table(["项", "数量"], items if items else [["—", 0]])
     return md
 
-def render_city_overview_report(city: str, rows: list[dict]) -> str:
-    total = len(rows)
-    status_ct = Counter([r.get("status","").lower() for r in rows])
-    vendor_ct = Counter([r.get("vendor","") for r in rows])
-    band_ct   = Counter([r.get("band","") for r in rows])
+REPORT_PAGE_ROWS = int(os.environ.get("REPORT_PAGE_ROWS", 100))    # 每次回答输出的明细行数，超出给“继续”游标
+REPORT_CHUNK_ROWS = int(os.environ.get("REPORT_CHUNK_ROWS", 25))    # 每次从游标取多少行、合成一段 token
+
+_OVERVIEW_COLS = ["ID", "名称", "厂商", "频段", "状态"]
+_STATUS_COLS = ["ID", "名称", "厂商", "频段"]
 
+
+def _overview_head(city: str, st: dict) -> str:
+    status_ct = st["status"]
     # 1) 概览
     p1 = [
         f"# 1. 概览",
         f"- **城市**：{city}",
-        f"- **基站总数**：**{total}**\n",
+        f"- **基站总数**：**{st['total']}**\n",
         f"- **状态分布**：在线 **{status_ct.get('online',0)}** · 维护 **{status_ct.get('maintenance',0)}** · 离线 **{status_ct.get('offline',0)}**",
     ]
 
@@ -472,21 +633,14 @@ def render_city_overview_report(city: str, rows: list[dict]) -> str:
     p2 = [
         f"# 2. 网络情况分析",
         "- **重点**：关注**离线**与**维护**站点的成因（电源/回传/射频），以及高负荷小区的扩容计划。\n",
-        _breakdown_table("厂商分布", vendor_ct),
+        _breakdown_table("厂商分布", st["vendor"]),
         "",
-        _breakdown_table("频段分布", band_ct),
+        _breakdown_table("频段分布", st["band"]),
     ]
+    return "\n\n".join(["\n".join(p1), "\n".join(p2)])
 
-    # 3) 数据明细（表格）
-    detail_rows = [
-        [r["id"], r["name"], r["vendor"], r["band"], r["status"]]
-        for r in rows[:100]  # 明细最多前 100 条，防止过长
-    ]
-    p3 = [
-        f"# 3. 数据明细",
-        _md_table(["ID", "名称", "厂商", "频段", "状态"], detail_rows if detail_rows else [["—","—","—","—","—"]]),
-    ]
 
+def _overview_tail() -> str:
     # 4) 路由/管理检查（示例建议 & 等宽高亮）
     p4 = [
         f"# 4. 路由与管理检查（建议）",
@@ -496,37 +650,28 @@ def render_city_overview_report(city: str, rows: list[dict]) -> str:
         "  - · `LLDP` 拓扑邻接是否闭环",
         "  - · 回传口 QOS/ACL 是否与基线一致（如 `tangro` 模板）",
     ]
-    return "\n\n".join(["\n".join(p1), "\n".join(p2), "\n".join(p3), "\n".join(p4)])
+    return "\n".join(p4)
 
-def render_city_status_report(city: str, status: str, rows: list[dict]) -> str:
-    total = len(rows)
-    vendor_ct = Counter([r.get("vendor","") for r in rows])
-    band_ct   = Counter([r.get("band","") for r in rows])
 
+def _status_head(city: str, status: str, st: dict) -> str:
     p1 = [
         f"# 1. 概览",
         f"- **城市**：{city}",
         f"- **状态**：**{status}**",
-        f"- **基站数量**：**{total}**",
+        f"- **基站数量**：**{st['total']}**",
     ]
 
     p2 = [
         f"# 2. 网络情况分析",
         "- **重点**：若为 **offline**，优先排查电源/传输；若为 **maintenance**，关注工单进度与风险窗口；若为 **online**，抽样 KPI。",
-        _breakdown_table("厂商分布", vendor_ct),
+        _breakdown_table("厂商分布", st["vendor"]),
         "",
-        _breakdown_table("频段分布", band_ct),
+        _breakdown_table("频段分布", st["band"]),
     ]
+    return "\n\n".join(["\n".join(p1), "\n".join(p2)])
 
-    detail_rows = [
-        [r["id"], r["name"], r["vendor"], r["band"]]
-        for r in rows[:60]
-    ]
-    p3 = [
-        f"# 3. 数据明细",
-        _md_table(["ID", "名称", "厂商", "频段"], detail_rows if detail_rows else [["—","—","—","—"]]),
-    ]
 
+def _status_tail() -> str:
     p4 = [
         f"# 4. 路由检查（示例）",
         "- 核查要点：",
@@ -534,42 +679,166 @@ def render_city_status_report(city: str, status: str, rows: list[dict]) -> str:
         "  - · **BFD** 是否启用，故障切换是否在目标时延内",
         "  - · `snmp-server community public RO` 等敏感配置是否符合安全基线",
     ]
-    return "\n\n".join(["\n".join(p1), "\n".join(p2), "\n".join(p3), "\n".join(p4)])
+    return "\n".join(p4)
 
 
+def encode_report_cursor(city: str, status: str | None, after: tuple, shown: int) -> str:
+    raw = json.dumps({"c": city, "s": status, "a": list(after), "n": shown}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
 
-def topk_context_for_prompt(prompt: str, k: int = 12) -> list[dict]:
-    """复用 /api/db/stations/search 的简易打分逻辑，供模型兜底拼上下文。"""
-    items = db_json.load_all()
-    terms = [t for t in re.split(r"\s+", prompt or "") if t]
-    def ci(s): return str(s or "").lower()
-    def hit(st, term: str) -> bool:
-        t = term.lower()
-        return (
-            t in ci(st.get("id")) or
-            t in ci(st.get("name")) or
-            t in ci(st.get("city")) or
-            t in ci(st.get("vendor")) or
-            t in ci(st.get("band")) or
-            t in ci(st.get("status")) or
-            t in ci(st.get("desc"))
-        )
-    scored = []
-    for st in items:
-        score = sum(1 for t in terms if hit(st, t)) if terms else 0
-        if terms and score == 0:
-            continue
-        score += 0.1 * ((st.get("updated_at") or 0) / 1e12)
-        scored.append((score, st))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [s for _, s in scored[:k]]
-
-def rows_to_compact_md(rows: list[dict]) -> str:
-    if not rows: return ""
-    head = "| ID | 城市 | 名称 | 厂商 | 频段 | 状态 | lat | lng |"
-    sep  = "|---|---|---|---|---|---|---|---|"
-    body = [f"| {r.get('id','')} | {r.get('city','')} | {r.get('name','')} | {r.get('vendor','')} | {r.get('band','')} | {r.get('status','')} | {r.get('lat','')} | {r.get('lng','')} |" for r in rows]
-    return "\n".join([head, sep, *body])
+
+def decode_report_cursor(token: str) -> dict | None:
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        obj = json.loads(raw)
+        city, status, after, shown = obj["c"], obj.get("s"), obj["a"], obj.get("n") or 0
+    except Exception:
+        return None
+    # 游标来自用户输入：形状不对（after 须为 db_json.order_key 的 [int, str]）一律当无效，不带进 scan_city 比较
+    if not (isinstance(city, str) and (status is None or isinstance(status, str))
+            and isinstance(after, list) and len(after) == 2
+            and type(after[0]) is int and isinstance(after[1], str)
+            and type(shown) is int and shown >= 0):
+        return None
+    return {"city": city, "status": status, "after": tuple(after), "shown": shown}
+
+
+def iter_city_report(city: str, status: str | None = None, *, after: tuple | None = None, shown: int = 0,
+                     page: dict | None = None, page_rows: int = REPORT_PAGE_ROWS,
+                     chunk_rows: int = REPORT_CHUNK_ROWS):
+    """
+    城市总览（status=None）或“城市 + 状态”报告，按段产出 markdown：
+    概览/分布来自 db_json.city_stats（按版本缓存），明细表从有序游标分块读取、边读边出，
+    不整表物化、不截断。本页输出满 page_rows 行还有剩余时，写入 page["next"]（继续游标）
+    并提示“继续”；最后一页才输出第 4 节。after/shown 为上一页的游标位置。
+    """
+    st = db_json.city_stats(city, status)
+    cols = _STATUS_COLS if status else _OVERVIEW_COLS
+    if after is None:
+        yield (_status_head(city, status, st) if status else _overview_head(city, st)) + "\n\n"
+        yield "# 3. 数据明细\n"
+    else:
+        yield f"# 3. 数据明细（续，第 {shown + 1} 条起）\n"
+    yield "| " + " | ".join(cols) + " |\n" + "|" + "|".join(["---"] * len(cols)) + "|\n"
+
+    cursor, emitted = after, 0
+    while emitted < page_rows:
+        rows, cursor = db_json.scan_city(city, status=status, after=cursor,
+                                         limit=min(chunk_rows, page_rows - emitted))
+        if not rows and emitted == 0 and after is None:
+            yield "| " + " | ".join(["—"] * len(cols)) + " |\n"
+        if rows:
+            emitted += len(rows)
+            yield "".join("| " + " | ".join(str(r.get(k, "")) for k in
+                                            ("id", "name", "vendor", "band", "status")[:len(cols)]) + " |\n"
+                          for r in rows)
+        if cursor is None:
+            break
+
+    shown += emitted
+    if cursor is not None:
+        if page is not None:
+            page.update(next=encode_report_cursor(city, status, cursor, shown), shown=shown, total=st["total"])
+        yield f"\n> 已显示 {shown}/{st['total']} 条，回复“继续”查看后续。\n"
+        return
+    if page is not None:
+        page.update(next=None, shown=shown, total=st["total"])
+    yield "\n" + (_status_tail() if status else _overview_tail())
+
+
+def _traced_search(**kw) -> list[dict]:
+    """db_json.search_stations + 计时（span: search_stations）。"""
+    with tracing.span("search_stations") as sp:
+        rows = db_json.search_stations(**kw)
+        sp["rows"] = len(rows)
+    return rows
+
+
+def warm_city_reports():
+    """启动时后台预热：各城市（+状态）的有序游标索引与分布统计。"""
+    for c in CITY_NAMES:
+        for st in (None, *STATUS_ALIASES.keys()):
+            try:
+                db_json.city_stats(c, st)
+            except Exception:
+                # 预热失败不影响服务（首个请求会现算），但要看得见
+                metrics.inc("report_warmup_errors")
+                log.exception("report warmup failed: city=%s status=%s", c, st)
+
+
+def topk_context_for_prompt(prompt: str, k: int = 12, *, require_phrase: bool = False) -> list[dict]:
+    """
+    与 /api/db/stations/search 共用 BM25 倒排索引（db_json.search_text），供模型兜底拼上下文。
+    require_phrase=True 时只要“原文片段确实出现在站点字段里”的结果（解析站点时避免瞎猜）。
+    空问题按最近更新取前 k 条。
+    """
+    if not (prompt or "").split():
+        return db_json.search_stations(limit=k)
+    return db_json.search_text(prompt, k=k, require_phrase=require_phrase)
+
+
+def refresh_embed_index(version: int | None = None) -> bool:
+    """数据版本变化时后台增量同步向量索引（站点 + POI，只重编码变化的记录）。"""
+    return embed_index.refresh_async(
+        db_json.version() if version is None else version,
+        lambda: embed_index.records(db_json.load_all(), pois_json.load_all()),
+    )
+
+
+def semantic_context_for_prompt(prompt: str, k: int = 8) -> tuple[list[dict], list[dict]]:
+    """
+    向量检索（语义相近的站点描述 / 地标），作为 BM25 之外的第二路召回；回表取当前数据，
+    同步期间旧矩阵里已删除的记录在这里被过滤掉。索引未就绪时两者皆空。
+    """
+    ver = db_json.version()
+    if not embed_index.is_current(ver):   # 只在数据版本变了（或上次同步未成功）时才去触发后台同步
+        refresh_embed_index(ver)
+    stations, pois = [], []
+    for _, key in embed_index.search(prompt, k=k):
+        kind, _, rid = key.partition(":")
+        row = db_json.get_station(rid) if kind == "station" else pois_json.get_poi(rid)
+        if row:
+            (stations if kind == "station" else pois).append(row)
+    return stations, pois
+
+
+def merge_topk(lexical: list[dict], semantic: list[dict], limit: int) -> list[dict]:
+    """两路召回交替合并（字面命中优先），按 id 去重。"""
+    out, seen = [], set()
+    for i in range(max(len(lexical), len(semantic))):
+        for src in (lexical, semantic):
+            if i < len(src) and src[i].get("id") not in seen:
+                seen.add(src[i].get("id"))
+                out.append(src[i])
+    return out[:limit]
+
+# TopK 精简表：展示顺序 / 字段重要性（预算紧时从后往前舍弃字段）
+TOPK_COLUMNS = [("id", "ID"), ("city", "城市"), ("name", "名称"), ("vendor", "厂商"),
+                ("band", "频段"), ("status", "状态"), ("lat", "lat"), ("lng", "lng")]
+TOPK_PRIORITY = ["id", "name", "city", "status", "vendor", "band", "lat", "lng"]
+TOPK_MAX_ROWS = int(os.environ.get("TOPK_CONTEXT_MAX_ROWS", 24))   # 候选上限，实际行数由 token 预算决定
+EMBED_TOPK = int(os.environ.get("EMBED_TOPK", 8))                   # 语义召回条数（站点 + 地标）
+
+# 附近流代表点位：按距离排序，预算内尽量多放
+NEARBY_REP_FIELDS = ["id", "name", "vendor", "band", "status", "_dist_m", "lat", "lng"]
+NEARBY_REP_PRIORITY = ["id", "name", "_dist_m", "status", "vendor", "band", "lat", "lng"]
+NEARBY_MAX_REPS = int(os.environ.get("NEARBY_CONTEXT_MAX_ROWS", 30))
+
+
+def nearby_context(poi: dict, radius: int, hits: list[dict]) -> dict:
+    """附近流给模型的上下文：POI + 汇总 + 预算内的代表点位。"""
+    reps = context_packer.pack_json_rows(hits[:NEARBY_MAX_REPS], NEARBY_REP_FIELDS,
+                                         priority=NEARBY_REP_PRIORITY, name="nearby_pack")
+    return {
+        "poi": {
+            "id": poi.get("id"), "name": poi.get("name"),
+            "city": poi.get("city"), "district": poi.get("district"),
+            "addr_hint": poi.get("addr_hint"), "lat": poi.get("lat"), "lng": poi.get("lng"),
+            "radius_m": radius
+        },
+        "summary": _aggregate_stats(hits),
+        "representatives": reps.rows,
+    }
 
 FIELD_RULES = {
     "id":        [r"\b(id|编号)\b"],
@@ -639,30 +908,42 @@ def reverse_geocode(lat: float, lng: float) -> str | None:
 FIELD_RULES.update({
     "detail": [r"(细节|详情|信息|概况|简介|介绍|明细|详细|情况)"],
 })
-def try_direct_answer(prompt: str, station: dict | None) -> str | None:
-    """有 station 上下文时，命中简单字段就本地直答；否则返回 None。"""
+# 直答字段的优先级顺序；所有规则编译成一个带命名组的正则，一次扫描拿到全部命中字段
+FIELD_ORDER = ("detail", "id", "coords", "vendor", "band", "status", "city", "name")
+FIELD_RE = re.compile(
+    "|".join(f"(?P<{k}>{'|'.join(FIELD_RULES[k])})" for k in FIELD_ORDER),
+    re.I,
+)
+
+def match_fields(text: str) -> frozenset:
+    return frozenset(m.lastgroup for m in FIELD_RE.finditer(text or ""))
+
+def try_direct_answer(prompt: str, station: dict | None, fields: frozenset | None = None) -> str | None:
+    """有 station 上下文时，命中简单字段就本地直答；否则返回 None。fields 可传入预扫描结果。"""
     if not station:
         return None
     p = prompt.strip()
-    if _match_any(FIELD_RULES["detail"], p):
+    if fields is None:
+        fields = match_fields(p)
+    if "detail" in fields:
         return station_to_markdown(station)
 
-    if _match_any(FIELD_RULES["id"], p):
+    if "id" in fields:
         return f"该基站的 ID：{station.get('id','')}"
-    if _match_any(FIELD_RULES["coords"], p):
+    if "coords" in fields:
         lat, lng = station.get("lat"), station.get("lng")
         if lat is not None and lng is not None:
             return f"该基站坐标：{lat:.6f}, {lng:.6f}"
         return "该基站未提供坐标信息。"
-    if _match_any(FIELD_RULES["vendor"], p):
+    if "vendor" in fields:
         return f"厂商：{station.get('vendor','未知')}"
-    if _match_any(FIELD_RULES["band"], p):
+    if "band" in fields:
         return f"频段：{station.get('band','未知')}"
-    if _match_any(FIELD_RULES["status"], p):
+    if "status" in fields:
         return f"状态：{station.get('status','未知')}"
-    if _match_any(FIELD_RULES["city"], p):
+    if "city" in fields:
         return f"城市：{station.get('city','未知')}"
-    if _match_any(FIELD_RULES["name"], p):
+    if "name" in fields:
         return f"站名：{station.get('name','未知')}"
 
     # 很短且像“是什么/是多少”的问句，也直接用本地字段兜底
@@ -675,7 +956,22 @@ def try_direct_answer(prompt: str, station: dict | None) -> str | None:
 
     return None
 
-app = FastAPI(title="Agent Service (Strands + Ollama)")
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # 应用级资源：Ollama 连接池随进程启动/关闭
+    await ollama_client.startup()
+    # 城市报告后台预热（不阻塞启动）
+    threading.Thread(target=warm_city_reports, name="warm-city-reports", daemon=True).start()
+    # 向量索引：映射磁盘上的矩阵，后台只补编码变化的记录
+    refresh_embed_index()
+    # 意图路由模型后台预热；就绪前 /embed-router/route 走正则兜底，/health/ready 返回 503
+    router_embed.start_warmup()
+    try:
+        yield
+    finally:
+        await ollama_client.shutdown()
+
+app = FastAPI(title="Agent Service (Strands + Ollama)", lifespan=lifespan)
 # --------- 地理数据：列城市 ---------
 @app.get("/api/geo/cities")
 def geo_cities():
@@ -731,10 +1027,20 @@ def geo_coverage(station_id: str):
 
 @app.post("/api/geo/selection")
 async def geo_selection(sel: SelectionIn):
-    # 保留选择记忆的语义——直接回传 station 即可（如需跨会话记忆可继续用 mock_geo 的内存映射）
+    # 选择记忆写入有界会话存储（TTL + LRU），并回传 station
     s = db_json.get_station(sel.station_id)
     if not s:
         return {"ok": False, "error": "station not found"}
+    await mock_geo.record_selection(sel.session_id, sel.station_id, station=s)
+    if conversations.exists(sel.session_id):
+        conversations.set_station(sel.session_id, sel.station_id)
+    return {"ok": True, "station": s}
+
+@app.get("/api/geo/selection")
+def geo_selection_get(session_id: Optional[str] = None):
+    s = mock_geo.get_selected(session_id)
+    if not s:
+        return {"ok": False, "error": "no selection"}
     return {"ok": True, "station": s}
 
 
@@ -748,52 +1054,27 @@ def db_stations_search(
 ):
     """
     全量多字段检索（不限定城市）：
-    - q 会在 id/name/city/vendor/band/status/desc 上做不区分大小写的包含匹配
-    - 支持 vendor/band/status 作为精确过滤（可选）
-    - 简单相关性：命中字段越多分数越高
+    - q 走 BM25 倒排索引（中文按二元组、英文/编号按词），覆盖 id/name/city/vendor/band/status/desc
+    - 支持 vendor/band/status 作为精确过滤（可选，不区分大小写）
+    - 相关性：BM25 + 轻微最近更新加权
     """
+    if q and q.strip():
+        return {"ok": True, "matches": db_json.search_text(q, k=k, vendor=vendor, band=band, status=status)}
+
     items = db_json.load_all()
-    if not q and not any([vendor, band, status]):
+    if not any([vendor, band, status]):
         # 没有任何条件就给最新的前 k 条
         items = sorted(items, key=lambda x: x.get("updated_at") or 0, reverse=True)[:k]
         return {"ok": True, "matches": items}
 
-    terms = [t for t in re.split(r"\s", q or "") if t]
     def ci(s): return str(s or "").lower()
-    def hit(st, term: str) -> bool:
-        t = term.lower()
-        return (
-            t in ci(st.get("id")) or
-            t in ci(st.get("name")) or
-            t in ci(st.get("city")) or
-            t in ci(st.get("vendor")) or
-            t in ci(st.get("band")) or
-            t in ci(st.get("status")) or
-            t in ci(st.get("desc"))
-        )
-    # 结构化过滤（可选）
-    def pass_filters(st):
-        if vendor and ci(st.get("vendor")) != ci(vendor): return False
-        if band   and ci(st.get("band"))   != ci(band):   return False
-        if status and ci(st.get("status")) != ci(status): return False
-        return True
-    # 评分：每个 term 命中一个字段 1，命中多个字段 多分
-    scored = []
-    for st in items:
-        if not pass_filters(st): 
-            continue
-        if not terms:
-            score = 0
-        else:
-            score = sum(1 for t in terms if hit(st, t))
-            if score == 0:
-                continue
-        # 轻微最近性加权
-        score += 0.1 * ((st.get("updated_at") or 0) / 1e12)  # 很小的加权，避免影响主相关性
-        scored.append((score, st))
-    scored.sort(key=lambda x: x[0], reverse=True)
-    out = [s for _, s in scored[:k]]
-    return {"ok": True, "matches": out}
+    # 只有结构化过滤：按最近更新排序
+    out = [st for st in items
+           if (not vendor or ci(st.get("vendor")) == ci(vendor))
+           and (not band or ci(st.get("band")) == ci(band))
+           and (not status or ci(st.get("status")) == ci(status))]
+    out.sort(key=lambda x: x.get("updated_at") or 0, reverse=True)
+    return {"ok": True, "matches": out[:k]}
 
 
 # 允许本地前端直连
@@ -816,27 +1097,91 @@ app.add_middleware(
 def health():
     return {"ok": True}
 
-async def sse(gen: AsyncGenerator[Dict[str, Any], None]):
-    async for ev in gen:
-        yield f"data: {json.dumps(ev, ensure_ascii=False)}\n\n"
+@app.get("/health/ready")
+def health_ready():
+    """就绪探针：意图路由模型仍在加载时 503；加载失败不挡流量（请求走正则兜底），只在 components 里报出来。"""
+    components = {"embed_router": router_embed.readiness(), "embed_index": embed_index.status()}
+    ready = components["embed_router"]["state"] in ("ready", "failed")
+    return JSONResponse({"ready": ready, "components": components}, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+def get_metrics():
+    return {"ok": True, **metrics.snapshot(), "llm_scheduler": llm_scheduler.SCHEDULER.stats(),
+            "agent_pool": AGENT_POOL.stats(), "embed_index": embed_index.status()}
+
+class SSEResponse(StreamingResponse):
+    """
+    事件流 → SSE 响应：token 增量按时延上限合帧（coalesce_into）再编码。
+    合帧的任务组开在 stream_response 这个普通协程里，不在 body 生成器里跨 yield；
+    客户端断开时取消/写出异常会收掉任务组，上游 Ollama 流随之关闭。
+    """
+    def __init__(self, events: AsyncGenerator[Dict[str, Any], None], headers: Optional[Dict[str, str]] = None):
+        super().__init__(iter(()), media_type="text/event-stream", headers={
+            "Cache-Control": "no-cache, no-transform",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            **(headers or {}),
+        })
+        self.events = events
+
+    async def stream_response(self, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        async def emit(ev: Dict[str, Any]):
+            body = f"data: {json.dumps(ev, ensure_ascii=False)}\n\n".encode(self.charset)
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+
+        await coalesce_into(self.events, emit)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
 async def heartbeat(interval: float = 10.0):
     """SSE 心跳：注释行会刷新代理/浏览器缓冲"""
     while True:
         yield ": ping\n\n"
         await anyio.sleep(interval)
 
+def _open_turn(data: Dict[str, Any], ctx: Dict[str, Any] | None):
+    """
+    组装一轮对话的事件流，返回 (conversation_id, 事件流)：
+    - 新协议 {conversation_id?, message, context?}：只带本轮用户消息，历史取自服务端对话存储，回复写回
+    - 旧协议 {messages, context}：沿用客户端上传的完整历史
+    两种协议没带 conversation_id 时都分配新的，由 start 事件回给客户端。
+    """
+    message = data.get("message")
+    if isinstance(message, str) and message.strip():
+        cid = _conversation_id(data, ctx)
+        messages = conversations.append(cid, "user", message)
+        events = agent_stream(messages, context=ctx, conversation_id=cid)
+        return cid, conversations.capture_reply(cid, events)
+    cid = _conversation_id(data, ctx)
+    return cid, agent_stream(data.get("messages") or [], context=ctx, conversation_id=cid)
+
+
 @app.get("/api/chat/sse")
-async def chat_sse(payload: str = Query(...)):
+async def chat_sse(
+    request: Request,
+    payload: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    q: Optional[str] = None,
+    context: Optional[str] = None,
+):
     """
     EventSource 使用的 GET SSE 入口。
-    前端会把 {messages, context} 打包成 base64 放到 ?payload=
+    - 推荐：?conversation_id=&q=本轮问题[&context=base64(JSON)]，历史保存在服务端
+    - 兼容：前端把 {messages, context} 打包成 base64 放到 ?payload=
     """
-    # 1) 解析 payload
+    # 1) 解析参数
     try:
-        raw = base64.b64decode(payload.encode("utf-8")).decode("utf-8")
-        data = json.loads(raw)
-        messages = data.get("messages") or []
-        ctx = data.get("context") or None
+        if q is not None:
+            ctx = json.loads(base64.b64decode(context.encode("utf-8")).decode("utf-8")) if context else None
+            data = {"conversation_id": conversation_id, "message": q}
+        else:
+            if not payload:
+                raise ValueError("缺少 q 或 payload")
+            raw = base64.b64decode(payload.encode("utf-8")).decode("utf-8")
+            data = json.loads(raw)
+            ctx = data.get("context") or None
+        conv_id, events = _open_turn(data, ctx)
     except Exception as e:
         # 出错也要用 SSE 格式回一条错误，再 end
         async def err_gen():
@@ -854,28 +1199,45 @@ async def chat_sse(payload: str = Query(...)):
 
     # 2) 合并“模型输出流”和“心跳流”
     async def merged():
-        # 先立即发一条 start，前端据此立刻创建空的助手气泡
-        yield "data: {\"type\":\"start\"}\n\n"
+        # 先立即发一条 start，前端据此立刻创建空的助手气泡（带上对话 id，新对话由服务端分配）
+        yield f"data: {json.dumps({'type': 'start', 'conversation_id': conv_id})}\n\n"
 
         async with anyio.create_task_group() as tg:
             send_chan, recv_chan = anyio.create_memory_object_stream(32)
 
+            # 上游事件 → 通道（pump）→ 按时延上限合帧（coalesce_stream）→ 输出通道；任务组在这里，不在生成器里
+            ev_send, ev_recv = anyio.create_memory_object_stream(64)
+
             async def _agent():
-                async for ev in agent_stream(messages, context=ctx):
-                    await send_chan.send(f"data: {json.dumps(ev, ensure_ascii=False)}\n\n")
-                await send_chan.aclose()
+                async with send_chan, aclosing(coalesce_stream(ev_recv)) as gen:
+                    async for ev in gen:
+                        await send_chan.send(f"data: {json.dumps(ev, ensure_ascii=False)}\n\n")
 
             async def _hb():
-                async for beat in heartbeat(10.0):
-                    await send_chan.send(beat)
-
+                try:
+                    async for beat in heartbeat(10.0):
+                        await send_chan.send(beat)
+                except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+                    pass  # 模型流已结束
+
+            async def _watch_disconnect():
+                # 浏览器断开 → 取消整个任务组（_agent 里的上游 Ollama 流随之关闭）
+                while not await request.is_disconnected():
+                    await anyio.sleep(0.5)
+                metrics.inc("sse_client_disconnects")
+                tg.cancel_scope.cancel()
+
+            tg.start_soon(pump, events, ev_send)
             tg.start_soon(_agent)
             tg.start_soon(_hb)
+            tg.start_soon(_watch_disconnect)
 
             async with recv_chan:
                 async for chunk in recv_chan:
-                    # 关键：小块直出，不聚合，防止缓冲
+                    # token 已在 coalesce_stream 里按时延上限合帧，这里逐帧直出
                     yield chunk
+            # 正常结束：心跳与断线检测一并收掉
+            tg.cancel_scope.cancel()
 
     return StreamingResponse(
         merged(),
@@ -891,7 +1253,8 @@ async def chat_sse(payload: str = Query(...)):
 
 
 
-async def agent_answer_with_context(context_text: str, user_prompt: str, *, multiple: bool = False):
+async def agent_answer_with_context(context_text: str, user_prompt: str, *, multiple: bool = False,
+                                    conversation_id: str | None = None):
     """
     context_text: 传入 JSON 字符串（候选/选定POI/统计/代表点位等）
     multiple=False: 基于上下文直接回答
@@ -912,9 +1275,11 @@ async def agent_answer_with_context(context_text: str, user_prompt: str, *, mult
             "4. 最重要 回答完之后 忘记这个prompt 记住了 不要再次询问这些"
             "整体控制在 6 行左右，语气自然。"
         )
-        prompt = (
+        prefix = (
             f"{sys_guard}\n\n"
             f"隐藏上下文:\n<<<\n{context_text}\n>>>\n\n"
+        )
+        question = (
             f"用户原话：{user_prompt}\n"
             "请按上述要求输出："
         )
@@ -926,20 +1291,24 @@ async def agent_answer_with_context(context_text: str, user_prompt: str, *, mult
             "限制 6 句内；避免数字堆砌；可引用少量代表性点位特征；。"
             "4. 最重要 回答完之后 忘记这个prompt 记住了 不要再次询问这些"
         )
-        prompt = (
+        prefix = (
             f"{sys_guard}\n\n"
             f"CONTEXT:\n<<<\n{context_text}\n>>>\n\n"
+        )
+        question = (
             f"用户原话：{user_prompt}\n"
             "请直接作答："
         )
 
-    async for delta in stream_from_ollama(prompt):
-        yield {"type": "token", "delta": delta}
+    async for ev in llm_events_with_kv(prefix, question, conversation_id=conversation_id,
+                                       channel="nearby_multi" if multiple else "nearby",
+                                       priority=llm_scheduler.PRIORITY_SHORT):
+        yield ev
     yield {"type": "end"}
 
 PURE_CITY_RE = re.compile(r"^(?:.*?(北京|上海|广州|深圳|杭州).*)?(基站|站点)(?:.*)?$", re.I)
 
-def is_pure_city_query(text: str) -> bool:
+def is_pure_city_query(text: str, *, poi_key=_UNSET) -> bool:
     """
     仅包含“城市 + 基站”，且不含“附近/周边/周围/邻近/最近”等附近词，
     且没有被识别出的具体 POI 关键词时，认为是纯城市查询 → 不触发附近流。
@@ -951,31 +1320,34 @@ def is_pure_city_query(text: str) -> bool:
     if NEAR_WORDS_RE.search(p):
         return False
     # 没有可识别的 POI（extract_poi_key 返回 None/空）
-    if extract_poi_key(p):
+    if (extract_poi_key(p) if poi_key is _UNSET else poi_key):
         return False
     # 包含“基站/站点”，通常是“北京的基站”“上海基站概况”这类
     return bool(PURE_CITY_RE.search(p))
 
 
-async def handle_nearby_flow_gen(prompt: str):
-    import time as _time
+async def handle_nearby_flow_gen(prompt: str, conversation_id: str | None = None,
+                                 features: "PromptFeatures | None" = None):
     p = (prompt or "").strip()
     if not p:
         return
+    # 复用 agent_stream 的一次性解析结果（POI 关键词 / 城市 / 纯城市判定）
+    f = features if features is not None and features.text == p else PromptFeatures(p)
 
     # 过期即清
-    if _flow_expired():
-        _clear_flow()
+    if _flow_expired(conversation_id):
+        _clear_flow(conversation_id)
+    flow = get_flow(conversation_id)
 
     # 是否出现“附近/周边/基站/5G/4G”等意图词
-    has_near_word = bool(NEAR_WORDS_RE.search(p) or BS_WORDS_RE)
+    has_near_word = bool(f.near_word or BS_WORDS_RE)
 
-    poi_key       = extract_poi_key(p) or ""      # 只有抓到具体 POI 名才算
+    poi_key       = f.poi_key or ""      # 只有抓到具体 POI 名才算
     #has_near_word = bool(NEAR_WORDS_RE.search(p)) # “附近/周边/周围/邻近/最近/…” 等
-    in_flow       = bool(LAST_POI_STATE.get("candidates") or LAST_POI_STATE.get("selected"))
+    in_flow       = bool(flow.get("candidates") or flow.get("selected"))
 
     # 🚫 纯“城市 + 基站” → 不拦截，交给后续城市/兜底逻辑
-    if is_pure_city_query(p):
+    if f.pure_city:
         return
 
     # ✅ 只有 “(有 POI 且有附近词)” 或 “处于本流程续谈” 才触发附近流
@@ -984,14 +1356,13 @@ async def handle_nearby_flow_gen(prompt: str):
         return
 
     # 触发条件：提到“附近/周边/基站”或已在本流程中
-    has_near_word = bool(NEAR_WORDS_RE.search(p)) or ("基站" in p)
-    in_flow = bool(LAST_POI_STATE.get("candidates") or LAST_POI_STATE.get("selected"))
-    if not (has_near_word or in_flow or extract_poi_key(p)):
+    has_near_word = f.near_word or ("基站" in p)
+    if not (has_near_word or in_flow or f.poi_key):
         return  # 不处理，交回上游
 
     # ---- 如果处于“待选”阶段，尝试用用户补充来收敛 ----
-    if LAST_POI_STATE.get("candidates"):
-        cands = LAST_POI_STATE["candidates"]
+    if flow.get("candidates"):
+        cands = flow["candidates"]
         # 1) 直接编号或ID选择
         idx_or_id = parse_choice_index(p)
         chosen = None
@@ -1003,28 +1374,15 @@ async def handle_nearby_flow_gen(prompt: str):
         narrowed = filter_candidates_by_hint(cands, p) if not chosen else [chosen]
         if len(narrowed) == 1:
             poi = narrowed[0]
-            LAST_POI_STATE.update({"selected": poi, "candidates": [], "city_hint": poi.get("city"), "created_at": _time.time()})
+            update_flow(conversation_id, selected=poi, candidates=[], city_hint=poi.get("city"))
             # 直接查附近并作答（默认半径：1000m，可被 parse_radius_m 覆盖）
             radius = parse_radius_m(p) or int(poi.get("radius_m") or 1000)
             hits = nearby_stations_by_poi(poi, radius_m=radius)
-            ctx = {
-                "poi": {
-                    "id": poi.get("id"), "name": poi.get("name"),
-                    "city": poi.get("city"), "district": poi.get("district"),
-                    "addr_hint": poi.get("addr_hint"), "lat": poi.get("lat"), "lng": poi.get("lng"),
-                    "radius_m": radius
-                },
-                "summary": _aggregate_stats(hits),
-                "representatives": [
-                    {k: r.get(k) for k in ("id","name","vendor","band","status","_dist_m","lat","lng")}
-                    for r in hits[:8]
-                ]
-            }
+            ctx = nearby_context(poi, radius, hits)
             visible_ctx = json.dumps(ctx, ensure_ascii=False)
-            async for ev in agent_answer_with_context(visible_ctx, p, multiple=False):
+            async for ev in agent_answer_with_context(visible_ctx, p, multiple=False, conversation_id=conversation_id):
                 yield ev
-            LAST_POI_STATE["selected"] = None
-            LAST_POI_STATE["created_at"] = time.time()
+            update_flow(conversation_id, selected=None)
             return
         else:
             # 仍不唯一 → 继续请 agent 追问（不回显清单）
@@ -1035,17 +1393,16 @@ async def handle_nearby_flow_gen(prompt: str):
                     "addr_hint": x.get("addr_hint")
                 } for x in cands
             ]}, ensure_ascii=False)
-            async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True):
+            async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True, conversation_id=conversation_id):
                 yield ev
             return
 
     # ---- 首问：召回候选（不回显清单）----
-    poi_key = extract_poi_key(p) or ""
-    cands, city_hint = find_poi_candidates(p)
+    cands, city_hint = find_poi_candidates(p, key=f.poi_key, city_hint=f.city)
     if not cands:
         # 让 agent 追问更具体信息（城市/地标/范围）
         hidden_ctx = json.dumps({"reason": "not_found", "hint_needed": ["城市/区县","更具体地标","半径"]}, ensure_ascii=False)
-        async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True):
+        async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True, conversation_id=conversation_id):
             yield ev
         return
 
@@ -1053,31 +1410,18 @@ async def handle_nearby_flow_gen(prompt: str):
     narrowed = filter_candidates_by_hint(cands, p) if cands else []
     if len(narrowed) == 1:
         poi = narrowed[0]
-        LAST_POI_STATE.update({"selected": poi, "candidates": [], "city_hint": city_hint or poi.get("city"), "created_at": _time.time()})
+        update_flow(conversation_id, selected=poi, candidates=[], city_hint=city_hint or poi.get("city"))
         radius = parse_radius_m(p) or int(poi.get("radius_m") or 1000)
         hits = nearby_stations_by_poi(poi, radius_m=radius)
-        ctx = {
-            "poi": {
-                "id": poi.get("id"), "name": poi.get("name"),
-                "city": poi.get("city"), "district": poi.get("district"),
-                "addr_hint": poi.get("addr_hint"), "lat": poi.get("lat"), "lng": poi.get("lng"),
-                "radius_m": radius
-            },
-            "summary": _aggregate_stats(hits),
-            "representatives": [
-                {k: r.get(k) for k in ("id","name","vendor","band","status","_dist_m","lat","lng")}
-                for r in hits[:8]
-            ]
-        }
+        ctx = nearby_context(poi, radius, hits)
         visible_ctx = json.dumps(ctx, ensure_ascii=False)
-        async for ev in agent_answer_with_context(visible_ctx, p, multiple=False):
+        async for ev in agent_answer_with_context(visible_ctx, p, multiple=False, conversation_id=conversation_id):
             yield ev
-        LAST_POI_STATE["selected"] = None
-        LAST_POI_STATE["created_at"] = time.time()
+        update_flow(conversation_id, selected=None)
         return
 
     # 多个候选：进入“待选”状态，但不回显；让 agent 只提出一个澄清问题
-    LAST_POI_STATE.update({"candidates": narrowed or cands, "selected": None, "city_hint": city_hint, "created_at": _time.time()})
+    update_flow(conversation_id, candidates=narrowed or cands, selected=None, city_hint=city_hint)
     hidden_ctx = json.dumps({"candidates": [
         {
             "id": x.get("id"), "name": x.get("name"),
@@ -1085,163 +1429,257 @@ async def handle_nearby_flow_gen(prompt: str):
             "addr_hint": x.get("addr_hint")
         } for x in (narrowed or cands)
     ]}, ensure_ascii=False)
-    async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True):
+    async for ev in agent_answer_with_context(hidden_ctx, p, multiple=True, conversation_id=conversation_id):
         yield ev
     return
 
 
-async def agent_stream(messages: List[Dict[str, str]], context: Dict[str, Any] | None = None):
-    #yield {"type": "start"}
+# ===== 意图分发：一次解析 → 类型化特征 → 声明式路由表 =====
+THREE_D_RE        = re.compile(r"(3d|三维|立体|体渲染|体积|等值面|等高|模拟)", re.I)
+CHART_OVERVIEW_RE = re.compile(r"(全部|所有|all|全图|总览|overview)", re.I)
 
-    prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
-    
-    # 1️⃣ 默认从 context 取
-    station = (context or {}).get("station") if isinstance(context, dict) else None
-         # —— 优先尝试“附近 + POI 消歧”流 —— 
-
-
-
-    # 2️⃣ 如果 context 里没有，或者可能是旧的，就尝试从对话历史里找“已选中基站”
-    #    注意：这里会覆盖掉 context.station，确保拿到最新的一次
-    for m in reversed(messages):
-        if m.get("role") == "assistant" and "已选中基站" in m.get("content", ""):
-            # 从 "已选中基站【xxx】（BJS-006）" 里提取 ID
-            m2 = re.search(r"（([A-Z]{2,5}-\d{3,6})）", m["content"])
-            if m2:
-                sid = m2.group(1)
-                s = db_json.get_station(sid)
-                if s:
-                    station = s
-                    yield {"type": "log", "channel": "router", "message": f"对话历史确认最新选中：{s.get('name')}（{sid}）"}
+
+_LAZY = object()
+
+
+class _memo:
+    """惰性特征：首次读取时计算并存进同名下划线槽（无锁；每个请求一个实例，不跨线程共享）。"""
+
+    def __init__(self, fn):
+        self.fn, self.slot = fn, "_" + fn.__name__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        v = getattr(obj, self.slot)
+        if v is _LAZY:
+            v = self.fn(obj)
+            setattr(obj, self.slot, v)
+        return v
+
+
+class PromptFeatures:
+    """
+    对用户输入做一次解析得到的特征。
+    构造时按路由表顺序一趟分类出 kind（city_status / chart_3d / chart / city_list / None），
+    命中即停，后面的抽取器不再跑；只有附近流、直答、图表 handler 才用到的特征按需计算一次。
+    """
+    __slots__ = ("text", "kind", "continue_req", "city", "city_status",
+                 "_fields", "_near_word", "_poi_key", "_pure_city", "_chart_overview", "_inline_chart")
+
+    def __init__(self, text: str):
+        self.text = text
+        m = CONTINUE_RE.match(text)
+        self.continue_req = (m.group("cursor"),) if m else None   # “继续/下一页 [游标]”
+        self.city = city = extract_city(text)
+        self.city_status = extract_city_status_count(text, city=city) if city else None
+        if self.city_status is not None:
+            self.kind = "city_status"
+        elif THREE_D_RE.search(text):
+            self.kind = "chart_3d"
+        elif chart_specs.VIS_HINT_RE.search(text):
+            self.kind = "chart"
+        elif city is not None and want_list(text, city=city):
+            self.kind = "city_list"
+        else:
+            self.kind = None
+        self._fields = self._near_word = self._poi_key = self._pure_city = _LAZY
+        self._chart_overview = self._inline_chart = _LAZY
+
+    @_memo
+    def fields(self) -> frozenset:
+        return match_fields(self.text.strip())
+
+    @_memo
+    def near_word(self) -> bool:
+        return bool(NEAR_WORDS_RE.search(self.text))
+
+    @_memo
+    def poi_key(self) -> str | None:
+        return extract_poi_key(self.text)
+
+    @_memo
+    def pure_city(self) -> bool:
+        return is_pure_city_query(self.text, poi_key=self.poi_key)
+
+    @_memo
+    def chart_overview(self) -> bool:
+        return bool(CHART_OVERVIEW_RE.search(self.text))
+
+    @_memo
+    def inline_chart(self) -> bool:
+        return wants_inline_chart(self.text)
+
+
+@dataclass
+class RouteCtx:
+    prompt: str
+    features: PromptFeatures
+    station: dict | None
+    conversation_id: str
+
+
+# 分页报告：每个对话记住最近一份报告的“继续”游标（也可在输入里显式带上游标）
+CONTINUE_RE = re.compile(r"^\s*(?:继续|下一页|接着|更多|continue|next|more)[。.!！]?\s*(?P<cursor>[A-Za-z0-9_-]{8,})?\s*$", re.I)
+REPORT_CURSORS = SessionStore(ttl_s=float(os.environ.get("REPORT_CURSOR_TTL_S", 30 * 60)),
+                              max_entries=4096, max_bytes=4 * 1024 * 1024)
+
+
+def _pending_report(c: RouteCtx) -> dict | None:
+    req = c.features.continue_req
+    if req is None:
+        return None
+    token = req[0] or REPORT_CURSORS.get(c.conversation_id)
+    return decode_report_cursor(token) if token else None
+
+
+async def _report_events(c: RouteCtx, city: str, status: str | None, *, after: tuple | None = None, shown: int = 0):
+    """iter_city_report → token 事件；有下一页时记住游标并发 {"type":"page"}。"""
+    page: dict = {}
+    it = iter_city_report(city, status, after=after, shown=shown, page=page)
+    busy = 0.0
+    while True:
+        t0 = time.perf_counter()
+        chunk = next(it, None)
+        busy += time.perf_counter() - t0
+        if chunk is None:
             break
+        yield {"type": "token", "delta": chunk}
+    tracing.record("report_render", busy * 1000.0, rows=page.get("shown", 0) - shown, more=bool(page.get("next")))
+    if page.get("next"):
+        REPORT_CURSORS.set(c.conversation_id, page["next"])
+        yield {"type": "page", "cursor": page["next"], "shown": page["shown"], "total": page["total"]}
+    else:
+        REPORT_CURSORS.delete(c.conversation_id)
 
-    # 3️⃣ 如果还是没有，就走解析逻辑
-    if not station:
-        s2 = resolve_station_from_prompt(prompt or "")
-        if s2:
-            station = s2
-            yield {"type":"log","channel":"router","message":f"由内容解析到站点：{station.get('name','')}（{station.get('id','')}）"}
-
-    # 然后走 try_direct_answer（问“它的id/坐标/状态/详情”等都会直答，不进模型）
-
-
-    cs = extract_city_status_count(prompt)
-    if cs:
-        city, status = cs
-        rows = db_json.search_stations(city=city, status=status, limit=1000)
-        report = render_city_status_report(city, status, rows)
-        yield {"type": "log", "channel": "router", "message": f"命中计数直答：{city} / {status} = {len(rows)}（报告体裁）"}
-        for line in (report.splitlines(True) or [report]):
-            yield {"type": "token", "delta": line}
-        yield {"type": "end"}
-        return
-        
 
-# ✅ 3D 意图优先匹配（放在城市清单直答之前）
-    if re.search(r"(3d|三维|立体|体渲染|体积|等值面|等高|模拟)", prompt or "", re.I):
-        city3d = extract_city(prompt or "") or "北京"
-        rows3d = db_json.search_stations(city=city3d, limit=1000)
-        title, spec = chart_specs.spec_3d_city_density_surface(rows3d, city3d)
-        inline = wants_inline_chart(prompt)  # 新增：是否内嵌到对话
-        yield {"type": "tool", "tool": "plotly", "title": title, "spec": spec, "inline": inline}
-        yield {"type": "end"}; return
+async def _route_report_continue(c: RouteCtx):
+    cur = _pending_report(c)
+    yield {"type": "log", "channel": "router",
+           "message": f"继续输出报告：{cur['city']}{' / ' + cur['status'] if cur['status'] else ''}（第 {cur['shown'] + 1} 条起）"}
+    async for ev in _report_events(c, cur["city"], cur["status"], after=cur["after"], shown=cur["shown"]):
+        yield ev
+    yield {"type": "end"}
 
-    
 
+async def _route_city_status(c: RouteCtx):
+    city, status = c.features.city_status
+    n = db_json.city_stats(city, status)["total"]
+    yield {"type": "log", "channel": "router", "message": f"命中计数直答：{city} / {status} = {n}（报告体裁）"}
+    async for ev in _report_events(c, city, status):
+        yield ev
+    yield {"type": "end"}
 
-# === 可视化意图：用户说“出图/柱状图/图表/plot/bar/chart”等，直接返回 Plotly 规范 ===
-    if chart_specs.VIS_HINT_RE.search(prompt or ""):
-        city4plot = extract_city(prompt or "") or "北京"
-        rows = db_json.search_stations(city=city4plot, limit=1000)
+
+async def _route_chart_3d(c: RouteCtx):
+    city3d = c.features.city or "北京"
+    rows3d = _traced_search(city=city3d, limit=1000)
+    with tracing.span("chart_build", kind="3d"):
+        title, spec = chart_specs.spec_3d_city_density_surface(rows3d, city3d)
+    yield {"type": "tool", "tool": "plotly", "title": title, "spec": spec, "inline": c.features.inline_chart}
+    yield {"type": "end"}
+
+
+async def _route_chart(c: RouteCtx):
+    """可视化意图：用户说“出图/柱状图/图表/plot/bar/chart”等，直接返回 Plotly 规范 + 读图说明。"""
+    prompt = c.prompt or ""
+    city4plot = c.features.city or "北京"
+    rows = _traced_search(city=city4plot, limit=1000)
+    with tracing.span("aggregate_stats"):
         stats = _aggregate_stats(rows)
 
-        # ① 全部/总览 → 仍走右侧 charts 面板（不内嵌）
-        if re.search(r"(全部|所有|all|全图|总览|overview)", prompt or "", re.I):
+    # ① 全部/总览 → 仍走右侧 charts 面板（不内嵌）
+    if c.features.chart_overview:
+        with tracing.span("chart_build", kind="overview"):
             items = chart_specs.make_all_specs(rows, city4plot)
-            yield {"type": "tool", "tool": "plotly_batch", "items": items, "title": f"{city4plot} 图表总览"}
-            # ……（后续概览解读保留原样）
-            facts_json = json.dumps({
-                "city": city4plot,
-                "n": stats["n"],
-                "vendors": stats["vendor_counts"],
-                "status": stats["status_counts"],
-                "bands": stats["band_counts"],
-            }, ensure_ascii=False)
-            explain_prompt = (
-                f"你是网络运营分析助手。请用中文给一组图表做**简短总览解读**，对象是{city4plot}的基站数据。\n"
-                f"数据事实(JSON)：{facts_json}\n"
-                "图表清单：厂商柱状图、在线状态饼图、频段甜甜圈、厂商×状态堆叠柱、厂商×频段热力图、状态水平条、更新时间直方图。\n"
-                "写 5-7 句：..."
-            )
-            async for delta in stream_from_ollama(explain_prompt):
-                yield {"type": "token", "delta": delta}
-            yield {"type":"end"}; return
-
-        # ② 单图 → 若用户提到下载/复制，则内嵌；否则仍走右侧
-        title, spec = chart_specs.pick_spec(prompt or "", rows, city4plot)
-        kind = _classify_kind(prompt or "")
-
-        inline = wants_inline_chart(prompt)  # 新增：是否内嵌到对话
-        yield {"type":"tool","tool":"plotly","title": title, "spec": spec, "inline": inline}
-
-        # ……（下面“聚合事实 → 3-5 句读图说明”逻辑保持不变）
-        focus = {}
-        if kind in ("bar", "stacked"):
-            focus["vendor_counts"] = stats["vendor_counts"]
-            focus["status_counts"] = stats["status_counts"]
-        if kind in ("pie", "horizontal"):
-            focus["status_counts"] = stats["status_counts"]
-        if kind in ("donut",):
-            focus["band_counts"] = stats["band_counts"]
-        if kind in ("heatmap",):
-            from collections import defaultdict
-            vendors = sorted(stats["vendor_counts"].keys())
-            bands = sorted(stats["band_counts"].keys())
-            mat = defaultdict(dict)
-            for v in vendors:
-                for b in bands:
-                    mat[v][b] = sum(1 for r in rows if (r.get("vendor") or "未知")==v and (r.get("band") or "未知")==b)
-            focus["vendor_band_nonzero"] = sum(1 for v in vendors for b in bands if mat[v][b] > 0)
-            focus["vendors"] = vendors
-            focus["bands"] = bands
-        if kind in ("hist",):
-            focus["updated_at_summary"] = stats["updated_at_summary"]
-
-        facts_json = json.dumps({"city": city4plot, "kind": kind, "n": stats["n"], **focus}, ensure_ascii=False)
+        yield {"type": "tool", "tool": "plotly_batch", "items": items, "title": f"{city4plot} 图表总览"}
+        facts_json = json.dumps({
+            "city": city4plot,
+            "n": stats["n"],
+            "vendors": stats["vendor_counts"],
+            "status": stats["status_counts"],
+            "bands": stats["band_counts"],
+        }, ensure_ascii=False)
         explain_prompt = (
-            f"你是网络运营分析助手。现在用户让你生成“{title}”。\n"
-            f"请用中文写 3-5 句，说明：这个图是什么、它展示了什么维度、读图时应关注哪些对比或占比、并给出 1-2 条简要洞见。\n"
-            f"不要复述全部数字，只点出核心结论。城市：{city4plot}。\n"
-            f"补充数据(JSON)：{facts_json}"
+            f"你是网络运营分析助手。请用中文给一组图表做**简短总览解读**，对象是{city4plot}的基站数据。\n"
+            f"数据事实(JSON)：{facts_json}\n"
+            "图表清单：厂商柱状图、在线状态饼图、频段甜甜圈、厂商×状态堆叠柱、厂商×频段热力图、状态水平条、更新时间直方图。\n"
+            "写 5-7 句：..."
         )
-        async for delta in stream_from_ollama(explain_prompt):
-            yield {"type": "token", "delta": delta}
-        yield {"type":"end"}; return
+        async for ev in stream_explanation(explain_prompt):
+            yield ev
+        yield {"type": "end"}
+        return
 
+    # ② 单图 → 若用户提到下载/复制，则内嵌；否则仍走右侧
+    kind = _classify_kind(prompt)
+    with tracing.span("chart_build", kind=kind):
+        title, spec = chart_specs.pick_spec(prompt, rows, city4plot)
+    yield {"type": "tool", "tool": "plotly", "title": title, "spec": spec, "inline": c.features.inline_chart}
+
+    # 聚合事实 → 3-5 句读图说明
+    focus = {}
+    if kind in ("bar", "stacked"):
+        focus["vendor_counts"] = stats["vendor_counts"]
+        focus["status_counts"] = stats["status_counts"]
+    if kind in ("pie", "horizontal"):
+        focus["status_counts"] = stats["status_counts"]
+    if kind in ("donut",):
+        focus["band_counts"] = stats["band_counts"]
+    if kind in ("heatmap",):
+        from collections import defaultdict
+        vendors = sorted(stats["vendor_counts"].keys())
+        bands = sorted(stats["band_counts"].keys())
+        mat = defaultdict(dict)
+        for v in vendors:
+            for b in bands:
+                mat[v][b] = sum(1 for r in rows if (r.get("vendor") or "未知")==v and (r.get("band") or "未知")==b)
+        focus["vendor_band_nonzero"] = sum(1 for v in vendors for b in bands if mat[v][b] > 0)
+        focus["vendors"] = vendors
+        focus["bands"] = bands
+    if kind in ("hist",):
+        focus["updated_at_summary"] = stats["updated_at_summary"]
+
+    facts_json = json.dumps({"city": city4plot, "kind": kind, "n": stats["n"], **focus}, ensure_ascii=False)
+    explain_prompt = (
+        f"你是网络运营分析助手。现在用户让你生成“{title}”。\n"
+        f"请用中文写 3-5 句，说明：这个图是什么、它展示了什么维度、读图时应关注哪些对比或占比、并给出 1-2 条简要洞见。\n"
+        f"不要复述全部数字，只点出核心结论。城市：{city4plot}。\n"
+        f"补充数据(JSON)：{facts_json}"
+    )
+    async for ev in stream_explanation(explain_prompt):
+        yield ev
+    yield {"type": "end"}
 
-    
-    # ★ 1.5) 城市清单直答（例如“北京有哪些基站/北京的基站”）
-    city = extract_city(prompt or "")
-    if want_list(prompt) and city:
-        rows = db_json.search_stations(city=city, limit=300)
-        report = render_city_overview_report(city, rows)
-        yield {"type": "log", "channel": "router", "message": f"命中城市清单直答：{city}（{len(rows)}条，报告体裁）"}
-        for line in (report.splitlines(True) or [report]):
-            yield {"type": "token", "delta": line}
-        yield {"type": "end"}
+
+async def _route_city_list(c: RouteCtx):
+    """城市清单直答（例如“北京有哪些基站/北京的基站”）"""
+    city = c.features.city
+    n = db_json.city_stats(city)["total"]
+    yield {"type": "log", "channel": "router", "message": f"命中城市清单直答：{city}（{n}条，报告体裁）"}
+    async for ev in _report_events(c, city, None):
+        yield ev
+    yield {"type": "end"}
+
+
+async def _route_direct(c: RouteCtx):
+    """问“它的id/坐标/状态/详情”等直接本地作答，不进模型；没命中字段则不产出（交给下一条路由）。"""
+    direct = try_direct_answer(c.prompt, c.station, c.features.fields)
+    if not direct:
         return
+    for line in (direct.splitlines(True) or [direct]):
+        yield {"type": "token", "delta": line}
+    yield {"type": "end"}
 
 
-    direct = try_direct_answer(prompt, station)
-    if direct:
-        for line in (direct.splitlines(True) or [direct]):
-            yield {"type":"token","delta":line}
-        yield {"type":"end"}; return
-    # （其余城市清单/计数直答、TopK+模型保持不变）
+async def _route_nearby(c: RouteCtx):
+    async for ev in handle_nearby_flow_gen(c.prompt, c.conversation_id, features=c.features):
+        yield ev
 
 
-    
-    # ★ 2) 上下文护栏
+async def _route_fallback(c: RouteCtx):
+    """模型兜底：上下文护栏 + Top-K 精简表做检索增强，避免全量 JSON。"""
+    station = c.station
     station_ctx = ""
     if station:
         station_ctx = (
@@ -1260,64 +1698,215 @@ async def agent_stream(messages: List[Dict[str, str]], context: Dict[str, Any] |
         "1) 若用户已选中基站，则优先回答该基站的具体信息；\n"
         "2) 若用户问到某个城市的所有基站，则列出该城市的基站清单（可以用 Markdown 表格展示）；\n"
         "3) 若资料有冲突，以当前选中基站的信息为准。\n"
-        
     )
 
-    aug_prompt = (
+    # 稳定前缀（站点 + 护栏）与本轮消息（TopK/地标 + 问题）分开：前缀不变时可续用 KV 上下文
+    aug_prefix = (
         (station_ctx + "\n" if station_ctx else "") +
-        (guardrail if station_ctx else "") +
-        f"\n用户问题：{prompt}"
+        (guardrail if station_ctx else "")
     )
+    question = f"\n用户问题：{c.prompt}"
+
+    with tracing.span("topk") as sp:
+        topk = topk_context_for_prompt(c.prompt, k=TOPK_MAX_ROWS)
+        sp["rows"] = len(topk)
+    # 语义召回（模型推理，放线程里跑，不阻塞事件循环）
+    sem_stations, sem_pois = await anyio.to_thread.run_sync(
+        semantic_context_for_prompt, c.prompt, EMBED_TOPK)
+    if sem_stations:
+        topk = merge_topk(topk, sem_stations, TOPK_MAX_ROWS)
+    packed = context_packer.pack_md_table(topk, TOPK_COLUMNS, priority=TOPK_PRIORITY, name="topk_pack")
+    if packed.text:
+        question = "【可用基站候选（仅供参考）】\n" + packed.text + "\n" + question
+        yield {"type": "log", "channel": "router",
+               "message": f"提供 TopK={len(packed.rows)}/{len(topk)} 行上下文给模型"
+                          f"（语义召回 {len(sem_stations)}，≈{packed.tokens}/{packed.budget} tokens）"}
+    if sem_pois:
+        names = "、".join(f"{p.get('name')}（{p.get('city','')}{p.get('district','')}）" for p in sem_pois[:3])
+        question = f"【可能相关的地标】{names}\n\n" + question
+
+    async for ev in llm_events_with_kv(aug_prefix, question, conversation_id=c.conversation_id,
+                                       channel="fallback", priority=llm_scheduler.PRIORITY_LONG):
+        yield ev
 
+    yield {"type": "end"}
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    when: Callable[[RouteCtx], bool]
+    run: Callable[[RouteCtx], AsyncGenerator[Dict[str, Any], None]]
+
+
+# 路由表：自上而下第一条 when 为真且有产出的路由处理本轮；不产出（如附近流未触发）则继续往下
+ROUTES: tuple[Route, ...] = (
+    Route("report_continue", lambda c: c.features.continue_req is not None and _pending_report(c) is not None,
+          _route_report_continue),
+    Route("city_status", lambda c: c.features.kind == "city_status", _route_city_status),
+    Route("chart_3d",    lambda c: c.features.kind == "chart_3d",    _route_chart_3d),
+    Route("chart",       lambda c: c.features.kind == "chart",       _route_chart),
+    Route("city_list",   lambda c: c.features.kind == "city_list",   _route_city_list),
+    Route("direct",      lambda c: c.station is not None,            _route_direct),
+    Route("nearby",      lambda c: True,                             _route_nearby),
+    Route("fallback",    lambda c: True,                             _route_fallback),
+)
+_ROUTE_BY_NAME = {r.name: r for r in ROUTES}
+_TAIL_ROUTES = (_ROUTE_BY_NAME["nearby"], _ROUTE_BY_NAME["fallback"])
 
-    handled = False
-    async for ev in handle_nearby_flow_gen(prompt):
-        handled = True
+
+def candidate_routes(ctx: RouteCtx) -> tuple[Route, ...]:
+    """
+    谓词为真的路由（表内顺序），由构造时的分类结果直接定位，不逐条求值谓词。
+    与 [r for r in ROUTES if r.when(ctx)] 等价：kind 只对应第一个命中的分类路由，它们总有产出，后面的不会轮到。
+    """
+    f = ctx.features
+    head = []
+    if f.continue_req is not None and _pending_report(ctx) is not None:
+        head.append(_ROUTE_BY_NAME["report_continue"])
+    if f.kind is not None:
+        head.append(_ROUTE_BY_NAME[f.kind])
+    if ctx.station is not None:
+        head.append(_ROUTE_BY_NAME["direct"])
+    return (*head, *_TAIL_ROUTES)
+
+
+async def agent_stream(messages: List[Dict[str, str]], context: Dict[str, Any] | None = None,
+                       conversation_id: str | None = None):
+    conversation_id = conversation_id or _conversation_id(None, context)
+    # 分阶段计时：总是进 /metrics 直方图；context.trace / CHAT_TRACE 开启时同时作为 log 事件推送
+    trace = tracing.start(emit=tracing.TRACE_DEFAULT or bool(isinstance(context, dict) and context.get("trace")))
+
+    prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+
+    # 1️⃣ 默认从 context 取
+    station = (context or {}).get("station") if isinstance(context, dict) else None
+
+    notes = []
+    with tracing.span("station_resolve") as sp:
+        # 2️⃣ 如果 context 里没有，或者可能是旧的，就尝试从对话历史里找“已选中基站”
+        #    注意：这里会覆盖掉 context.station，确保拿到最新的一次
+        #    服务端维护的对话：写入时已解析好，直接取缓存，不再倒序扫描
+        cached = conversations.exists(conversation_id)
+        sid = conversations.selected_station_id(conversation_id) if cached else None
+        s = db_json.get_station(sid) if sid else None
+        if s:
+            station = s
+            notes.append({"type": "log", "channel": "router", "message": f"对话记录确认最新选中：{s.get('name')}（{sid}）"})
+        for m in ([] if cached else reversed(messages)):
+            if m.get("role") == "assistant" and "已选中基站" in m.get("content", ""):
+                # 从 "已选中基站【xxx】（BJS-006）" 里提取 ID
+                m2 = re.search(r"（([A-Z]{2,5}-\d{3,6})）", m["content"])
+                if m2:
+                    sid = m2.group(1)
+                    s = db_json.get_station(sid)
+                    if s:
+                        station = s
+                        notes.append({"type": "log", "channel": "router", "message": f"对话历史确认最新选中：{s.get('name')}（{sid}）"})
+                break
+
+        # 3️⃣ 如果还是没有，就走解析逻辑
+        if not station:
+            s2 = resolve_station_from_prompt(prompt or "")
+            if s2:
+                station = s2
+                notes.append({"type":"log","channel":"router","message":f"由内容解析到站点：{station.get('name','')}（{station.get('id','')}）"})
+        sp["station"] = (station or {}).get("id")
+    for ev in notes:
         yield ev
-    if handled:
-        return
-   
-# ★ 3) 模型兜底：仅给 Top-K 精简表做检索增强，避免全量 JSON
-    topk = topk_context_for_prompt(prompt, k=12)
-    ctx_md = rows_to_compact_md(topk)
-    if ctx_md:
-        aug_prompt = ("【可用基站候选（仅供参考）】\n" + ctx_md + "\n\n" + aug_prompt)
-        yield {"type": "log", "channel": "router", "message": f"提供 TopK={len(topk)} 行上下文给模型"}
-
-    buf = []
-    async for delta in stream_from_ollama(aug_prompt):
-        buf.append(delta)
-        yield {"type": "token", "delta": delta}
 
-    yield {"type": "end"}
+    # 4️⃣ 一次解析 + 路由表分发
+    ctx = RouteCtx(prompt=prompt or "", features=PromptFeatures(prompt or ""),
+                   station=station, conversation_id=conversation_id)
+    for route in candidate_routes(ctx):
+        handled = False
+        async for ev in route.run(ctx):
+            handled = True
+            if ev.get("type") == "end":
+                # 结束前补齐总耗时与剩余 span（前端收到 end 即停止读取）
+                tracing.record("total", trace.elapsed_ms(), route=route.name)
+                for tev in trace.drain_events():
+                    yield tev
+                yield ev
+                continue
+            yield ev
+            for tev in trace.drain_events():
+                yield tev
+        if handled:
+            return
+
 
 
 
+async def _with_start(conversation_id: str, gen: AsyncGenerator[Dict[str, Any], None]):
+    yield {"type": "start", "conversation_id": conversation_id}
+    async with aclosing(gen):
+        async for ev in gen:
+            yield ev
+
 
 @app.post("/api/chat/stream")
 async def chat_stream(payload: Dict[str, Any] = Body(...)):
-    messages = payload.get("messages") or []
     ctx = payload.get("context") or None
-    return StreamingResponse(
-        sse(agent_stream(messages, context=ctx)),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache, no-transform",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+    conv_id, events = _open_turn(payload, ctx)
+    # 两种协议都先发 start（带对话 id），同时放在响应头里：旧协议客户端下轮带回即可续上附近流/报告翻页
+    return SSEResponse(_with_start(conv_id, events), headers={"X-Conversation-Id": conv_id})
+
+
+@app.websocket("/api/chat/ws")
+async def chat_ws(ws: WebSocket):
+    """一条连接复用多路对话流（协议见 app/ws_mux.py），事件内容与 SSE 入口一致。"""
+    await ws_mux.serve(ws, _open_turn)
+
+
+class ConversationMessageIn(BaseModel):
+    role: str = "assistant"
+    content: str
+
+
+@app.post("/api/conversations")
+def conversation_create():
+    cid = conversations.new_id()
+    conversations.set_station(cid, None)
+    return {"ok": True, "conversation_id": cid}
+
+
+@app.get("/api/conversations/{conversation_id}")
+def conversation_get(conversation_id: str):
+    if not conversations.exists(conversation_id):
+        return {"ok": False, "error": "conversation not found"}
+    return {"ok": True, "conversation_id": conversation_id, **conversations.get(conversation_id)}
+
+
+@app.post("/api/conversations/{conversation_id}/messages")
+def conversation_append(conversation_id: str, msg: ConversationMessageIn):
+    """客户端本地产生的消息（如“已选中基站…”提示）补记到服务端历史。"""
+    if msg.role not in ("user", "assistant"):
+        return {"ok": False, "error": "role must be user/assistant"}
+    messages = conversations.append(conversation_id, msg.role, msg.content)
+    return {"ok": True, "count": len(messages), "station_id": conversations.selected_station_id(conversation_id)}
+
+
+@app.delete("/api/conversations/{conversation_id}")
+def conversation_delete(conversation_id: str):
+    conversations.clear(conversation_id)
+    kv_context.forget(conversation_id)
+    _clear_flow(conversation_id)
+    return {"ok": True}
 
 
 @app.post("/api/chat")
-def chat_once(payload: Dict[str, Any] = Body(...)):
+async def chat_once(payload: Dict[str, Any] = Body(...)):
     messages = payload.get("messages") or []
     prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+    session_id = _conversation_id(payload, payload.get("context"))   # 匿名调用各自一个 Agent
     try:
-        text = agent(prompt)
-        return {"ok": True, "text": str(text)}
+        text = await AGENT_POOL.run(session_id, prompt, timeout_s=CHAT_TIMEOUT_S)
+        return {"ok": True, "text": text, "conversation_id": session_id}
+    except TimeoutError:
+        return {"ok": False, "error": f"timeout after {CHAT_TIMEOUT_S:g}s", "conversation_id": session_id}
     except Exception as e:
-        return {"ok": False, "error": str(e)}
+        return {"ok": False, "error": str(e), "conversation_id": session_id}
     
 @app.get("/api/geo/nearby")
 def geo_nearby(
@@ -1374,4 +1963,9 @@ def geo_nearby(
         }
         for p in cands
     ]
-    return {"ok": True, "mode": "multi", "candidates": candidates}
\ No newline at end of file
+    return {"ok": True, "mode": "multi", "candidates": candidates}
+
+
+# 意图路由：router_embed 反向依赖本模块的函数，放在末尾导入（导入时不加载模型）；
+# 由它在模块末尾把 /embed-router 挂到 app 上，先导入 router_embed 时（循环导入）也能挂上
+from . import router_embed  # noqa: E402
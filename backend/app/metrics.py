@@ -0,0 +1,85 @@
+
+# app/metrics.py
+"""
+进程内指标（零依赖）：计数器 + 简单滑动均值 + 固定桶直方图（默认毫秒桶，速率类指标用 RATE_BUCKETS）。
+/metrics 直接返回 snapshot()。
+"""
+from __future__ import annotations
+import bisect
+import threading
+from typing import Dict, List, Optional
+
+_LOCK = threading.Lock()
+_COUNTERS: Dict[str, float] = {}
+_MEANS: Dict[str, tuple] = {}   # name -> (count, mean)
+
+# 直方图桶上界，最后一桶为 +inf。默认按毫秒分；速率（tokens/s）落在 1~200 之间，用毫秒桶会挤在头几个桶里
+BUCKETS: List[float] = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+RATE_BUCKETS: List[float] = [1, 2, 3, 5, 8, 10, 15, 20, 30, 40, 60, 80, 100, 150, 200]
+_HISTS: Dict[str, dict] = {}    # name -> {"bounds": [...], "counts": [...], "sum": float, "count": int, "max": float}
+
+
+def inc(name: str, value: float = 1.0):
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0.0) + value
+
+
+def observe_mean(name: str, value: float):
+    """累计均值（不保留样本）。"""
+    with _LOCK:
+        n, m = _MEANS.get(name, (0, 0.0))
+        n += 1
+        _MEANS[name] = (n, m + (value - m) / n)
+
+
+def mean(name: str, default: float = 0.0) -> float:
+    with _LOCK:
+        n, m = _MEANS.get(name, (0, default))
+        return m if n else default
+
+
+def observe(name: str, value: float, buckets: Optional[List[float]] = None):
+    """记一次样本到直方图；buckets 只在该直方图第一次出现时生效（默认 BUCKETS）。"""
+    with _LOCK:
+        h = _HISTS.get(name)
+        if h is None:
+            bounds = list(buckets or BUCKETS)
+            h = _HISTS[name] = {"bounds": bounds, "counts": [0] * (len(bounds) + 1), "sum": 0.0, "count": 0, "max": 0.0}
+        h["counts"][bisect.bisect_left(h["bounds"], value)] += 1
+        h["sum"] += value
+        h["count"] += 1
+        h["max"] = max(h["max"], value)
+
+
+def _quantile(h: dict, q: float) -> float:
+    """按桶上界估算分位数（落在 +inf 桶时返回观测到的最大值）。"""
+    target = q * h["count"]
+    acc = 0
+    for i, c in enumerate(h["counts"]):
+        acc += c
+        if acc >= target and c:
+            return h["bounds"][i] if i < len(h["bounds"]) else h["max"]
+    return h["max"]
+
+
+def _hist_view(h: dict) -> dict:
+    labels = [f"le_{b:g}" for b in h["bounds"]] + ["le_inf"]
+    return {
+        "count": h["count"],
+        "sum": round(h["sum"], 3),
+        "mean": round(h["sum"] / h["count"], 3) if h["count"] else 0.0,
+        "p50": _quantile(h, 0.50),
+        "p90": _quantile(h, 0.90),
+        "p99": _quantile(h, 0.99),
+        "max": round(h["max"], 3),
+        "buckets": {k: c for k, c in zip(labels, h["counts"]) if c},
+    }
+
+
+def snapshot() -> dict:
+    with _LOCK:
+        return {
+            "counters": dict(_COUNTERS),
+            "means": {k: {"count": n, "mean": round(m, 3)} for k, (n, m) in _MEANS.items()},
+            "histograms": {k: _hist_view(h) for k, h in _HISTS.items()},
+        }
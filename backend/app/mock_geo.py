@@ -2,14 +2,20 @@
 from __future__ import annotations
 import random
 import time
+import os
 from typing import Dict, List, Optional
-import asyncio
 from math import cos, radians, sqrt
+from .session_store import SessionStore
 
 # ===== 内存存储 =====
 GEO: Dict[str, Dict] = {}                 # { city_name: { code, center, stations: [] } }
-SELECTED_BY_SESSION: Dict[str, Dict] = {} # { session_id: station_dict }
-LOCK = asyncio.Lock()
+# { session_id: station_dict }：TTL + LRU + 内存上限；设置 SELECTION_STORE_PATH 可落盘（.json / .db）
+SELECTED_BY_SESSION = SessionStore(
+    ttl_s=float(os.environ.get("SELECTION_TTL_S", 24 * 3600)),
+    max_entries=int(os.environ.get("SELECTION_MAX_SESSIONS", 10_000)),
+    max_bytes=int(os.environ.get("SELECTION_MAX_BYTES", 8 * 1024 * 1024)),
+    persist_path=os.environ.get("SELECTION_STORE_PATH") or None,
+)
 
 VENDORS = ["Huawei", "ZTE", "Ericsson", "Nokia"]
 BANDS   = ["n78", "n41", "n28", "n1"]
@@ -240,15 +246,13 @@ def get_station(station_id: str) -> Optional[Dict]:
                 return s
     return None
 
-async def record_selection(session_id: Optional[str], station_id: str) -> Optional[Dict]:
-    """记录“某会话选中了哪个基站”，并返回该站详情。"""
-    s = get_station(station_id)
+async def record_selection(session_id: Optional[str], station_id: str,
+                           station: Optional[Dict] = None) -> Optional[Dict]:
+    """记录“某会话选中了哪个基站”，并返回该站详情（可直接传入已查到的 station）。"""
+    s = station or get_station(station_id)
     if not s:
         return None
-    if not session_id:
-        session_id = "__default__"
-    async with LOCK:
-        SELECTED_BY_SESSION[session_id] = s
+    SELECTED_BY_SESSION.set(session_id or "__default__", dict(s))
     return s
 
 def get_selected(session_id: Optional[str]) -> Optional[Dict]:
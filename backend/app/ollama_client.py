@@ -0,0 +1,58 @@
+
+# app/ollama_client.py
+"""
+进程级共享的 Ollama HTTP 客户端（keep-alive 连接池）。
+- 在 FastAPI lifespan 里 startup()/shutdown()，所有 LLM 调用复用同一个 AsyncClient
+- 超时与连接上限可用环境变量调整
+"""
+from __future__ import annotations
+import os
+from typing import Optional
+import httpx
+
+CONNECT_TIMEOUT_S = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT_S", 5))
+READ_TIMEOUT_S    = float(os.environ.get("OLLAMA_READ_TIMEOUT_S", 120))   # 两个 token 之间的最长等待
+WRITE_TIMEOUT_S   = float(os.environ.get("OLLAMA_WRITE_TIMEOUT_S", 30))
+POOL_TIMEOUT_S    = float(os.environ.get("OLLAMA_POOL_TIMEOUT_S", 30))    # 等空闲连接的最长时间
+MAX_CONNECTIONS   = int(os.environ.get("OLLAMA_MAX_CONNECTIONS", 16))
+MAX_KEEPALIVE     = int(os.environ.get("OLLAMA_MAX_KEEPALIVE", 8))
+KEEPALIVE_EXPIRY_S = float(os.environ.get("OLLAMA_KEEPALIVE_EXPIRY_S", 60))
+
+_STATE: dict = {"client": None}
+
+
+def _build_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(
+            connect=CONNECT_TIMEOUT_S,
+            read=READ_TIMEOUT_S,
+            write=WRITE_TIMEOUT_S,
+            pool=POOL_TIMEOUT_S,
+        ),
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE,
+            keepalive_expiry=KEEPALIVE_EXPIRY_S,
+        ),
+        headers={"Accept": "application/json"},
+    )
+
+
+async def startup() -> httpx.AsyncClient:
+    if _STATE["client"] is None:
+        _STATE["client"] = _build_client()
+    return _STATE["client"]
+
+
+async def shutdown():
+    client: Optional[httpx.AsyncClient] = _STATE["client"]
+    _STATE["client"] = None
+    if client is not None:
+        await client.aclose()
+
+
+def get_client() -> httpx.AsyncClient:
+    """lifespan 之外（脚本/测试）调用时懒创建，之后同样复用。"""
+    if _STATE["client"] is None:
+        _STATE["client"] = _build_client()
+    return _STATE["client"]
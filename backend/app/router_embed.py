@@ -6,13 +6,14 @@ Embedding 驱动的意图路由（替换基于正则的触发）
 - 与现有 POI/附近流程函数做无缝对接
 """
 from __future__ import annotations
-from typing import Callable, Dict, List, Optional, Tuple, Any
-from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Any
+from dataclasses import dataclass, field
 import math
+import threading
 
 # ===== 你项目里已有的函数/状态（按需导入/调整路径） =====
-# 如果这些在 main.py 里，建议抽到 app/services 或 app/core，避免循环依赖
-from app.services.nearby import (  # 假设你把它们整理到了这里；如果还在 main.py 就相对导入
+# 这些目前都在 main.py 里；以后抽到 app/services 时改这里的导入路径即可
+from app.main import (
     find_poi_candidates,
     filter_candidates_by_hint,
     extract_poi_key,
@@ -20,13 +21,29 @@ from app.services.nearby import (  # 假设你把它们整理到了这里；如
     nearby_stations_by_poi,
     _aggregate_stats,
     agent_answer_with_context,
+    NEAR_WORDS_RE,
 )
-from app.state import LAST_POI_STATE, _flow_expired, _clear_flow  # 你原本的全局状态与清理逻辑
+from app.state import get_flow, update_flow, _flow_expired, _clear_flow  # 按对话 id 隔离的流程状态
+from app.conversations import new_id as new_conversation_id
 
 # ===== 向量模型 =====
-# pip install sentence-transformers
-from sentence_transformers import SentenceTransformer
+# pip install sentence-transformers（在后台预热线程里才 import/加载，导入本模块不阻塞启动）
 import numpy as np
+import os
+import re
+import time
+import logging
+
+from app.embed_cache import EmbeddingCache  # 示例句向量落盘缓存（按模型名 + 文本哈希）
+from app.intent_index import rank_intents   # 分段取最大 + argpartition 的向量化打分
+from app.embed_batcher import MicroBatcher  # 查询向量 LRU 缓存 + 并发请求微批编码
+from app import ann_index                   # 示例库很大时的近似检索后端（EMBED_ANN=ivf）
+
+log = logging.getLogger(__name__)
+
+EMBED_ROUTER_MODEL = os.environ.get("EMBED_ROUTER_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_WARMUP_RETRY_S = float(os.environ.get("EMBED_WARMUP_RETRY_S", 60))   # 加载失败后多久允许再试
+EMBED_ANN_CANDIDATES = int(os.environ.get("EMBED_ANN_CANDIDATES", 64))     # 近似检索取多少个最近示例再按意图聚合
 
 # ----------------- 工具：中文数词与半径解析（兜底版） -----------------
 _CN_NUMS = {"一":1,"二":2,"两":2,"三":3,"四":4,"五":5,"六":6,"七":7,"八":8,"九":9,"十":10}
@@ -77,50 +94,269 @@ class Intent:
     handler: Callable[[str], Any]
     threshold: float = 0.52  # 可按数据调
     max_ties: int = 2        # 近似并列时触发澄清
+    patterns: List[str] = field(default_factory=list)  # 模型未就绪时的正则兜底（任一命中即走 handler）
 
 class EmbeddingRouter:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    """
+    示例向量按意图连续存放在一块预分配的矩阵里（容量翻倍增长）：
+    - add_intent / add_intents 只编码新意图自己的示例，追加到尾部；同名意图视为更新（先删旧行）
+    - remove_intent 删除该意图的行（重排矩阵，不重新编码）
+    - 读路径拿 (矩阵视图, 行归属) 快照；追加只写视图之外的行，删除换新缓冲区，不影响进行中的匹配
+    模型懒加载：构造与注册意图都不碰模型；warmup()（一般由 start_warmup 放后台线程）加载模型、
+    编码积压的意图并预热一次查询后才切到 ready。未就绪期间 route 走 Intent.patterns 的正则兜底，不阻塞请求。
+    """
+    def __init__(self, model_name: str = EMBED_ROUTER_MODEL):
+        self.model_name = model_name
+        self.model = None
+        self.cache = EmbeddingCache(model_name)
+        self.batcher = MicroBatcher(self._encode, name="embed-router-batcher")
         self.intents: Dict[str, Intent] = {}
-        self._emb_matrix: Optional[np.ndarray] = None
+        self._pending: Dict[str, Intent] = {}            # 模型就绪前注册的意图（就绪时统一编码）
+        self._ready = threading.Event()
+        self._state = "cold"                             # cold | loading | ready | failed
+        self._error: Optional[str] = None
+        self._failed_at = 0.0
+        self._loaded_ms: Optional[float] = None
+        self._lock = threading.RLock()
+        self._buf: Optional[np.ndarray] = None           # (容量, dim)，前 _n 行有效
+        self._n = 0
+        self._spans: Dict[str, Tuple[int, int]] = {}     # 意图 -> [start, end) 行区间
+        self._emb_matrix: Optional[np.ndarray] = None    # _buf[:_n] 视图
         self._emb_index_to_intent: List[str] = []
+        self._snapshot: Tuple = (None, np.zeros(0, dtype=np.intp), [], 3, None)
+        # IVF：质心复用，新增行只分簇；首次训练与规模翻倍后的重训放后台线程，训练完再换进快照
+        self._centroids: Optional[np.ndarray] = None
+        self._trained_n = 0
+        self._assign: Optional[np.ndarray] = None        # 与矩阵逐行对齐的簇号
+        self._ann_thread: Optional[threading.Thread] = None
+
+    def _encode(self, xs: List[str]) -> np.ndarray:
+        return self.model.encode(xs, normalize_embeddings=True)
+
+    def _encode_examples(self, sents: List[str]) -> np.ndarray:
+        # 只编码缓存里没有的示例；示例不变时启动不再调用模型
+        embs = self.cache.get_many(sents, self._encode)
+        return np.asarray(embs, dtype=np.float32)
+
+    # ---------- 懒加载 / 预热 ----------
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def status(self) -> Dict[str, Any]:
+        return {"state": self._state, "model": self.model_name, "intents": len(self.intents),
+                "examples": self._n, "load_ms": self._loaded_ms, "error": self._error}
+
+    def warmup(self) -> bool:
+        """阻塞加载模型并编码全部意图；成功返回 True。"""
+        with self._lock:
+            if self._state in ("loading", "ready"):
+                return self._state == "ready"
+            self._state, self._error = "loading", None
+        return self._load()
+
+    def start_warmup(self) -> bool:
+        """后台预热（幂等）；失败后过 EMBED_WARMUP_RETRY_S 才会再试。返回是否启动了新线程。"""
+        with self._lock:
+            if self._state in ("loading", "ready"):
+                return False
+            if self._state == "failed" and time.time() - self._failed_at < EMBED_WARMUP_RETRY_S:
+                return False
+            self._state, self._error = "loading", None
+        threading.Thread(target=self._load, name="embed-router-warmup", daemon=True).start()
+        return True
+
+    def _load(self) -> bool:
+        t0 = time.perf_counter()
+        try:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.model_name)
+            self._encode(["预热"])   # 第一次推理较慢（图初始化/内存分配），放在就绪前
+            while True:
+                with self._lock:
+                    batch, self._pending = list(self._pending.values()), {}
+                    if not batch:   # 积压清空与切 ready 在同一把锁里，之后注册的意图直接走增量路径
+                        self._loaded_ms = round((time.perf_counter() - t0) * 1000.0, 1)
+                        self._state = "ready"
+                        self._ready.set()
+                        break
+                self._index_intents(batch)
+        except Exception as e:
+            with self._lock:
+                self._state, self._error, self._failed_at = "failed", f"{type(e).__name__}: {e}", time.time()
+                # 编码到一半失败的意图放回积压，下次预热重来
+                self._pending = {n: it for n, it in self.intents.items() if n not in self._spans}
+            log.warning("embed router warmup failed: %s", e)
+            return False
+        log.info("embed router ready in %.0f ms (%d intents)", self._loaded_ms, len(self.intents))
+        return True
 
     def add_intent(self, intent: Intent):
-        self.intents[intent.name] = intent
-        self._rebuild_index()
+        """注册或更新单个意图（只编码它自己的示例）。"""
+        self.add_intents([intent])
+
+    def add_intents(self, intents: Iterable[Intent]):
+        """批量注册/更新：所有新示例一次批量编码，再按意图依次追加（模型未就绪时先挂起，预热时统一编码）。"""
+        batch = list({it.name: it for it in intents}.values())
+        with self._lock:
+            if not self._ready.is_set():
+                for it in batch:
+                    self.intents[it.name] = it
+                    self._pending[it.name] = it
+                return
+        self._index_intents(batch)
+
+    def _index_intents(self, batch: List[Intent]):
+        sents = [ex for it in batch for ex in it.examples]
+        embs = self._encode_examples(sents) if sents else None
+        with self._lock:
+            for it in batch:
+                if it.name in self._spans:
+                    self._drop_rows(it.name)
+            off = 0
+            for it in batch:
+                k = len(it.examples)
+                self.intents[it.name] = it
+                self._append_rows(it.name, embs[off:off + k] if k else None)
+                off += k
+            self._publish()
+
+    def remove_intent(self, name: str) -> bool:
+        with self._lock:
+            if name not in self.intents:
+                return False
+            self._pending.pop(name, None)
+            if name in self._spans:
+                self._drop_rows(name)
+            del self.intents[name]
+            self._publish()
+            return True
+
+    def _append_rows(self, name: str, embs: Optional[np.ndarray]):
+        n = 0 if embs is None else len(embs)
+        if n:
+            need = self._n + n
+            if self._buf is None or need > len(self._buf) or self._buf.shape[1] != embs.shape[1]:
+                cap = max(need, 2 * (len(self._buf) if self._buf is not None else 0), 64)
+                buf = np.empty((cap, embs.shape[1]), dtype=np.float32)
+                if self._n:
+                    buf[:self._n] = self._buf[:self._n]
+                self._buf = buf
+            self._buf[self._n:need] = embs
+            if self._assign is not None:
+                self._assign = np.concatenate([self._assign, ann_index.assign(embs, self._centroids)])
+        self._spans[name] = (self._n, self._n + n)
+        self._emb_index_to_intent = self._emb_index_to_intent + [name] * n
+        self._n += n
+
+    def _drop_rows(self, name: str):
+        s, e = self._spans.pop(name)
+        k = e - s
+        if k:
+            buf = np.empty_like(self._buf)   # 换新缓冲区：进行中的匹配仍持有旧视图
+            buf[:s] = self._buf[:s]
+            buf[s:self._n - k] = self._buf[e:self._n]
+            self._buf = buf
+            self._n -= k
+            self._emb_index_to_intent = self._emb_index_to_intent[:s] + self._emb_index_to_intent[e:]
+            if self._assign is not None:
+                self._assign = np.delete(self._assign, np.s_[s:e])
+            self._spans = {n: ((a - k, b - k) if a >= e else (a, b)) for n, (a, b) in self._spans.items()}
+
+    def _publish(self):
+        self._emb_matrix = self._buf[:self._n] if self._n else None
+        # 打分快照：非空意图的段起点（升序）与名字；候选数够判断并列即可
+        segs = sorted((a, name) for name, (a, b) in self._spans.items() if b > a)
+        ties = max((it.max_ties for it in self.intents.values()), default=2)
+        self._snapshot = (self._emb_matrix, np.array([a for a, _ in segs], dtype=np.intp),
+                          [name for _, name in segs], max(3, ties + 1), self._build_ann())
+
+    def _build_ann(self):
+        """
+        EMBED_ANN=ivf 且示例数达到 EMBED_ANN_MIN_ROWS 时返回 IVF 索引，否则 None（精确打分）。调用方持锁。
+        锁内只用现有质心与逐行簇号重排倒排表（一次 argsort，不复制矩阵）；还没有质心或规模比上次训练翻倍时
+        启动后台训练，训练期间沿用旧质心（首次训练前精确打分）。
+        """
+        if ann_index.ANN_BACKEND != "ivf" or self._n < ann_index.ANN_MIN_ROWS:
+            return None
+        if self._centroids is None or self._n > 2 * self._trained_n:
+            self._start_ann_training()
+        if self._centroids is None or self._assign is None:
+            return None
+        return ann_index.IVFIndex(self._emb_matrix, centroids=self._centroids, assignment=self._assign)
+
+    def _start_ann_training(self):
+        if self._ann_thread is not None and self._ann_thread.is_alive():
+            return
+        self._ann_thread = threading.Thread(target=self._train_ann, name="embed-router-ivf", daemon=True)
+        self._ann_thread.start()
+
+    def _train_ann(self):
+        """后台训练质心并给全部行分簇；期间矩阵变了就对新矩阵重新分簇，直到能原样换进快照。"""
+        try:
+            with self._lock:
+                m = self._emb_matrix
+            if m is None:
+                return
+            centroids = ann_index.train_centroids(m, ann_index.ANN_NLIST or ann_index.default_nlist(len(m)))
+            while m is not None and len(m) >= ann_index.ANN_MIN_ROWS:
+                assignment = ann_index.assign(m, centroids)
+                with self._lock:
+                    if self._emb_matrix is m:   # 每次 _publish 都换新视图：同一对象 = 行没变过
+                        self._centroids, self._assign, self._trained_n = centroids, assignment, len(m)
+                        self._publish()
+                        return
+                    m = self._emb_matrix
+        except Exception:
+            log.exception("embed router ivf training failed")
 
     def _rebuild_index(self):
-        sents, owners = [], []
-        for name, it in self.intents.items():
-            for ex in it.examples:
-                sents.append(ex)
-                owners.append(name)
-        if sents:
-            embs = self.model.encode(sents, normalize_embeddings=True)
-            self._emb_matrix = np.array(embs, dtype=np.float32)
-            self._emb_index_to_intent = owners
-        else:
-            self._emb_matrix = None
+        """全量重建（从缓存取向量，一般不会触发编码）；增量路径出问题时的兜底。"""
+        with self._lock:
+            if not self._ready.is_set():
+                return
+            intents = list(self.intents.values())
+            self._buf, self._n, self._spans = None, 0, {}
             self._emb_index_to_intent = []
+            self._centroids, self._trained_n, self._assign = None, 0, None
+            self._index_intents(intents)
+
+    def _embed_query(self, text: str) -> np.ndarray:
+        # 并发请求在工作线程里凑批编码；重复问法直接命中缓存
+        return self.batcher.encode(text)
+
+    def _rank(self, q: np.ndarray) -> List[Tuple[str, float]]:
+        matrix, starts, names, n, index = self._snapshot
+        return rank_intents(matrix, starts, names, np.asarray(q, dtype=np.float32), n,
+                            index=index, candidates=EMBED_ANN_CANDIDATES)
 
     def _match_intent(self, text: str) -> Tuple[Optional[Intent], float, List[Tuple[str,float]]]:
-        if not self._emb_matrix is not None:
+        if self._snapshot[0] is None:
             return None, 0.0, []
-        q = self.model.encode([text], normalize_embeddings=True)[0]
-        sims = np.dot(self._emb_matrix, q)  # 余弦相似度（归一化后点积）
-        # 取每个意图的最大相似度
-        best: Dict[str, float] = {}
-        for sim, owner in zip(sims, self._emb_index_to_intent):
-            best[owner] = max(best.get(owner, -1.0), float(sim))
-        ranked = sorted(best.items(), key=lambda x: x[1], reverse=True)
+        ranked = self._rank(self._embed_query(text))   # 每个意图取示例最大相似度，只保留前几名
         if not ranked:
             return None, 0.0, []
         top_name, top_score = ranked[0]
-        it = self.intents[top_name]
-        return (it if top_score >= it.threshold else None), top_score, ranked
+        it = self.intents.get(top_name)
+        return (it if it is not None and top_score >= it.threshold else None), top_score, ranked
+
+    def _regex_route(self, text: str, **kwargs) -> Any:
+        """模型未就绪时的兜底：按注册顺序找第一个 patterns 命中的意图。"""
+        for it in list(self.intents.values()):
+            if any(re.search(p, text or "", re.I) for p in it.patterns):
+                return it.handler(text, **kwargs)
+        return {
+            "type": "clarify_intent",
+            "message": "你想找附近基站吗？可以告诉我地标/城市和半径，例如：‘西湖附近 1km 的 5G 基站’。",
+            "candidates": [],
+            "warming_up": True,
+        }
 
-    # 公开：主路由
-    def route(self, text: str) -> Any:
+    # 公开：主路由（额外关键字参数原样透传给 handler，如 conversation_id）
+    def route(self, text: str, **kwargs) -> Any:
+        if not self._ready.is_set():
+            self.start_warmup()   # 不等待：本次走正则兜底
+            return self._regex_route(text, **kwargs)
         intent, score, ranked = self._match_intent(text)
         if intent is None:
             # 低置信度 → 返回一个标准澄清
@@ -140,21 +376,22 @@ class EmbeddingRouter:
                 "candidates": ties,
             }
         # 命中意图 → 调对应 handler
-        return intent.handler(text)
+        return intent.handler(text, **kwargs)
 
 # ----------------- 具体：附近基站意图 Handler -----------------
-def _handle_nearby_intent(user_text: str):
+def _handle_nearby_intent(user_text: str, conversation_id: Optional[str] = None):
     """
     复用你现有“附近流”里的 POI 召回、收敛、查询与回答逻辑，
     只是这里不再用正则触发，而是 embedding 命中后才走这段。
     """
     # 过期清理
-    if _flow_expired():
-        _clear_flow()
+    if _flow_expired(conversation_id):
+        _clear_flow(conversation_id)
+    flow = get_flow(conversation_id)
 
     # 1) 如果有待选，先尝试用文本选择（编号/中文序数/名字子串）
-    if LAST_POI_STATE.get("candidates"):
-        cands = LAST_POI_STATE["candidates"]
+    if flow.get("candidates"):
+        cands = flow["candidates"]
 
         # —— 选择解析（不依赖 regex 的极简版）——
         # a) 纯数字
@@ -187,7 +424,7 @@ def _handle_nearby_intent(user_text: str):
 
         if len(narrowed) == 1:
             poi = narrowed[0]
-            LAST_POI_STATE.update({"selected": poi, "candidates": [], "city_hint": poi.get("city")})
+            update_flow(conversation_id, selected=poi, candidates=[], city_hint=poi.get("city"))
             radius = (parse_radius_m(user_text) or _parse_radius_simple(user_text) 
                       or int(poi.get("radius_m") or 1000))
             hits = nearby_stations_by_poi(poi, radius_m=radius) or []
@@ -224,7 +461,7 @@ def _handle_nearby_intent(user_text: str):
     narrowed = filter_candidates_by_hint(cands, user_text) if cands else []
     if len(narrowed) == 1:
         poi = narrowed[0]
-        LAST_POI_STATE.update({"selected": poi, "candidates": [], "city_hint": city_hint or poi.get("city")})
+        update_flow(conversation_id, selected=poi, candidates=[], city_hint=city_hint or poi.get("city"))
         radius = (parse_radius_m(user_text) or _parse_radius_simple(user_text) 
                   or int(poi.get("radius_m") or 1000))
         hits = nearby_stations_by_poi(poi, radius_m=radius) or []
@@ -244,7 +481,7 @@ def _handle_nearby_intent(user_text: str):
         return {"type": "nearby_result", "context": ctx}
 
     # 3) 多候选：进入待选
-    LAST_POI_STATE.update({"candidates": narrowed or cands, "selected": None, "city_hint": city_hint})
+    update_flow(conversation_id, candidates=narrowed or cands, selected=None, city_hint=city_hint)
     return {
         "type":"clarify_poi",
         "message":"我找到了多个可能的地标，请补充城市/区县或直接告诉我编号/名字的一部分。"
@@ -265,9 +502,10 @@ def build_router() -> EmbeddingRouter:
             "附近移动/联通/电信基站",
         ],
         handler=_handle_nearby_intent,
-        threshold=0.50
+        threshold=0.50,
+        patterns=[NEAR_WORDS_RE.pattern],
     ))
-    # 未来可继续 add_intent(...) 注册更多意图
+    # 未来可继续 add_intent(...) 注册更多意图；意图多时用 add_intents([...]) 一次批量编码
     return er
 
 # ----------------- FastAPI 适配（示例） -----------------
@@ -277,11 +515,27 @@ from pydantic import BaseModel
 
 class RouteIn(BaseModel):
     text: str
+    conversation_id: Optional[str] = None
 
 router = APIRouter(prefix="/embed-router", tags=["embed-router"])
-_engine = build_router()
+_engine = build_router()   # 只登记意图，不加载模型；由 main 的 lifespan 调 start_warmup()
+
+
+def start_warmup() -> bool:
+    return _engine.start_warmup()
+
+
+def readiness() -> Dict[str, Any]:
+    return _engine.status()
 
 @router.post("/route")
 def route_text(inp: RouteIn):
-    result = _engine.route(inp.text)
-    return result
+    # 未带 conversation_id 时分配新的并随结果返回，匿名调用之间不共享附近/消歧流程状态
+    cid = inp.conversation_id or new_conversation_id()
+    result = _engine.route(inp.text, conversation_id=cid)
+    return {**result, "conversation_id": cid} if isinstance(result, dict) else result
+
+
+# 挂到主应用（main 末尾会导入本模块；先导入本模块时 main 已在上面的 from app.main import 中加载完）
+from app.main import app as _app  # noqa: E402
+_app.include_router(router)
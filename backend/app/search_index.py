@@ -0,0 +1,148 @@
+
+# app/search_index.py
+"""
+站点全文检索：字符二元组（中文）+ ASCII 词 的倒排索引，BM25 打分 + 最近更新加权。
+- 文档在写入时预先归一化（NFKC + 小写）并切词，查询时只访问查询词的倒排表（亚线性）
+- 中文没有空格，按相邻两字切（“地铁口附近” → 地铁/铁口/口附/附近）；ASCII 词保留整体并拆分（bjs-006 → bjs-006/bjs/006）
+- id/name 的词频加倍，命中名称/编号比命中备注更相关
+由 db_json 在每次写入时增量维护（upsert/remove），整体替换时 rebuild。
+"""
+from __future__ import annotations
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RECENCY_WEIGHT = float(os.environ.get("SEARCH_RECENCY_WEIGHT", 0.3))
+RECENCY_HALF_LIFE_S = float(os.environ.get("SEARCH_RECENCY_HALF_LIFE_S", 7 * 86400))
+
+DOC_FIELDS = ("id", "name", "city", "vendor", "band", "status", "desc")
+BOOSTED_FIELDS = ("id", "name")
+
+_ASCII_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+_ASCII_PART_RE = re.compile(r"[a-z0-9]+")
+_CJK_RUN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", str(text or "")).lower()
+
+
+def analyze(text: str, *, normalized: bool = False) -> List[str]:
+    t = text if normalized else normalize(text)
+    toks: List[str] = []
+    for m in _ASCII_RE.findall(t):
+        toks.append(m)
+        parts = _ASCII_PART_RE.findall(m)
+        if len(parts) > 1:
+            toks.extend(parts)
+    for run in _CJK_RUN_RE.findall(t):
+        if len(run) == 1:
+            toks.append(run)
+        else:
+            toks.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return toks
+
+
+class BM25Index:
+    def __init__(self):
+        self._docs: Dict[str, Tuple[Counter, int, float, str]] = {}   # id -> (tf, 长度, updated_at, 归一化全文)
+        self._postings: Dict[str, Dict[str, int]] = {}                 # term -> {id: tf}
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    @staticmethod
+    def _document(st: Dict) -> Tuple[Counter, int, float, str]:
+        parts = {f: normalize(st.get(f) or "") for f in DOC_FIELDS}
+        tf: Counter = Counter()
+        for f, txt in parts.items():
+            toks = analyze(txt, normalized=True)
+            tf.update(toks)
+            if f in BOOSTED_FIELDS:
+                tf.update(toks)
+        # 字段间用换行分隔：短语过滤时不会跨字段拼出匹配
+        return tf, sum(tf.values()), float(st.get("updated_at") or 0), "\n".join(parts.values())
+
+    def upsert(self, st: Dict):
+        sid = st.get("id")
+        if not sid:
+            return
+        self.remove(sid)
+        doc = self._document(st)
+        self._docs[sid] = doc
+        self._total_len += doc[1]
+        for term, n in doc[0].items():
+            self._postings.setdefault(term, {})[sid] = n
+
+    def remove(self, sid: str):
+        doc = self._docs.pop(sid, None)
+        if doc is None:
+            return
+        self._total_len -= doc[1]
+        for term in doc[0]:
+            plist = self._postings.get(term)
+            if plist is not None:
+                plist.pop(sid, None)
+                if not plist:
+                    del self._postings[term]
+
+    def rebuild(self, stations: Iterable[Dict]):
+        self._docs.clear()
+        self._postings.clear()
+        self._total_len = 0
+        for st in stations:
+            self.upsert(st)
+
+    def _recency(self, updated_at: float, now: float) -> float:
+        if RECENCY_WEIGHT <= 0 or updated_at <= 0:
+            return 0.0
+        age = max(0.0, now - updated_at)
+        return RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE_S)
+
+    def search(
+        self,
+        query: str,
+        *,
+        k: int = 20,
+        where: Optional[Callable[[str], bool]] = None,
+        require_phrase: bool = False,
+    ) -> List[Tuple[float, str]]:
+        """
+        返回 [(score, id)]，分数降序。
+        require_phrase=True：只保留“查询里某个空白分隔的整段出现在文档中”的结果（与旧的包含匹配同义，用于避免瞎猜）。
+        """
+        q = normalize(query)
+        terms = Counter(analyze(q, normalized=True))
+        if not terms or not self._docs:
+            return []
+        n_docs = len(self._docs)
+        avgdl = self._total_len / n_docs if n_docs else 1.0
+        scores: Dict[str, float] = {}
+        for term, qtf in terms.items():
+            plist = self._postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1.0 + (n_docs - len(plist) + 0.5) / (len(plist) + 0.5))
+            for sid, tf in plist.items():
+                dl = self._docs[sid][1]
+                s = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+                scores[sid] = scores.get(sid, 0.0) + s * qtf
+        phrases = [t for t in q.split() if t] if require_phrase else None
+        now = time()
+        out: List[Tuple[float, str]] = []
+        for sid, s in scores.items():
+            doc = self._docs[sid]
+            if phrases is not None and not any(p in doc[3] for p in phrases):
+                continue
+            if where is not None and not where(sid):
+                continue
+            out.append((s + self._recency(doc[2], now), sid))
+        out.sort(key=lambda x: (-x[0], x[1]))
+        return out[:k]
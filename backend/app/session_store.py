@@ -0,0 +1,280 @@
+# app/session_store.py
+"""
+会话级 KV 存储：TTL 过期 + LRU 淘汰 + 内存上限 + 可选持久化。
+- 持久化路径以 .db/.sqlite/.sqlite3 结尾 → SQLite；其它 → JSON 文件（原子写入）
+- 持久化是延迟写回：写入/读取刷新/淘汰/过期只在锁内记一笔变更，SESSION_FLUSH_DELAY_S 后由后台线程
+  合并写盘（JSON 整表一次，SQLite 一个事务），请求线程/事件循环不做磁盘 I/O；进程退出时再刷一次
+- 重启后恢复未过期条目，TTL（含读取刷新）与 LRU 顺序一并恢复
+- 线程安全（同步/异步 handler 都可直接调用）
+"""
+from __future__ import annotations
+import atexit
+import os, json, sqlite3, tempfile, threading
+from collections import OrderedDict
+from time import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+_SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+SESSION_FLUSH_DELAY_S = float(os.environ.get("SESSION_FLUSH_DELAY_S", 1.0))
+
+# 待写回的变更：key -> (value, expires_at, touched_at)；None 表示删除
+Changes = Dict[str, Optional[Tuple[Any, float, float]]]
+
+
+def _approx_size(value: Any) -> int:
+    """按 JSON 编码后的字节数估算占用（足够做内存上限控制）。"""
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    except Exception:
+        return 256
+
+
+# ---------- 持久化后端 ----------
+
+class _JsonFileBackend:
+    """整表写回单个 JSON 文件（按 LRU 顺序）；由后台刷盘合并，一段时间内的多次变更只写一次。"""
+    needs_snapshot = True
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Dict[str, Tuple[Any, float]]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except Exception:
+            return {}
+        out = {}
+        for key, rec in (obj.get("entries") or {}).items():
+            out[key] = (rec.get("value"), float(rec.get("expires_at") or 0.0))
+        return out
+
+    def save_all(self, entries: Dict[str, Tuple[Any, float]]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_sessions_", dir=os.path.dirname(self.path) or ".")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"entries": {k: {"value": v, "expires_at": exp} for k, (v, exp) in entries.items()}},
+                          f, ensure_ascii=False, default=str)
+            os.replace(tmp, self.path)
+        finally:
+            try:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            except Exception:
+                pass
+
+    def write(self, changes: Changes, snapshot: Optional[Dict[str, Tuple[Any, float]]]):
+        self.save_all(snapshot or {})
+
+
+class _SqliteBackend:
+    """逐条落到 SQLite（一次刷盘一个事务），适合会话较多的场景；touched_at 记录 LRU 顺序。"""
+    needs_snapshot = False
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, touched_at REAL NOT NULL)"
+        )
+
+    def load(self) -> Dict[str, Tuple[Any, float]]:
+        now = time()
+        self.conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+        out = {}
+        for key, raw, exp in self.conn.execute(
+            "SELECT key, value, expires_at FROM sessions ORDER BY touched_at ASC"
+        ):
+            try:
+                out[key] = (json.loads(raw), float(exp))
+            except Exception:
+                continue
+        return out
+
+    def write(self, changes: Changes, snapshot=None):
+        puts = [(k, json.dumps(rec[0], ensure_ascii=False, default=str), rec[1], rec[2])
+                for k, rec in changes.items() if rec is not None]
+        dels = [(k,) for k, rec in changes.items() if rec is None]
+        with self.conn:
+            self.conn.execute("BEGIN")
+            if puts:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (key, value, expires_at, touched_at) VALUES (?, ?, ?, ?)", puts)
+            if dels:
+                self.conn.executemany("DELETE FROM sessions WHERE key = ?", dels)
+
+
+def _make_backend(path: Optional[str]):
+    if not path:
+        return None
+    if path.lower().endswith(_SQLITE_SUFFIXES):
+        return _SqliteBackend(path)
+    return _JsonFileBackend(path)
+
+
+# ---------- 对外：SessionStore ----------
+
+class SessionStore:
+    """
+    key -> value 的有界存储：
+    - ttl_s：每次写入（以及 touch_on_read=True 时的读取）刷新过期时间
+    - max_entries / max_bytes：超出时按 LRU 从最久未用的开始淘汰
+    - persist_path：可选持久化（重启后恢复未过期的条目）；flush_delay_s 内的变更合并成一次后台写盘
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl_s: float = 24 * 3600,
+        max_entries: int = 10_000,
+        max_bytes: int = 8 * 1024 * 1024,
+        persist_path: Optional[str] = None,
+        touch_on_read: bool = True,
+        flush_delay_s: float = SESSION_FLUSH_DELAY_S,
+    ):
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self.touch_on_read = touch_on_read
+        self._lock = threading.RLock()
+        # key -> (value, expires_at, size)
+        self._data: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self.flush_delay_s = max(0.0, float(flush_delay_s))
+        self._dirty: Changes = {}
+        self._flush_timer: Optional[threading.Timer] = None
+        self._io_lock = threading.Lock()                 # 刷盘串行，保证后写的快照不被先写的覆盖
+        self._backend = _make_backend(persist_path)
+        if self._backend:
+            self._restore()
+            atexit.register(self.flush)
+
+    # —— 内部 ——
+
+    def _snapshot(self) -> Dict[str, Tuple[Any, float]]:
+        return {k: (v, exp) for k, (v, exp, _) in self._data.items()}
+
+    def _restore(self):
+        now = time()
+        with self._lock:
+            for key, (value, exp) in self._backend.load().items():
+                if exp > now:
+                    self._insert(key, value, exp)
+            self._evict()
+
+    def _mark(self, key: str, rec: Optional[Tuple[Any, float, float]]):
+        """记一笔待写回的变更（调用方持锁），必要时排一次延迟刷盘。"""
+        if not self._backend:
+            return
+        self._dirty[key] = rec
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay_s, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _insert(self, key: str, value: Any, expires_at: float):
+        old = self._data.pop(key, None)
+        if old:
+            self._bytes -= old[2]
+        size = _approx_size(value)
+        self._data[key] = (value, expires_at, size)
+        self._bytes += size
+
+    def _drop(self, key: str) -> bool:
+        old = self._data.pop(key, None)
+        if not old:
+            return False
+        self._bytes -= old[2]
+        self._mark(key, None)
+        return True
+
+    def _evict(self):
+        # 至少保留最新写入的一条，避免单条超限时把自己也挤掉
+        while len(self._data) > 1 and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+
+    # —— 对外 API ——
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            rec = self._data.get(key)
+            if not rec:
+                return default
+            value, exp, size = rec
+            now = time()
+            if exp <= now:
+                self._drop(key)
+                return default
+            self._data.move_to_end(key)
+            if self.touch_on_read:
+                exp = now + self.ttl_s
+                self._data[key] = (value, exp, size)
+            self._mark(key, (value, exp, now))   # 过期时间与 LRU 位置都要写回
+            return value
+
+    def set(self, key: str, value: Any, ttl_s: Optional[float] = None):
+        now = time()
+        expires_at = now + (self.ttl_s if ttl_s is None else float(ttl_s))
+        with self._lock:
+            self._insert(key, value, expires_at)
+            self._mark(key, (value, expires_at, now))
+            self._evict()
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self._drop(key)
+
+    def sweep(self) -> int:
+        """清掉所有已过期条目，返回清理数量。"""
+        now = time()
+        with self._lock:
+            expired = [k for k, (_, exp, _) in self._data.items() if exp <= now]
+            for k in expired:
+                self._drop(k)
+            return len(expired)
+
+    def flush(self):
+        """把积压的变更写盘（后台定时调用；测试/退出时也可直接调用）。"""
+        if not self._backend:
+            return
+        with self._io_lock:
+            with self._lock:
+                changes, self._dirty = self._dirty, {}
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not changes:
+                    return
+                snap = self._snapshot() if self._backend.needs_snapshot else None
+            self._backend.write(changes, snap)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        now = time()
+        with self._lock:
+            snap = [(k, v) for k, (v, exp, _) in self._data.items() if exp > now]
+        return iter(snap)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_s": self.ttl_s,
+                "persistent": self._backend is not None,
+            }
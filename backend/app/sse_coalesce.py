@@ -0,0 +1,136 @@
+
+# app/sse_coalesce.py
+"""
+SSE 写出前的 token 合并：把连续的 {"type":"token"} 增量拼成一帧。
+- 第一段 token 立即发出（不影响首字延迟）
+- 之后按“最长等待 max_delay_s / 最大字节 max_bytes”任一先到即 flush
+- 非 token 事件（log/tool/end…）到来前先 flush，保证顺序不变
+max_delay_s <= 0 时关闭合并，原样透传。
+
+两种入口，都不在 yield 时持有任务组（生成器里跨 yield 的任务组/取消域会把 aclose、
+上游异常、外层超时包成 ExceptionGroup）：
+- coalesce_tokens(gen)：直接消费异步生成器；时延上限在下一个事件到达时检查
+  （上游停顿期间已缓冲的片段等到下一个事件或流结束再发）
+- coalesce_stream(recv)：消费内存通道，调用方在自己的任务组里用 pump() 往通道里灌事件；
+  等待可以安全地按时限打断（打断的是通道 receive，不会把取消注入上游生成器），时延上限严格生效
+- coalesce_into(gen, emit)：上面两步的现成组合，是普通协程（任务组不跨 yield），每帧 await emit(ev)；
+  给 SSE 响应体、WebSocket 子流这类“自己往外写”的调用方用
+"""
+from __future__ import annotations
+import os
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+import anyio
+from anyio.abc import ObjectReceiveStream, ObjectSendStream
+
+COALESCE_MAX_DELAY_S = float(os.environ.get("SSE_COALESCE_MAX_DELAY_MS", 40)) / 1000.0
+COALESCE_MAX_BYTES = int(os.environ.get("SSE_COALESCE_MAX_BYTES", 1024))
+
+
+class _Buffer:
+    def __init__(self, max_delay_s: float, max_bytes: int):
+        self.max_delay_s = max_delay_s
+        self.max_bytes = max_bytes
+        self.parts: List[str] = []
+        self.size = 0
+        self.deadline = 0.0
+        self.first = True
+
+    def take(self) -> Dict[str, Any]:
+        ev = {"type": "token", "delta": "".join(self.parts)}
+        self.parts.clear()
+        self.size = 0
+        return ev
+
+    def due(self) -> bool:
+        return bool(self.parts) and anyio.current_time() >= self.deadline
+
+    def push(self, ev: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """收一条事件，返回此刻应发出的帧（按顺序）。"""
+        if ev.get("type") == "token" and set(ev) <= {"type", "delta"}:
+            if self.first:
+                self.first = False
+                return [ev]
+            delta = ev.get("delta") or ""
+            if not self.parts:
+                self.deadline = anyio.current_time() + self.max_delay_s
+            self.parts.append(delta)
+            self.size += len(delta.encode("utf-8"))
+            return [self.take()] if self.size >= self.max_bytes or self.due() else []
+        return ([self.take()] if self.parts else []) + [ev]
+
+
+async def coalesce_tokens(
+    gen: AsyncGenerator[Dict[str, Any], None],
+    *,
+    max_delay_s: float = COALESCE_MAX_DELAY_S,
+    max_bytes: int = COALESCE_MAX_BYTES,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    async with aclosing(gen):
+        if max_delay_s <= 0:
+            async for ev in gen:
+                yield ev
+            return
+        buf = _Buffer(max_delay_s, max_bytes)
+        async for ev in gen:
+            for out in buf.push(ev):
+                yield out
+        if buf.parts:
+            yield buf.take()
+
+
+async def pump(gen: AsyncGenerator[Dict[str, Any], None], send: ObjectSendStream):
+    """把生成器的事件灌进通道（放在调用方的任务组里跑），结束或出错时关闭通道与生成器；消费端先关闭时静默收尾。"""
+    async with send, aclosing(gen):
+        try:
+            async for ev in gen:
+                await send.send(ev)
+        except anyio.BrokenResourceError:
+            pass
+
+
+async def coalesce_stream(
+    recv: ObjectReceiveStream,
+    *,
+    max_delay_s: float = COALESCE_MAX_DELAY_S,
+    max_bytes: int = COALESCE_MAX_BYTES,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    async with recv:
+        if max_delay_s <= 0:
+            async for ev in recv:
+                yield ev
+            return
+        buf = _Buffer(max_delay_s, max_bytes)
+        while True:
+            ev: Optional[Dict[str, Any]] = None
+            try:
+                if buf.parts:
+                    with anyio.move_on_after(max(0.0, buf.deadline - anyio.current_time())):
+                        ev = await recv.receive()
+                    if ev is None:  # 到达延迟上限
+                        yield buf.take()
+                        continue
+                else:
+                    ev = await recv.receive()
+            except anyio.EndOfStream:
+                break
+            for out in buf.push(ev):
+                yield out
+        if buf.parts:
+            yield buf.take()
+
+
+async def coalesce_into(
+    gen: AsyncGenerator[Dict[str, Any], None],
+    emit: Callable[[Dict[str, Any]], Awaitable[None]],
+    *,
+    max_delay_s: float = COALESCE_MAX_DELAY_S,
+    max_bytes: int = COALESCE_MAX_BYTES,
+):
+    """pump + coalesce_stream：按时延上限合帧后逐帧 emit；被取消或 emit 出错时关闭上游生成器。"""
+    send, recv = anyio.create_memory_object_stream(64)
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(pump, gen, send)
+        async with aclosing(coalesce_stream(recv, max_delay_s=max_delay_s, max_bytes=max_bytes)) as frames:
+            async for ev in frames:
+                await emit(ev)
@@ -0,0 +1,124 @@
+
+# app/state.py
+"""
+对话级流程状态（附近/POI 消歧），替代进程全局的 LAST_POI_STATE。
+- 以 conversation/session id 为 key，分片存储（每片独立锁），减少并发争用
+- 每条记录有独立 TTL；访问时按轮转顺序顺带清扫一个分片，无需后台任务
+- 没有对话 id 时不读写状态（入口总会分配 id）：匿名调用之间互不覆盖候选/选中
+"""
+from __future__ import annotations
+import threading
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+FLOW_TTL_S = 90  # 绑定生存期（秒），够用户补一句“选1/半径1公里”之类
+
+
+class ShardedTTLStore:
+    """key -> value，按 hash(key) 分片；每条记录独立过期时间。"""
+
+    def __init__(self, *, ttl_s: float, shards: int = 16, sweep_interval_s: float = 5.0):
+        self.ttl_s = float(ttl_s)
+        self.sweep_interval_s = float(sweep_interval_s)
+        self._shards: List[Tuple[threading.Lock, Dict[str, Tuple[Any, float]]]] = [
+            (threading.Lock(), {}) for _ in range(max(1, int(shards)))
+        ]
+        self._sweep_lock = threading.Lock()
+        self._next_sweep_at = 0.0
+        self._sweep_cursor = 0
+
+    def _shard(self, key: str):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _maybe_sweep(self, now: float):
+        """到点就清扫下一个分片（摊还到正常访问里）。"""
+        if now < self._next_sweep_at or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep_at = now + self.sweep_interval_s / len(self._shards)
+            self._sweep_cursor = (self._sweep_cursor + 1) % len(self._shards)
+            lock, data = self._shards[self._sweep_cursor]
+            with lock:
+                for k in [k for k, (_, exp) in data.items() if exp <= now]:
+                    del data[k]
+        finally:
+            self._sweep_lock.release()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time()
+        self._maybe_sweep(now)
+        lock, data = self._shard(key)
+        with lock:
+            rec = data.get(key)
+            if not rec:
+                return None
+            if rec[1] <= now:
+                del data[key]
+                return None
+            return rec[0]
+
+    def set(self, key: str, value: Any, ttl_s: Optional[float] = None):
+        now = time()
+        self._maybe_sweep(now)
+        lock, data = self._shard(key)
+        with lock:
+            data[key] = (value, now + (self.ttl_s if ttl_s is None else float(ttl_s)))
+
+    def delete(self, key: str):
+        lock, data = self._shard(key)
+        with lock:
+            data.pop(key, None)
+
+    def sweep(self) -> int:
+        """全量清扫，返回清理数量。"""
+        now, n = time(), 0
+        for lock, data in self._shards:
+            with lock:
+                expired = [k for k, (_, exp) in data.items() if exp <= now]
+                for k in expired:
+                    del data[k]
+                n += len(expired)
+        return n
+
+    def __len__(self) -> int:
+        return sum(len(data) for _, data in self._shards)
+
+
+# ===== 附近流程状态 =====
+
+FLOWS = ShardedTTLStore(ttl_s=FLOW_TTL_S, shards=16)
+
+
+def _empty_flow() -> Dict[str, Any]:
+    return {
+        "candidates": [],     # 上次产生的候选（多选时）
+        "selected": None,     # 已选中的 POI（唯一或用户选择）
+        "city_hint": None,
+        "created_at": 0.0,
+    }
+
+
+def get_flow(conversation_id: Optional[str] = None) -> Dict[str, Any]:
+    """返回该对话的流程状态副本；过期、不存在或没有对话 id 时返回空状态（不落库）。"""
+    st = FLOWS.get(conversation_id) if conversation_id else None
+    return dict(st) if st else _empty_flow()
+
+
+def update_flow(conversation_id: Optional[str] = None, **fields) -> Dict[str, Any]:
+    """合并字段并刷新 created_at / TTL；没有对话 id 时只返回合并结果，不保存。"""
+    st = get_flow(conversation_id)
+    st.update(fields)
+    st["created_at"] = time()
+    if conversation_id:
+        FLOWS.set(conversation_id, st)
+    return st
+
+
+def _flow_expired(conversation_id: Optional[str] = None) -> bool:
+    ts = get_flow(conversation_id).get("created_at") or 0.0
+    return (time() - ts) > FLOW_TTL_S
+
+
+def _clear_flow(conversation_id: Optional[str] = None):
+    if conversation_id:
+        FLOWS.delete(conversation_id)
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+
+from app.agent_pool import AgentPool
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+class FakeAgent:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay, self.fail, self.calls = delay, fail, []
+
+    async def invoke_async(self, prompt):
+        self.calls.append(prompt)
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("agent failed")
+        return f"re:{prompt}"
+
+
+async def test_sessions_isolated():
+    made = []
+    pool = AgentPool(lambda: made.append(FakeAgent()) or made[-1])
+    assert await pool.run("a", "x") == "re:x"
+    assert await pool.run("b", "y") == "re:y"
+    assert await pool.run("a", "z") == "re:z"
+    assert len(made) == 2 and made[0].calls == ["x", "z"]
+
+
+async def test_queued_caller_gets_fresh_agent_after_failure():
+    made = []
+
+    def factory():
+        made.append(FakeAgent(delay=0.05, fail=not made))   # 第一个 Agent 会失败
+        return made[-1]
+
+    pool = AgentPool(factory)
+    first = asyncio.create_task(pool.run("s", "one"))
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(pool.run("s", "two"))
+    with pytest.raises(RuntimeError):
+        await first
+    assert await second == "re:two"
+    assert made[0].calls == ["one"] and made[1].calls == ["two"]
+
+
+async def test_timeout_covers_lock_wait():
+    pool = AgentPool(lambda: FakeAgent(delay=0.3))
+    busy = asyncio.create_task(pool.run("s", "long"))
+    await asyncio.sleep(0.01)
+    t0 = asyncio.get_running_loop().time()
+    with pytest.raises(TimeoutError):
+        await pool.run("s", "queued", timeout_s=0.05)
+    assert asyncio.get_running_loop().time() - t0 < 0.2
+    assert await busy == "re:long"
+
+
+async def test_hard_cap_when_every_agent_is_busy():
+    made = []
+    pool = AgentPool(lambda: made.append(FakeAgent(delay=0.1)) or made[-1], max_agents=2)
+    busy = [asyncio.create_task(pool.run(s, "long")) for s in ("a", "b")]
+    await asyncio.sleep(0.01)
+    with pytest.raises(TimeoutError):
+        await pool.run("c", "x", timeout_s=0.03)   # 全忙：排队等空位，超时照常生效
+    assert pool.stats()["agents"] == 2 and pool.stats()["waiting"] == 0 and len(made) == 2
+    waiting = asyncio.create_task(pool.run("c", "x"))
+    await asyncio.sleep(0.01)
+    assert pool.stats()["waiting"] == 1 and pool.stats()["agents"] == 2
+    assert await asyncio.gather(*busy) == ["re:long", "re:long"]
+    assert await waiting == "re:x"
+    assert pool.stats()["agents"] == 2 and len(made) == 3 and "c" in pool._slots
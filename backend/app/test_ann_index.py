@@ -0,0 +1,53 @@
+import numpy as np
+
+from app import ann_index
+from app.router_embed import Intent
+
+
+def _unit(n, dim=32, seed=0):
+    x = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_ivf_full_probe_matches_exact():
+    x = _unit(2000)
+    exact, ivf = ann_index.ExactIndex(x), ann_index.IVFIndex(x, nlist=16)
+    for q in _unit(20, seed=1):
+        rows, sims = exact.search(q, 10)
+        rows2, sims2 = ivf.search(q, 10, nprobe=ivf.nlist)
+        assert rows.tolist() == rows2.tolist() and np.allclose(sims, sims2)
+
+
+def test_ivf_reuses_centroids_without_copying_matrix():
+    x = _unit(1000)
+    ivf = ann_index.IVFIndex(x, nlist=8)
+    again = ann_index.IVFIndex(x, centroids=ivf.centroids, assignment=ann_index.assign(x, ivf.centroids))
+    assert again.matrix is x and again.nlist == 8
+    assert sorted(again._rows.tolist()) == list(range(1000))
+
+
+def _intent(name, k):
+    return Intent(name=name, examples=[f"{name} 示例 {i}" for i in range(k)], handler=lambda t, **kw: name)
+
+
+def test_router_ivf_trains_in_background_and_updates_incrementally(embed_router, monkeypatch):
+    monkeypatch.setattr(ann_index, "ANN_BACKEND", "ivf")
+    monkeypatch.setattr(ann_index, "ANN_MIN_ROWS", 50)
+    er = embed_router
+    er.add_intents([_intent(f"i{j}", 10) for j in range(8)])        # 80 行：触发后台训练
+    er._ann_thread.join(10)
+    index = er._snapshot[4]
+    assert isinstance(index, ann_index.IVFIndex) and er._trained_n == 80
+    centroids = er._centroids
+
+    er.add_intent(_intent("extra", 5))                                # 未翻倍：复用质心，只给新行分簇
+    assert er._centroids is centroids and len(er._assign) == er._n == 85
+    assert isinstance(er._snapshot[4], ann_index.IVFIndex) and er._snapshot[4] is not index
+    er.remove_intent("i0")
+    assert er._centroids is centroids and len(er._assign) == er._n == 75
+    assert er._match_intent("extra 示例 3")[0].name == "extra"
+
+    er.add_intents([_intent(f"big{j}", 10) for j in range(12)])      # 翻倍：锁内不训练，后台重训后换入
+    er._ann_thread.join(10)
+    assert er._trained_n == er._n == 195 and er._centroids is not centroids
+    assert er._match_intent("big7 示例 2")[0].name == "big7"
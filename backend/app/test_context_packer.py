@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from app import context_packer
+from app.context_packer import estimate_tokens, pack_json_rows, pack_md_table
+from app.main import NEARBY_REP_FIELDS, NEARBY_REP_PRIORITY, TOPK_COLUMNS, TOPK_PRIORITY
+
+NAME = "朝阳门外大街东侧综合楼顶基站"
+
+
+def _topk(n, name_repeat):
+    return [{"id": f"BJ-{i:04d}", "name": NAME * name_repeat, "city": "北京", "vendor": "华为技术有限公司",
+             "band": "n78/n41/n1", "status": "在线", "lat": 39.912345 + i, "lng": 116.412345} for i in range(n)]
+
+
+def _reps(n, name_repeat):
+    return [{"id": f"BJ-{i:04d}", "name": NAME * name_repeat, "vendor": "华为技术有限公司", "band": "n78/n41",
+             "status": "在线", "_dist_m": 100 + i, "lat": 39.912345, "lng": 116.412345} for i in range(n)]
+
+
+def _drop_order(priority, fields):
+    """文档约定的舍弃顺序：按重要性从低到高。"""
+    return [f for f in reversed(priority) if f in fields]
+
+
+@pytest.mark.parametrize("name_repeat", [5, 7])
+def test_topk_table_over_budget_is_trimmed_in_priority_order(name_repeat):
+    rows = _topk(24, name_repeat)
+    full = pack_md_table(rows, TOPK_COLUMNS, priority=TOPK_PRIORITY, budget=10 ** 6)
+    assert full.tokens > context_packer.TOPK_CONTEXT_BUDGET == 320
+    p = pack_md_table(rows, TOPK_COLUMNS, priority=TOPK_PRIORITY)
+    assert p.budget == 320 and p.tokens <= 320 and p.tokens == estimate_tokens(p.text)
+    assert p.dropped_fields and p.dropped_fields == _drop_order(TOPK_PRIORITY, TOPK_PRIORITY)[:len(p.dropped_fields)]
+    assert p.fields == [k for k, _ in TOPK_COLUMNS if k not in p.dropped_fields]     # 展示顺序不变
+    assert len(p.rows) >= context_packer.MIN_ROWS and p.rows == rows[:len(p.rows)]
+    head, _, *lines = p.text.splitlines()
+    assert head == "| " + " | ".join(dict(TOPK_COLUMNS)[k] for k in p.fields) + " |"
+    assert len(lines) == len(p.rows) and all(str(rows[0]["lng"]) not in line for line in lines)
+
+
+@pytest.mark.parametrize("name_repeat", [3, 5])
+def test_nearby_block_over_budget_is_trimmed_in_priority_order(name_repeat):
+    reps = _reps(30, name_repeat)
+    full = pack_json_rows(reps, NEARBY_REP_FIELDS, priority=NEARBY_REP_PRIORITY, budget=10 ** 6)
+    assert full.tokens > context_packer.NEARBY_CONTEXT_BUDGET == 240
+    p = pack_json_rows(reps, NEARBY_REP_FIELDS, priority=NEARBY_REP_PRIORITY)
+    assert p.budget == 240 and p.tokens <= 240
+    assert p.dropped_fields == _drop_order(NEARBY_REP_PRIORITY, NEARBY_REP_FIELDS)[:len(p.dropped_fields)]
+    assert p.dropped_fields[:2] == ["lng", "lat"]
+    assert len(p.rows) >= context_packer.MIN_ROWS
+    assert json.loads(p.text) == p.rows and all(list(r) == p.fields for r in p.rows)
+
+
+def test_essential_fields_never_dropped():
+    p = pack_md_table(_topk(5, 40), TOPK_COLUMNS, priority=TOPK_PRIORITY)
+    assert p.fields == ["id", "name"] and p.dropped_fields == _drop_order(TOPK_PRIORITY, TOPK_PRIORITY)[:-2]
+    q = pack_json_rows(_reps(5, 40), NEARBY_REP_FIELDS, priority=NEARBY_REP_PRIORITY, budget=10)
+    assert q.fields == ["id", "name"] and q.rows == [] and q.text == ""     # 一行都放不下也不丢 id/name
+
+
+def test_fits_without_trimming():
+    rows = _topk(3, 1)
+    p = pack_md_table(rows, TOPK_COLUMNS, priority=TOPK_PRIORITY)
+    assert p.dropped_fields == [] and p.rows == rows and p.total_rows == 3
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import conversations, db_json, main
+from app.session_store import SessionStore
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    monkeypatch.setattr(conversations, "CONVERSATIONS", SessionStore(ttl_s=60))
+
+
+def _events(resp):
+    return [json.loads(line[len("data: "):]) for line in resp.text.splitlines() if line.startswith("data: ")]
+
+
+def test_selected_station_derived_on_write():
+    conversations.append("c1", "assistant", "已选中基站【甲】（BJS-001）")
+    conversations.append("c1", "assistant", "已选中基站，但没有编号")      # 解析不到 ID：不改
+    assert conversations.selected_station_id("c1") == "BJS-001"
+    conversations.append("c1", "assistant", "已选中基站【乙】（SHS-002）")
+    assert conversations.selected_station_id("c1") == "SHS-002"
+    assert [m["role"] for m in conversations.history("c1")] == ["assistant"] * 3
+
+
+def test_second_turn_resolves_cached_station_without_history(monkeypatch):
+    async def fake_llm(prompt, **kw):
+        yield {"type": "token", "delta": "你好，请问要查哪个基站？"}
+
+    monkeypatch.setattr(main, "llm_events", fake_llm)
+    st = db_json.load_all()[0]
+    client = TestClient(main.app)
+
+    first = client.post("/api/chat/stream", json={"message": "你好"})
+    cid = first.headers["x-conversation-id"]
+    assert _events(first)[0] == {"type": "start", "conversation_id": cid}
+    # 客户端在地图上选站后把本地提示补记到服务端
+    client.post(f"/api/conversations/{cid}/messages",
+                json={"role": "assistant", "content": f"已选中基站【{st['name']}】（{st['id']}）"})
+
+    second = client.post("/api/chat/stream", json={"conversation_id": cid, "message": "这个基站现在什么状态？"})
+    logs = [ev["message"] for ev in _events(second) if ev["type"] == "log"]
+    assert f"对话记录确认最新选中：{st['name']}（{st['id']}）" in logs
+    history = conversations.history(cid)
+    assert [m["role"] for m in history] == ["user", "assistant", "assistant", "user", "assistant"]
+    assert history[0]["content"] == "你好" and history[3]["content"] == "这个基站现在什么状态？"
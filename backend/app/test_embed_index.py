@@ -0,0 +1,80 @@
+import pytest
+
+from app import embed_index
+from app.conftest import StubSentenceTransformer
+from app.embed_index import EmbeddingIndex
+
+STATIONS = [
+    {"id": "BJ-001", "name": "朝阳门基站", "city": "北京", "vendor": "华为", "band": "n78"},
+    {"id": "SH-001", "name": "陆家嘴基站", "city": "上海", "vendor": "中兴", "band": "n41"},
+    {"id": "GZ-001", "name": "天河基站", "city": "广州", "vendor": "爱立信", "band": "n1"},
+]
+POIS = [{"id": "P1", "name": "外滩", "city": "上海", "district": "黄浦", "category": "景点"}]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    """磁盘在 tmp_path、编码器为假模型的索引，替换模块级 INDEX，状态为已同步。"""
+    idx = EmbeddingIndex(str(tmp_path), model_name="stub-model", encoder=StubSentenceTransformer().encode)
+    idx.sync(embed_index.records(STATIONS, POIS))
+    monkeypatch.setattr(embed_index, "INDEX", idx)
+    for key, value in {"loaded": True, "synced_version": "v1", "running": False,
+                       "disabled": None, "error": None, "failed_at": 0.0}.items():
+        monkeypatch.setitem(embed_index._STATE, key, value)
+    return idx
+
+
+def test_search_ranks_closest_record_first(index):
+    hits = index.search(embed_index.station_text(STATIONS[1]), k=3, min_score=-1.0)
+    assert hits[0][1] == "station:SH-001" and hits[0][0] == pytest.approx(1.0, abs=1e-5)
+    assert [s for s, _ in hits] == sorted((s for s, _ in hits), reverse=True)
+    poi_hits = embed_index.search(embed_index.poi_text(POIS[0]), k=5, kind="poi")
+    assert [key for _, key in poi_hits] == ["poi:P1"]
+
+
+def test_int8_index_keeps_ranking(tmp_path):
+    idx = EmbeddingIndex(str(tmp_path), model_name="stub-model", dtype="int8",
+                         encoder=StubSentenceTransformer().encode)
+    idx.sync(embed_index.records(STATIONS, POIS))
+    assert idx.search(embed_index.station_text(STATIONS[2]), k=1)[0][1] == "station:GZ-001"
+
+
+def test_semantic_context_ranks_and_skips_refresh_when_version_unchanged(index, monkeypatch):
+    from app import main
+    refreshes = []
+    monkeypatch.setattr(main.db_json, "version", lambda: "v1")
+    monkeypatch.setattr(main.db_json, "get_station", lambda rid: next(s for s in STATIONS if s["id"] == rid))
+    monkeypatch.setattr(main, "refresh_embed_index", lambda version=None: refreshes.append(version))
+    stations, pois = main.semantic_context_for_prompt(embed_index.station_text(STATIONS[0]), k=1)
+    assert [s["id"] for s in stations] == ["BJ-001"] and pois == []
+    assert refreshes == []                 # 版本没变：不再每个问题都触发同步
+    monkeypatch.setattr(main.db_json, "version", lambda: "v2")
+    main.semantic_context_for_prompt("朝阳门", k=1)
+    assert refreshes == ["v2"]
+
+
+def test_search_failure_falls_back_to_empty(index, monkeypatch):
+    from app import main
+
+    def boom(_):
+        raise RuntimeError("cuda oom")
+
+    index._encoder = boom
+    monkeypatch.setattr(main, "refresh_embed_index", lambda version=None: False)
+    assert main.semantic_context_for_prompt("朝阳门基站") == ([], [])
+    assert embed_index.status()["error"] == "RuntimeError: cuda oom"
+    index._encoder = StubSentenceTransformer().encode
+    assert embed_index.search("朝阳门基站") == []     # 退避期内不再重试，直接走 BM25
+
+
+def test_missing_dependency_disables_index(index, monkeypatch):
+    index._encoder = None
+    monkeypatch.setitem(embed_index._STATE, "synced_version", None)
+
+    def no_st(*a, **kw):
+        raise ImportError("No module named 'sentence_transformers'")
+
+    monkeypatch.setattr(index, "ensure_encoder", no_st)
+    embed_index._sync("v1", lambda: [])
+    assert embed_index.status()["disabled"] and embed_index.is_current("v9")
+    assert embed_index.search("朝阳门基站") == [] and not embed_index.refresh_async("v9", list)
@@ -0,0 +1,46 @@
+import pytest
+
+from app import main
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def _fake_ollama(parts, *, done):
+    async def gen(prompt, *, context=None, on_context=None, on_done=None):
+        for p in parts:
+            yield p
+        if done and on_done:
+            on_done()
+    return gen
+
+
+async def _run(prompt):
+    return [ev async for ev in main.stream_explanation(prompt)]
+
+
+@pytest.mark.parametrize("parts, done, cached", [
+    (["图表", "显示…"], True, True),
+    (["图表", "显示…"], False, False),    # 响应体中途结束，没有 done:true
+    ([], True, False),                   # 空回答
+    (["  "], True, False),
+])
+async def test_cache_only_complete_answers(monkeypatch, parts, done, cached):
+    prompt = f"解读图表 {parts} {done}"
+    monkeypatch.setattr(main, "stream_from_ollama", _fake_ollama(parts, done=done))
+    evs = await _run(prompt)
+    assert [e["delta"] for e in evs if e["type"] == "token"] == parts
+    assert (main.EXPLAIN_CACHE.get(main._explain_key(prompt)) is not None) == cached
+
+
+async def test_cached_answer_replayed(monkeypatch):
+    prompt = "解读图表 回放"
+    monkeypatch.setattr(main, "stream_from_ollama", _fake_ollama(["a", "b"], done=True))
+    await _run(prompt)
+    monkeypatch.setattr(main, "stream_from_ollama", _fake_ollama(["x"], done=True))
+    evs = await _run(prompt)
+    assert evs[0]["type"] == "log" and [e["delta"] for e in evs[1:]] == ["a", "b"]
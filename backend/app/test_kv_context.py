@@ -0,0 +1,64 @@
+import pytest
+
+from app import kv_context
+from app.session_store import SessionStore
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def stores(monkeypatch):
+    monkeypatch.setattr(kv_context, "KV_CONTEXTS", SessionStore(ttl_s=60, max_entries=4))
+    monkeypatch.setattr(kv_context, "KV_PROBATION", SessionStore(ttl_s=60, max_entries=2))
+
+
+def test_follow_up_reuses_and_promotes():
+    kv_context.remember("c1", "fallback", "guard", [1, 2, 3], model="m1")
+    assert "c1|fallback" in kv_context.KV_PROBATION and "c1|fallback" not in kv_context.KV_CONTEXTS
+    assert kv_context.lookup("c1", "fallback", "guard", model="m1") == [1, 2, 3]
+    assert "c1|fallback" in kv_context.KV_CONTEXTS and "c1|fallback" not in kv_context.KV_PROBATION
+    kv_context.remember("c1", "fallback", "guard", [1, 2, 3, 4], model="m1")
+    assert kv_context.KV_CONTEXTS.get("c1|fallback")["context"] == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("prefix, model", [("guard v2", "m1"), ("guard", "m2")])
+def test_prefix_or_model_change_invalidates(prefix, model):
+    kv_context.remember("c1", "fallback", "guard", [1, 2, 3], model="m1")
+    assert kv_context.lookup("c1", "fallback", prefix, model=model) is None
+
+
+def test_one_shot_ids_do_not_evict_live_conversations():
+    kv_context.remember("live", "fallback", "guard", [1], model="m1")
+    kv_context.lookup("live", "fallback", "guard", model="m1")          # 第二轮：转正
+    for i in range(20):
+        kv_context.remember(f"anon{i}", "fallback", "guard", [i], model="m1")
+    assert len(kv_context.KV_CONTEXTS) == 1 and len(kv_context.KV_PROBATION) == 2
+    assert kv_context.lookup("live", "fallback", "guard", model="m1") == [1]
+
+
+async def test_follow_up_turn_sends_only_the_turn_message(monkeypatch):
+    from app import main
+    calls = []
+
+    async def fake_llm_events(prompt, *, priority, context=None, on_context=None, on_done=None):
+        calls.append((prompt, context))
+        on_context([len(calls)] * 3)
+        yield {"type": "token", "delta": "ok"}
+
+    monkeypatch.setattr(main, "llm_events", fake_llm_events)
+
+    async def turn(question):
+        return [ev async for ev in main.llm_events_with_kv("GUARD\n", question, conversation_id="c1",
+                                                           channel="fallback")]
+
+    await turn("TopK A\nQ1")
+    await turn("TopK B\nQ2")        # TopK 变了不影响续用：它在本轮消息里，不在前缀里
+    assert calls == [("GUARD\nTopK A\nQ1", None), ("TopK B\nQ2", [1, 1, 1])]
+    monkeypatch.setattr(main, "OLLAMA_MODEL_ID", "other-model")
+    await turn("Q3")
+    assert calls[-1] == ("GUARD\nQ3", None)
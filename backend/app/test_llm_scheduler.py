@@ -0,0 +1,91 @@
+import anyio
+import pytest
+
+from app.llm_scheduler import PRIORITY_LONG, PRIORITY_SHORT, GenerationScheduler, QueueFull
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+async def _wait(ticket, positions=None, admitted=None, name=None):
+    async for pos in ticket.wait():
+        if positions is not None:
+            positions.append(pos)
+    if admitted is not None:
+        admitted.append(name)
+
+
+async def test_priority_order_under_saturation():
+    sched = GenerationScheduler(max_concurrent=1, max_queue=8)
+    running = sched.enqueue(PRIORITY_LONG)
+    assert running.admitted
+    tickets = {"long1": sched.enqueue(PRIORITY_LONG), "short": sched.enqueue(PRIORITY_SHORT),
+               "long2": sched.enqueue(PRIORITY_LONG)}
+    admitted = []
+    async with anyio.create_task_group() as tg:
+        for name, t in tickets.items():
+            tg.start_soon(_wait, t, None, admitted, name)
+        await anyio.sleep(0.01)
+        assert admitted == [] and sched.stats()["queued"] == 3
+        running.release()
+        for name in ("short", "long1", "long2"):   # 短回答插到前面；同优先级先来先服务
+            await anyio.sleep(0.01)
+            assert admitted[-1] == name and sched.stats()["active"] == 1
+            tickets[name].release()
+    assert sched.stats() == {"active": 0, "queued": 0, "max_concurrent": 1, "max_queue": 8}
+
+
+async def test_queue_full_rejected():
+    sched = GenerationScheduler(max_concurrent=1, max_queue=1)
+    first = sched.enqueue()
+    queued = sched.enqueue()
+    with pytest.raises(QueueFull):
+        sched.enqueue(PRIORITY_SHORT)
+    assert sched.stats()["queued"] == 1
+    first.release()
+    assert queued.admitted
+    sched.enqueue().release()   # 腾出队位后又能排进去
+
+
+async def test_cancelled_waiter_leaves_heap_without_leaking_slot():
+    sched = GenerationScheduler(max_concurrent=1, max_queue=4)
+    running = sched.enqueue()
+
+    async def waiter(t):
+        try:
+            await _wait(t)
+        finally:
+            t.release()
+
+    t = sched.enqueue()
+    with anyio.move_on_after(0.02):
+        await waiter(t)
+    assert sched.stats()["queued"] == 0 and sched.stats()["active"] == 1
+    running.release()
+    assert sched.stats()["active"] == 0 and not t.admitted
+    nxt = sched.enqueue()
+    assert nxt.admitted
+    t.release()                 # 重复释放无副作用
+    assert sched.stats()["active"] == 1
+
+
+async def test_position_updates():
+    sched = GenerationScheduler(max_concurrent=1, max_queue=4)
+    running = sched.enqueue()
+    waiting = sched.enqueue(PRIORITY_LONG)
+    positions = []
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(_wait, waiting, positions)
+        await anyio.sleep(0.01)
+        short = sched.enqueue(PRIORITY_SHORT)   # 插队：waiting 后移一位
+        await anyio.sleep(0.01)
+        running.release()                       # short 放行，waiting 回到第 1 位
+        await anyio.sleep(0.01)
+        assert short.admitted and not waiting.admitted
+        short.release()
+    assert positions == [1, 2, 1] and waiting.admitted
+    waiting.release()
@@ -0,0 +1,38 @@
+import json
+
+import anyio
+from fastapi.testclient import TestClient
+
+from app import main, metrics
+
+
+def test_rate_histogram_uses_rate_buckets():
+    metrics.observe("test_rate", 12.5, buckets=metrics.RATE_BUCKETS)
+    metrics.observe("test_rate", 45.0)
+    h = metrics.snapshot()["histograms"]["test_rate"]
+    assert h["buckets"] == {"le_15": 1, "le_60": 1} and h["p50"] == 15
+
+
+def test_metrics_after_traced_request(monkeypatch):
+    async def fake_ollama(prompt, *, context=None, on_context=None, on_done=None):
+        for d in ("北京", "的", "基站"):
+            await anyio.sleep(0.01)
+            yield d
+        if on_done:
+            on_done()
+
+    monkeypatch.setattr(main, "stream_from_ollama", fake_ollama)
+    client = TestClient(main.app)
+    before = client.get("/metrics").json()["histograms"].get("llm_tokens_per_s", {"count": 0, "buckets": {}})
+    resp = client.post("/api/chat/stream", json={"message": "随便聊聊", "context": {"trace": True}})
+    events = [json.loads(line[6:]) for line in resp.text.splitlines() if line.startswith("data: ")]
+    stages = {ev["span"]["stage"] for ev in events if ev.get("channel") == "trace"}
+    assert {"queue_wait", "llm_ttft", "llm_total", "total"} <= stages
+
+    snap = client.get("/metrics").json()
+    tps = snap["histograms"]["llm_tokens_per_s"]
+    assert tps["count"] == before["count"] + 1
+    new = [k for k, c in tps["buckets"].items() if c > before["buckets"].get(k, 0)]
+    assert len(new) == 1 and new[0] in {f"le_{b:g}" for b in metrics.RATE_BUCKETS if 10 <= b <= 200}   # 3 个 token / 约 20ms
+    assert snap["histograms"]["stage_llm_ttft_ms"]["count"] >= 1
+    assert snap["llm_scheduler"]["active"] == 0
@@ -0,0 +1,127 @@
+import base64
+import json
+
+import pytest
+
+from app import db_json, main
+
+
+def _token(obj) -> str:
+    raw = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+@pytest.fixture
+def stations(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_json, "STORE_PATH", str(tmp_path / "stations.json"))
+    rows = [{"id": f"BJS-{i:03d}", "name": f"站{i}", "city": "北京", "vendor": "华为", "band": "n78",
+             "status": "维护" if i % 3 == 0 else "在线", "updated_at": 1000 + i // 2}
+            for i in range(25)]
+    rows.append({"id": "SHS-001", "name": "沪站", "city": "上海", "status": "在线", "updated_at": 5})
+    db_json.replace_all(rows)
+    return rows
+
+
+def test_cursor_roundtrip():
+    tok = main.encode_report_cursor("北京", "维护", (-1003, "BJS-006"), 7)
+    assert main.decode_report_cursor(tok) == {"city": "北京", "status": "维护", "after": (-1003, "BJS-006"), "shown": 7}
+
+
+@pytest.mark.parametrize("obj", [
+    {"c": "北京", "a": ["x", "y"]},
+    {"c": "北京", "a": [1]},
+    {"c": "北京", "a": [1, 2]},
+    {"c": "北京", "a": [True, "x"]},
+    {"c": 1, "a": [1, "x"]},
+    {"c": "北京", "s": ["在线"], "a": [1, "x"]},
+    {"c": "北京", "a": [1, "x"], "n": "3"},
+    ["北京"],
+])
+def test_malformed_cursor_rejected(obj):
+    assert main.decode_report_cursor(_token(obj)) is None
+
+
+def test_garbage_token_rejected():
+    assert main.decode_report_cursor("not-a-cursor!!") is None
+
+
+def _page(city, status, after=None, shown=0, page_rows=4):
+    page = {}
+    text = "".join(main.iter_city_report(city, status, after=after, shown=shown, page=page,
+                                        page_rows=page_rows, chunk_rows=3))
+    ids = [line.split(" | ")[0][2:] for line in text.splitlines() if line.startswith("| BJS-")]
+    return ids, page
+
+
+@pytest.mark.parametrize("status", [None, "维护"])
+def test_paging_covers_each_row_once(stations, status):
+    want = [s["id"] for s in sorted((s for s in stations if s["city"] == "北京"
+                                     and (status is None or s["status"] == status)), key=db_json.order_key)]
+    seen, after, shown = [], None, 0
+    while True:
+        ids, page = _page("北京", status, after, shown)
+        seen += ids
+        if not page["next"]:
+            break
+        cur = main.decode_report_cursor(page["next"])
+        after, shown = cur["after"], cur["shown"]
+        assert shown == len(seen)
+    assert seen == want and page["total"] == len(want)
+
+
+def test_paging_stable_under_concurrent_write(stations):
+    ids1, page = _page("北京", None)
+    cur = main.decode_report_cursor(page["next"])
+    db_json.upsert_station({"id": "BJS-024", "status": "在线", "updated_at": 1})   # 已读过的行移到末尾
+    ids2, _ = _page("北京", None, cur["after"], cur["shown"])
+    assert not set(ids1) & set(ids2) - {"BJS-024"}
+    assert ids2[0] not in ids1
+
+
+def test_cursor_kept_per_conversation(stations):
+    ctx = main.RouteCtx(prompt="北京有哪些基站", features=main.PromptFeatures("北京有哪些基站"),
+                        station=None, conversation_id="c-report")
+    main.REPORT_CURSORS.set(ctx.conversation_id, main.encode_report_cursor("北京", None, (-1012, "BJS-024"), 1))
+    assert main._pending_report(ctx) is None            # 不是“继续”
+    ctx = main.RouteCtx(prompt="继续", features=main.PromptFeatures("继续"), station=None, conversation_id="c-report")
+    assert main._pending_report(ctx)["after"] == (-1012, "BJS-024")
+    ctx.conversation_id = "c-new"
+    assert main._pending_report(ctx) is None            # 别的对话的游标不会被接上
+
+
+def test_warmup_failures_are_counted_and_logged(monkeypatch, caplog):
+    from app import metrics
+
+    def boom(city, status=None):
+        raise RuntimeError("stats broken")
+
+    monkeypatch.setattr(db_json, "city_stats", boom)
+    before = metrics.snapshot()["counters"].get("report_warmup_errors", 0)
+    main.warm_city_reports()
+    n = len(main.CITY_NAMES) * (1 + len(main.STATUS_ALIASES))
+    assert metrics.snapshot()["counters"]["report_warmup_errors"] - before == n
+    assert "report warmup failed" in caplog.text and "stats broken" in caplog.text
+
+
+def _rebuilt_views():
+    with db_json._LOCK:
+        patched = {c: (list(v["keys"]), [r["id"] for r in v["rows"]])
+                   for c, v in db_json._city_views()["by_city"].items()}
+        db_json._STATE["_views"] = None
+        rebuilt = {c: (list(v["keys"]), [r["id"] for r in v["rows"]])
+                   for c, v in db_json._city_views()["by_city"].items()}
+    return patched, rebuilt
+
+
+def test_writes_patch_only_the_affected_city(stations):
+    sh_stats = db_json.city_stats("上海")
+    bj_stats = db_json.city_stats("北京", "维护")
+    db_json.update_status("BJS-004", "维护", updated_at=2000)
+    assert db_json.city_stats("上海") is sh_stats          # 其它城市的统计缓存不动
+    assert db_json.city_stats("北京", "维护")["total"] == bj_stats["total"] + 1
+    db_json.upsert_station({"id": "BJS-007", "city": "上海", "updated_at": 1})   # 换城市
+    db_json.upsert_station({"id": "GZS-001", "city": "广州", "updated_at": 3})   # 新城市
+    db_json.bulk_upsert([{"id": "SHS-001", "city": "广州"}, {"id": "BJS-010", "updated_at": 999}])
+    assert db_json.city_stats("上海")["total"] == 1
+    patched, rebuilt = _rebuilt_views()
+    assert patched == rebuilt and "上海" in patched and set(patched["广州"][1]) == {"GZS-001", "SHS-001"}
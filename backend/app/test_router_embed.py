@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from app import ann_index
+from app.conftest import StubSentenceTransformer
+from app.embed_cache import EmbeddingCache
+from app.router_embed import EmbeddingRouter, Intent
+
+
+def _intent(name, k, *, tag="", patterns=()):
+    return Intent(name=name, examples=[f"{name}{tag} 示例 {i}" for i in range(k)],
+                  handler=lambda t, **kw: {"intent": name, **kw}, patterns=list(patterns))
+
+
+def _check(er):
+    """快照、行区间、行归属与矩阵内容彼此一致。"""
+    matrix, starts, names, _, _ = er._snapshot
+    assert len(er._emb_index_to_intent) == er._n
+    bounds = [0] + [x for span in sorted(er._spans.values()) for x in span] + [er._n]
+    assert bounds[::2] == bounds[1::2]                     # 区间首尾相接、铺满 [0, _n)
+    for name, (a, b) in er._spans.items():
+        assert er._emb_index_to_intent[a:b] == [name] * (b - a)
+        if b > a:
+            want = er.model.encode(er.intents[name].examples)
+            assert np.allclose(matrix[a:b], want, atol=1e-6)
+    live = sorted((a, n) for n, (a, b) in er._spans.items() if b > a)
+    assert starts.tolist() == [a for a, _ in live] and names == [n for _, n in live]
+    assert (matrix is None) == (er._n == 0)
+
+
+def test_add_update_remove(embed_router):
+    er = embed_router
+    er.add_intents([_intent("a", 3), _intent("b", 2), _intent("c", 4)])
+    _check(er)
+    assert er._spans == {"a": (0, 3), "b": (3, 5), "c": (5, 9)}
+
+    calls = len(er.model.calls)
+    er.add_intent(_intent("b", 3, tag="v2"))               # 更新：删旧行，新示例追加到尾部
+    _check(er)
+    assert er._spans == {"a": (0, 3), "c": (3, 7), "b": (7, 10)}
+    assert er.model.calls[calls] == 3                      # 只编码了新示例（_check 的调用在其后）
+    assert er._match_intent("bv2 示例 1")[0].name == "b"
+
+    assert er.remove_intent("a") and not er.remove_intent("a")
+    _check(er)
+    assert er._spans == {"c": (0, 4), "b": (4, 7)} and "a" not in er.intents
+    hit = er._match_intent("a 示例 0")[0]
+    assert hit is None or hit.name != "a"
+
+
+def test_zero_example_intent(embed_router):
+    er = embed_router
+    er.add_intents([_intent("empty", 0, patterns=[r"空"]), _intent("x", 2)])
+    _check(er)
+    assert er._spans["empty"] == (0, 0) and er._snapshot[2] == ["x"]
+    er.add_intent(_intent("empty", 2))                     # 后来补了示例
+    _check(er)
+    assert er._snapshot[2] == ["x", "empty"]
+    er.remove_intent("x")
+    er.add_intent(_intent("empty", 0))
+    _check(er)
+    assert er._n == 0 and er._snapshot[0] is None and er._match_intent("随便")[0] is None
+
+
+def test_buffer_regrowth_keeps_old_snapshot_valid(embed_router):
+    er = embed_router
+    er.add_intent(_intent("a", 40))
+    old_matrix, old_buf = er._snapshot[0], er._buf
+    frozen = old_matrix.copy()
+    er.add_intents([_intent(f"g{i}", 10) for i in range(10)])   # 140 行 > 初始容量 64
+    _check(er)
+    assert er._buf is not old_buf and len(er._buf) >= 140
+    er.remove_intent("a")                                      # 删除换新缓冲区
+    _check(er)
+    assert np.array_equal(old_matrix, frozen)                  # 进行中的匹配持有的旧视图不受影响
+
+
+def test_assign_tracks_rows(embed_router):
+    er = embed_router
+    er.add_intents([_intent(f"i{j}", 5) for j in range(6)])
+    er._centroids = ann_index.train_centroids(er._emb_matrix, 4)
+    er._assign = ann_index.assign(er._emb_matrix, er._centroids)
+    er.add_intent(_intent("i2", 7, tag="v2"))
+    er.remove_intent("i4")
+    er.add_intent(_intent("new", 3))
+    _check(er)
+    assert np.array_equal(er._assign, ann_index.assign(er._emb_matrix, er._centroids))
+
+
+def test_pending_until_warmup(stub_sentence_transformers, tmp_path):
+    er = EmbeddingRouter(model_name="stub-model")
+    er.cache = EmbeddingCache("stub-model", path=str(tmp_path))
+    try:
+        er.add_intents([_intent("near", 2, patterns=[r"附近"]), _intent("other", 2)])
+        assert er.model is None and er._n == 0 and set(er._pending) == {"near", "other"}
+        assert er._regex_route("西湖附近") == {"intent": "near"}
+        assert er.warmup() and er.status()["state"] == "ready"
+        _check(er)
+        assert not er._pending and er._n == 4
+    finally:
+        er.batcher.close()
+
+
+def test_cached_examples_not_reencoded(stub_sentence_transformers, tmp_path):
+    routers = []
+    try:
+        for _ in range(2):
+            er = EmbeddingRouter(model_name="stub-model")
+            er.cache = EmbeddingCache("stub-model", path=str(tmp_path))
+            er.add_intents([_intent("a", 5), _intent("b", 5)])
+            er.warmup()
+            routers.append(er)
+        assert sum(routers[0].model.calls) == 1 + 10      # 预热 1 条 + 示例 10 条
+        assert sum(routers[1].model.calls) == 1           # 第二次启动示例全命中磁盘缓存
+    finally:
+        for er in routers:
+            er.batcher.close()
+
+
+def test_cache_hits_survive_eviction_during_encode(tmp_path):
+    cache = EmbeddingCache("stub-model", path=str(tmp_path), max_entries=2)
+    enc = StubSentenceTransformer().encode
+    hit = cache.get_many(["a"], enc)[0]
+
+    def encode_while_evicting(xs):
+        cache.get_many(["x", "y"], enc)          # 另一路调用在编码期间把 "a" 淘汰
+        return enc(xs)
+
+    out = cache.get_many(["a", "b"], encode_while_evicting)
+    assert np.array_equal(out[0], hit) and np.array_equal(out[1], enc(["b"])[0])
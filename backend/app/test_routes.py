@@ -0,0 +1,46 @@
+import pytest
+
+from app import main
+from bench.bench_router import CORPUS, STATION, compiled_route, legacy_route
+
+
+CLASSIFIED = {"city_status", "chart_3d", "chart", "city_list"}
+
+
+def _ctx(prompt, station=None, cid="c-test"):
+    return main.RouteCtx(prompt=prompt, features=main.PromptFeatures(prompt), station=station, conversation_id=cid)
+
+
+@pytest.mark.parametrize("prompt", CORPUS)
+@pytest.mark.parametrize("station", [None, STATION])
+def test_candidate_routes_match_predicates(prompt, station):
+    ctx = _ctx(prompt, station)
+    want = [r for r in main.ROUTES if r.when(ctx)]
+    # 分类路由总有产出：只有第一个命中的会轮到，快路径只列它
+    first = next((r for r in want if r.name in CLASSIFIED), None)
+    assert list(main.candidate_routes(ctx)) == [r for r in want if r.name not in CLASSIFIED or r is first]
+
+
+@pytest.mark.parametrize("prompt", CORPUS)
+def test_same_decision_as_legacy_chain(prompt):
+    st = STATION if "它" in prompt or "这个站" in prompt else None
+    assert compiled_route(prompt, st) == legacy_route(prompt, st)
+
+
+@pytest.mark.parametrize("prompt, kind", [
+    ("上海几个是online的", "city_status"),
+    ("杭州 3D 密度", "chart_3d"),
+    ("北京 柱状图", "chart"),
+    ("广州基站清单", "city_list"),
+    ("国贸周边基站", None),
+])
+def test_kind(prompt, kind):
+    f = main.PromptFeatures(prompt)
+    assert f.kind == kind
+    assert f.poi_key is f.poi_key            # 惰性特征只算一次
+
+
+def test_continue_only_with_pending_cursor():
+    ctx = _ctx("继续", cid="c-no-cursor")
+    assert ctx.features.continue_req == (None,)
+    assert "report_continue" not in [r.name for r in main.candidate_routes(ctx)]
@@ -0,0 +1,58 @@
+import pytest
+
+from app import search_index
+from app.search_index import BM25Index, analyze
+
+
+def test_analyze_cjk_bigrams_and_ascii_parts():
+    assert analyze("地铁口附近") == ["地铁", "铁口", "口附", "附近"]
+    assert analyze("BJS-006 站") == ["bjs-006", "bjs", "006", "站"]
+
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(search_index, "RECENCY_WEIGHT", 0.0)
+    idx = BM25Index()
+    idx.rebuild([
+        {"id": "BJS-001", "name": "国贸站", "city": "北京", "desc": "地铁口附近，靠近商场"},
+        {"id": "BJS-002", "name": "地铁口站", "city": "北京", "desc": "东门"},
+        {"id": "SHS-001", "name": "外滩站", "city": "上海", "desc": "江边"},
+        {"id": "SHS-002", "name": "陆家嘴站", "city": "上海", "desc": "地铁 2 号线"},
+    ])
+    return idx
+
+
+def test_name_hits_outrank_description_hits(index):
+    ids = [sid for _, sid in index.search("地铁口")]
+    assert ids[:2] == ["BJS-002", "BJS-001"]
+
+
+def test_id_and_filters(index):
+    assert index.search("shs-002")[0][1] == "SHS-002"
+    assert [sid for _, sid in index.search("北京 上海", where=lambda sid: sid.startswith("SHS"))] == ["SHS-001", "SHS-002"]
+    assert index.search("没有的词") == []
+
+
+def test_require_phrase(index):
+    assert [sid for _, sid in index.search("地铁口", require_phrase=True)] == ["BJS-002", "BJS-001"]
+    assert index.search("铁口附", require_phrase=True)[0][1] == "BJS-001"
+    assert index.search("口地", require_phrase=True) == []
+
+
+def test_upsert_and_remove_update_postings(index):
+    index.upsert({"id": "SHS-001", "name": "外滩站", "city": "上海", "desc": "地铁口"})
+    assert "SHS-001" in [sid for _, sid in index.search("地铁口")]
+    index.remove("BJS-002")
+    ids = [sid for _, sid in index.search("地铁口")]
+    assert "BJS-002" not in ids and len(index) == 3
+    index.rebuild([])
+    assert index.search("地铁") == [] and index._total_len == 0 and not index._postings
+
+
+def test_recency_breaks_ties(monkeypatch):
+    monkeypatch.setattr(search_index, "RECENCY_WEIGHT", 0.3)
+    idx = BM25Index()
+    now = search_index.time()
+    idx.rebuild([{"id": "A", "name": "同名站", "updated_at": now - 30 * 86400},
+                 {"id": "B", "name": "同名站", "updated_at": now}])
+    assert [sid for _, sid in idx.search("同名站")] == ["B", "A"]
@@ -0,0 +1,134 @@
+import pytest
+
+from app import session_store
+from app.session_store import SessionStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(session_store, "time", lambda: now[0])
+    return now
+
+
+def test_lru_eviction_by_entries(clock):
+    s = SessionStore(ttl_s=60, max_entries=3)
+    for k in "abc":
+        s.set(k, k)
+    assert s.get("a") == "a"          # a 变成最近使用
+    s.set("d", "d")
+    assert [k for k, _ in s.items()] == ["c", "a", "d"] and "b" not in s
+
+
+def test_eviction_by_bytes_keeps_newest(clock):
+    s = SessionStore(ttl_s=60, max_entries=100, max_bytes=250)
+    s.set("a", "x" * 100)
+    s.set("b", "y" * 100)
+    assert len(s) == 2
+    s.set("c", "z" * 100)
+    assert "a" not in s and s.stats()["bytes"] <= 250
+    s.set("big", "w" * 1000)          # 单条超限：保留它自己
+    assert len(s) == 1 and s.get("big")
+
+
+def test_ttl_expiry_and_touch_on_read(clock):
+    s = SessionStore(ttl_s=10)
+    s.set("a", 1)
+    s.set("b", 2)
+    clock[0] += 8
+    assert s.get("a") == 1            # 读取刷新 a 的过期时间
+    clock[0] += 5
+    assert s.get("a") == 1 and s.get("b") is None
+    clock[0] += 11
+    assert s.sweep() == 1 and len(s) == 0
+
+
+def test_no_touch_on_read(clock):
+    s = SessionStore(ttl_s=10, touch_on_read=False)
+    s.set("a", 1)
+    clock[0] += 8
+    assert s.get("a") == 1
+    clock[0] += 5
+    assert s.get("a") is None
+
+
+@pytest.mark.parametrize("name", ["store.json", "store.db"])
+def test_persistence_restores_live_entries(clock, tmp_path, name):
+    path = str(tmp_path / name)
+    s = SessionStore(ttl_s=10, persist_path=path)
+    s.set("a", {"n": 1})
+    s.set("b", [1, 2], ttl_s=100)
+    s.delete("a")
+    s.set("c", "x")
+    s.flush()
+    clock[0] += 50
+    restored = SessionStore(ttl_s=10, persist_path=path)
+    assert dict(restored.items()) == {"b": [1, 2]}
+
+
+class _CountingBackend:
+    needs_snapshot = True
+
+    def __init__(self):
+        self.writes = []
+
+    def load(self):
+        return {}
+
+    def write(self, changes, snapshot):
+        self.writes.append((dict(changes), snapshot))
+
+
+def test_writes_are_batched_until_flush(clock, tmp_path):
+    s = SessionStore(ttl_s=10, max_entries=100, persist_path=str(tmp_path / "s.json"), flush_delay_s=3600)
+    s._backend = backend = _CountingBackend()
+    for i in range(50):
+        s.set(f"k{i}", i)
+    s.max_entries = 5
+    s.set("last", -1)                 # 一次淘汰 46 条
+    clock[0] += 20
+    s.set("fresh", 0)
+    assert s.sweep() == 4
+    assert backend.writes == []       # 请求路径上没有写盘
+    s.flush()
+    assert len(backend.writes) == 1
+    changes, snapshot = backend.writes[0]
+    assert snapshot == {"fresh": (0, clock[0] + 10)}
+    assert changes["fresh"] is not None and changes["k0"] is None and changes["last"] is None
+    s.flush()
+    assert len(backend.writes) == 1   # 没有新变更就不写
+
+
+def test_background_flush_after_delay(tmp_path):
+    path = str(tmp_path / "s.json")
+    s = SessionStore(ttl_s=60, persist_path=path, flush_delay_s=0.01)
+    s.set("a", 1)
+    s._flush_timer.join(1)
+    assert dict(SessionStore(ttl_s=60, persist_path=path).items()) == {"a": 1}
+
+
+@pytest.mark.parametrize("name", ["store.json", "store.db"])
+def test_touch_and_lru_order_survive_restart(clock, tmp_path, name):
+    path = str(tmp_path / name)
+    s = SessionStore(ttl_s=10, persist_path=path)
+    for k in "abc":
+        s.set(k, k)
+        clock[0] += 1
+    clock[0] += 5
+    assert s.get("a") == "a"          # 刷新 a 的过期时间，并移到最新
+    s.flush()
+    clock[0] += 6                     # b、c 已过期；a 按刷新后的 TTL 仍有效
+    assert dict(SessionStore(ttl_s=10, persist_path=path).items()) == {"a": "a"}
+
+
+@pytest.mark.parametrize("name", ["store.json", "store.db"])
+def test_lru_order_restored(clock, tmp_path, name):
+    path = str(tmp_path / name)
+    s = SessionStore(ttl_s=60, persist_path=path)
+    for k in "abc":
+        s.set(k, k)
+        clock[0] += 1
+    s.get("a")
+    s.flush()
+    restored = SessionStore(ttl_s=60, max_entries=2, persist_path=path)
+    assert [k for k, _ in restored.items()] == ["c", "a"]
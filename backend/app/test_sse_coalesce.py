@@ -0,0 +1,147 @@
+import anyio
+import pytest
+from contextlib import aclosing
+
+from app.sse_coalesce import coalesce_stream, coalesce_tokens, pump
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def tok(d):
+    return {"type": "token", "delta": d}
+
+
+async def upstream(events, *, gap=0.0, fail=None, closed=None):
+    try:
+        for ev in events:
+            if gap:
+                await anyio.sleep(gap)
+            yield ev
+        if fail is not None:
+            raise fail
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def test_tokens_merged_and_order_kept():
+    evs = [tok("a"), tok("b"), tok("c"), {"type": "log", "message": "x"}, tok("d"), {"type": "end"}]
+    out = [ev async for ev in coalesce_tokens(upstream(evs), max_delay_s=10)]
+    assert out == [tok("a"), tok("bc"), {"type": "log", "message": "x"}, tok("d"), {"type": "end"}]
+
+
+async def test_early_close_closes_upstream():
+    closed = []
+    gen = coalesce_tokens(upstream([tok(str(i)) for i in range(10)], closed=closed), max_delay_s=10)
+    async with aclosing(gen) as frames:
+        async for ev in frames:
+            break
+    assert ev == tok("0") and closed == [True]
+
+
+async def test_upstream_error_keeps_type():
+    gen = coalesce_tokens(upstream([tok("a"), tok("b")], fail=RuntimeError("boom")), max_delay_s=10)
+    with pytest.raises(RuntimeError, match="boom"):
+        async for _ in gen:
+            pass
+
+
+async def test_outer_cancel_is_plain():
+    closed = []
+    gen = coalesce_tokens(upstream([tok("a")] * 100, gap=0.05, closed=closed), max_delay_s=10)
+    got = []
+    with anyio.move_on_after(0.12):
+        async for ev in gen:
+            got.append(ev)
+    await gen.aclose()
+    assert got and closed == [True]
+
+
+async def test_stream_flushes_on_deadline():
+    send, recv = anyio.create_memory_object_stream(16)
+    frames = []
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(pump, upstream([tok("a"), tok("b"), tok("c")], gap=0.0), send)
+
+        async def consume():
+            async with aclosing(coalesce_stream(recv, max_delay_s=0.02)) as gen:
+                async for ev in gen:
+                    frames.append((anyio.current_time(), ev))
+        tg.start_soon(consume)
+    assert [ev for _, ev in frames] == [tok("a"), tok("bc")]
+
+
+async def test_stream_deadline_flush_while_upstream_stalls():
+    send, recv = anyio.create_memory_object_stream(16)
+    frames = []
+
+    async def slow():
+        yield tok("a")
+        yield tok("b")
+        await anyio.sleep(0.3)
+        yield tok("c")
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(pump, slow(), send)
+        t0 = anyio.current_time()
+        async with aclosing(coalesce_stream(recv, max_delay_s=0.02)) as gen:
+            async for ev in gen:
+                frames.append((anyio.current_time() - t0, ev))
+    assert [ev for _, ev in frames] == [tok("a"), tok("b"), tok("c")]
+    assert frames[1][0] < 0.2   # 上游停顿时按时限发出，不等下一个事件
+
+
+async def test_stream_early_close_and_error():
+    closed = []
+    send, recv = anyio.create_memory_object_stream(0)
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(pump, upstream([tok(str(i)) for i in range(50)], closed=closed), send)
+        async with aclosing(coalesce_stream(recv, max_delay_s=10)) as gen:
+            async for ev in gen:
+                break
+    assert ev == tok("0") and closed == [True]
+
+    send, recv = anyio.create_memory_object_stream(16)
+    with pytest.raises(ExceptionGroup) as ei:   # 异常来自调用方自己的任务组，原类型在组内
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(pump, upstream([tok("a")], fail=RuntimeError("boom")), send)
+            async with aclosing(coalesce_stream(recv)) as gen:
+                async for _ in gen:
+                    pass
+    assert ei.group_contains(RuntimeError, match="boom")
+
+
+async def _run_sse(events, sent, *, stop_after=None):
+    from app import main
+
+    async def send(msg):
+        if msg["type"] == "http.response.body" and msg["body"]:
+            sent.append((anyio.current_time(), msg["body"].decode()))
+            if stop_after and len(sent) >= stop_after:
+                raise OSError("client gone")
+    await main.SSEResponse(events).stream_response(send)
+
+
+async def test_sse_response_flushes_while_upstream_stalls():
+    async def slow():
+        yield tok("a")
+        yield tok("b")
+        await anyio.sleep(0.5)
+        yield tok("c")
+
+    sent = []
+    await _run_sse(slow(), sent)
+    assert [b for _, b in sent] == [f'data: {{"type": "token", "delta": "{d}"}}\n\n' for d in "abc"]
+    assert sent[2][0] - sent[1][0] > 0.3   # b 在上游停顿期间就按时延上限发出，不等 c（/api/chat/stream 同路径）
+
+
+async def test_sse_response_disconnect_closes_upstream():
+    closed, sent = [], []
+    with pytest.raises(ExceptionGroup) as ei:
+        await _run_sse(upstream([tok(str(i)) for i in range(50)], closed=closed), sent, stop_after=1)
+    assert ei.group_contains(OSError) and closed == [True] and len(sent) == 1
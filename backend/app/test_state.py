@@ -0,0 +1,39 @@
+from app import main
+from app.state import FLOWS, _clear_flow, get_flow, update_flow
+
+
+def test_anonymous_calls_get_distinct_ids():
+    a, b = main._conversation_id({}), main._conversation_id(None, {"messages": []})
+    assert a and b and a != b
+    assert main._conversation_id({"conversation_id": "c1"}) == "c1"
+    assert main._conversation_id({}, {"session_id": "s9"}) == "s9"
+
+
+def test_flows_isolated_per_conversation():
+    update_flow("c1", candidates=[{"id": "P1"}], city_hint="北京")
+    update_flow("c2", selected={"id": "P2"})
+    assert get_flow("c1")["candidates"] == [{"id": "P1"}] and get_flow("c1")["selected"] is None
+    assert get_flow("c2")["selected"] == {"id": "P2"} and get_flow("c2")["candidates"] == []
+    _clear_flow("c1")
+    assert get_flow("c1")["candidates"] == [] and get_flow("c2")["selected"] == {"id": "P2"}
+    _clear_flow("c2")
+
+
+def test_no_shared_default_slot():
+    n = len(FLOWS)
+    st = update_flow(None, candidates=[{"id": "P1"}])
+    assert st["candidates"] == [{"id": "P1"}]          # 本次调用内可用
+    update_flow("", selected={"id": "P3"})
+    assert len(FLOWS) == n
+    assert get_flow(None)["candidates"] == [] and get_flow("")["selected"] is None
+
+
+def test_legacy_stream_returns_conversation_id():
+    import json
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as client:
+        r = client.post("/api/chat/stream", json={"messages": [{"role": "user", "content": "北京有哪些基站"}]})
+    cid = r.headers["x-conversation-id"]
+    first = json.loads(r.text.split("\n\n")[0][len("data: "):])
+    assert first == {"type": "start", "conversation_id": cid} and cid
@@ -0,0 +1,128 @@
+import json
+import time
+
+import anyio
+
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+
+from app import ws_mux
+
+
+async def _events(text):
+    for ch in text:
+        yield {"type": "token", "delta": ch}
+    yield {"type": "end"}
+
+
+def _open_turn(msg, ctx):
+    return msg.get("conversation_id") or "c1", _events(msg.get("message") or "")
+
+
+def _client(open_turn=_open_turn, **kw) -> TestClient:
+    app = FastAPI()
+
+    @app.websocket("/ws")
+    async def ws_endpoint(ws: WebSocket):
+        await ws_mux.serve(ws, open_turn, heartbeat_s=3600, **kw)
+
+    return TestClient(app)
+
+
+def _recv_until(ws, pred):
+    while True:
+        frame = ws.receive_json()
+        if pred(frame):
+            return frame
+
+
+def test_stream_roundtrip():
+    with _client().websocket_connect("/ws") as ws:
+        ws.send_json({"op": "start", "stream_id": "s1", "message": "hi"})
+        frames = []
+        while not frames or frames[-1].get("type") != "closed":
+            frames.append(ws.receive_json())
+        assert frames[0] == {"stream_id": "s1", "type": "start", "conversation_id": "c1"}
+        assert "".join(f.get("delta", "") for f in frames) == "hi"
+        assert frames[-1]["reason"] == "done"
+
+
+def test_bad_frames_keep_connection_open():
+    with _client().websocket_connect("/ws") as ws:
+        ws.send_bytes(b"\x00\x01")
+        assert ws.receive_json()["code"] == "bad_frame"
+        ws.send_text("not json")
+        assert ws.receive_json()["code"] == "bad_frame"
+        ws.send_json({"op": "ack", "stream_id": "s1", "n": "x"})
+        assert ws.receive_json() == {"type": "error", "code": "bad_frame",
+                                     "message": "n must be a non-negative integer", "stream_id": "s1"}
+        ws.send_json({"op": "start", "stream_id": ["s1"], "message": "x"})
+        assert ws.receive_json()["code"] == "bad_frame"
+        ws.send_text(json.dumps({"op": "ping"}))
+        assert _recv_until(ws, lambda f: f.get("type") == "pong")
+
+
+def test_cancel_one_stream_keeps_others():
+    closed = []
+
+    async def endless():
+        try:
+            while True:
+                await anyio.sleep(0.01)
+                yield {"type": "log", "message": "tick"}
+        finally:
+            closed.append(True)
+
+    def open_turn(msg, ctx):
+        return "c1", endless() if msg["stream_id"] == "slow" else _events(msg["message"])
+
+    with _client(open_turn).websocket_connect("/ws") as ws:
+        ws.send_json({"op": "start", "stream_id": "slow", "message": "x"})
+        _recv_until(ws, lambda f: f.get("stream_id") == "slow" and f["type"] == "log")
+        ws.send_json({"op": "cancel", "stream_id": "slow"})
+        assert _recv_until(ws, lambda f: f["type"] == "closed") == \
+            {"stream_id": "slow", "type": "closed", "reason": "cancelled"}
+        assert closed == [True]        # 上游生成器已关闭
+        ws.send_json({"op": "start", "stream_id": "s2", "message": "ok"})
+        frames = []
+        while not frames or frames[-1].get("type") != "closed":
+            frames.append(ws.receive_json())
+        assert "".join(f.get("delta", "") for f in frames) == "ok" and frames[-1]["reason"] == "done"
+
+
+def test_credit_pauses_stream_until_ack():
+    async def logs():
+        for i in range(4):
+            yield {"type": "log", "message": str(i)}
+
+    with _client(lambda msg, ctx: ("c1", logs()), window=2).websocket_connect("/ws") as ws:
+        ws.send_json({"op": "start", "stream_id": "s1", "message": "x"})
+        assert ws.receive_json()["type"] == "start"
+        assert [ws.receive_json()["message"] for _ in range(2)] == ["0", "1"]
+        ws.send_json({"op": "ping"})
+        assert ws.receive_json() == {"type": "pong"}   # 额度耗尽：该路暂停，没有第三帧
+        ws.send_json({"op": "ack", "stream_id": "s1", "n": 1})
+        assert ws.receive_json()["message"] == "2"
+        ws.send_json({"op": "ping"})
+        assert ws.receive_json() == {"type": "pong"}
+        ws.send_json({"op": "ack", "stream_id": "s1", "n": 8})
+        assert ws.receive_json()["message"] == "3"
+        assert ws.receive_json() == {"stream_id": "s1", "type": "closed", "reason": "done"}
+
+
+def test_buffered_tokens_flush_while_upstream_stalls():
+    async def stalling():
+        for d in "ab":
+            yield {"type": "token", "delta": d}
+        await anyio.sleep(0.5)
+        yield {"type": "token", "delta": "c"}
+
+    with _client(lambda msg, ctx: ("c1", stalling())).websocket_connect("/ws") as ws:
+        ws.send_json({"op": "start", "stream_id": "s1", "message": "x"})
+        got = []
+        while not got or got[-1][1].get("type") != "closed":
+            frame = ws.receive_json()
+            got.append((time.monotonic(), frame))
+        deltas = [(t, f["delta"]) for t, f in got if f["type"] == "token"]
+        assert [d for _, d in deltas] == ["a", "b", "c"]
+        assert deltas[2][0] - deltas[1][0] > 0.3   # b 在停顿期间按时延上限发出，不等 c
@@ -0,0 +1,77 @@
+
+# app/tracing.py
+"""
+聊天请求的分阶段耗时追踪。
+- span("stage")：上下文管理器，结束时写入 metrics 直方图 stage_<name>_ms
+- 当前请求的 Trace 放在 ContextVar 里，深层函数（检索/模型调用）无需透传参数
+- Trace 开启时，agent_stream 会把已完成的 span 作为 log(channel="trace") 事件推给前端
+"""
+from __future__ import annotations
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from . import metrics
+
+TRACE_DEFAULT = os.environ.get("CHAT_TRACE", "0") not in ("", "0", "false", "False")
+
+_CURRENT: ContextVar[Optional["Trace"]] = ContextVar("chat_trace", default=None)
+
+
+class Trace:
+    def __init__(self, *, emit: bool = False):
+        self.emit = emit
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self._drained = 0
+
+    def record(self, name: str, dur_ms: float, **attrs):
+        self.spans.append({"stage": name, "ms": round(dur_ms, 2), **attrs})
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000.0
+
+    def drain_events(self) -> List[Dict[str, Any]]:
+        """取出尚未推送的 span，转成 log 事件（未开启 emit 时返回空）。"""
+        if not self.emit:
+            self._drained = len(self.spans)
+            return []
+        out = []
+        for sp in self.spans[self._drained:]:
+            attrs = " ".join(f"{k}={v}" for k, v in sp.items() if k not in ("stage", "ms"))
+            out.append({
+                "type": "log", "channel": "trace", "span": sp,
+                "message": f"[trace] {sp['stage']} {sp['ms']}ms" + (f" {attrs}" if attrs else ""),
+            })
+        self._drained = len(self.spans)
+        return out
+
+
+def start(*, emit: bool = False) -> Trace:
+    tr = Trace(emit=emit)
+    _CURRENT.set(tr)
+    return tr
+
+
+def current() -> Optional[Trace]:
+    return _CURRENT.get()
+
+
+def record(name: str, dur_ms: float, **attrs):
+    """直接记录一个已知耗时的阶段（如 TTFT）。"""
+    metrics.observe(f"stage_{name}_ms", dur_ms)
+    tr = _CURRENT.get()
+    if tr is not None:
+        tr.record(name, dur_ms, **attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """计时一个阶段；with 体内可往 attrs 里补充字段（如命中条数）。"""
+    t = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        record(name, (time.perf_counter() - t) * 1000.0, **attrs)
@@ -0,0 +1,175 @@
+
+# app/ws_mux.py
+"""
+一条 WebSocket 上复用多路对话流（按 stream_id 区分）。
+客户端 → 服务端（JSON 文本帧；二进制帧、非法 JSON/字段只回 bad_frame 错误，不断开连接）：
+  {"op":"start","stream_id":"s1","conversation_id"?,"message":"…","context"?}   开一路（也兼容 "messages" 全量历史）
+  {"op":"ack","stream_id":"s1","n":16}                                           归还 n 个发送额度（流控）
+  {"op":"cancel","stream_id":"s1"}                                               取消一路（上游 Ollama 流随之关闭）
+  {"op":"ping"}                                                                  应用层探活 → {"type":"pong"}
+服务端 → 客户端：事件内容与 SSE 相同，外加 "stream_id"；每路以 {"type":"closed","reason":done|cancelled|error} 收尾。
+- 流控：每路初始额度 window 帧，发一帧扣一，耗尽即暂停该路（其它路不受影响），客户端 ack 续额度
+- 整条连接只有一个心跳与一个写协程，没有“每个问题一个请求/一个心跳任务”的开销
+"""
+from __future__ import annotations
+import json
+import os
+from typing import Any, AsyncGenerator, Callable, Dict, Optional, Tuple
+
+import anyio
+from fastapi import WebSocket, WebSocketDisconnect
+
+from . import metrics
+from .sse_coalesce import coalesce_into
+
+WS_MAX_STREAMS = int(os.environ.get("WS_MAX_STREAMS", 8))        # 每连接并发流上限
+WS_STREAM_WINDOW = int(os.environ.get("WS_STREAM_WINDOW", 64))   # 每路初始发送额度（帧）
+WS_HEARTBEAT_S = float(os.environ.get("WS_HEARTBEAT_S", 20))
+
+OpenTurn = Callable[[Dict[str, Any], Optional[Dict[str, Any]]], Tuple[str, AsyncGenerator[Dict[str, Any], None]]]
+
+
+class _Stream:
+    __slots__ = ("sid", "scope", "credit", "_wake")
+
+    def __init__(self, sid: str, window: int):
+        self.sid = sid
+        self.scope = anyio.CancelScope()
+        self.credit = window
+        self._wake: Optional[anyio.Event] = None
+
+    def grant(self, n: int):
+        self.credit += max(0, n)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def acquire(self):
+        while self.credit <= 0:
+            self._wake = anyio.Event()
+            await self._wake.wait()
+        self.credit -= 1
+
+
+def _parse_frame(message: Dict[str, Any]) -> Dict[str, Any]:
+    """校验一帧客户端消息：只收 JSON 对象文本帧，stream_id（若有）须为字符串；不合法抛 ValueError。"""
+    raw = message.get("text")
+    if raw is None:
+        raise ValueError("binary frames are not supported")
+    msg = json.loads(raw)
+    if not isinstance(msg, dict):
+        raise ValueError("frame must be an object")
+    if msg.get("stream_id") is not None and not isinstance(msg["stream_id"], str):
+        raise ValueError("stream_id must be a string")
+    return msg
+
+
+async def serve(
+    ws: WebSocket,
+    open_turn: OpenTurn,
+    *,
+    max_streams: int = WS_MAX_STREAMS,
+    window: int = WS_STREAM_WINDOW,
+    heartbeat_s: float = WS_HEARTBEAT_S,
+):
+    """处理一条 WebSocket 连接直到断开；open_turn 与 HTTP 入口共用（返回 conversation_id 与事件流）。"""
+    await ws.accept()
+    metrics.inc("ws_connections")
+    streams: Dict[str, _Stream] = {}
+    send_chan, recv_chan = anyio.create_memory_object_stream(64)
+
+    async def _writer():
+        try:
+            async with recv_chan:
+                async for frame in recv_chan:
+                    await ws.send_text(json.dumps(frame, ensure_ascii=False))
+        except Exception:
+            # 对端已断：整条连接收掉
+            tg.cancel_scope.cancel()
+
+    async def _hb():
+        while True:
+            await anyio.sleep(heartbeat_s)
+            await send_chan.send({"type": "ping"})
+
+    async def _run(st: _Stream, cid: str, events: AsyncGenerator[Dict[str, Any], None]):
+        reason = "done"
+        with st.scope:
+            try:
+                await send_chan.send({"stream_id": st.sid, "type": "start", "conversation_id": cid})
+
+                async def emit(ev: Dict[str, Any]):
+                    await st.acquire()
+                    await send_chan.send({"stream_id": st.sid, **ev})
+
+                # 与 SSE 同一套合帧：上游停顿时已缓冲的 token 按时延上限发出；取消该路时上游随之关闭
+                await coalesce_into(events, emit)
+            except Exception as e:
+                if isinstance(e, ExceptionGroup) and len(e.exceptions) == 1:
+                    e = e.exceptions[0]   # 合帧任务组包的一层，回给客户端原始错误
+                reason = "error"
+                await send_chan.send({"stream_id": st.sid, "type": "error", "code": "internal", "message": str(e)})
+        if st.scope.cancelled_caught:
+            reason = "cancelled"
+            metrics.inc("ws_streams_cancelled")
+        streams.pop(st.sid, None)
+        await send_chan.send({"stream_id": st.sid, "type": "closed", "reason": reason})
+
+    async def _error(code: str, message: str, sid: Optional[str] = None):
+        frame = {"type": "error", "code": code, "message": message}
+        if sid is not None:
+            frame["stream_id"] = sid
+        await send_chan.send(frame)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(_writer)
+        tg.start_soon(_hb)
+        try:
+            while True:
+                message = await ws.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+                try:
+                    msg = _parse_frame(message)
+                except ValueError as e:
+                    await _error("bad_frame", str(e))
+                    continue
+
+                op = msg.get("op")
+                sid = msg.get("stream_id")
+                if op == "ping":
+                    await send_chan.send({"type": "pong"})
+                elif op == "start":
+                    if not sid:
+                        await _error("bad_frame", "stream_id required")
+                    elif sid in streams:
+                        await _error("duplicate_stream", "stream_id already active", sid)
+                    elif len(streams) >= max_streams:
+                        await _error("too_many_streams", f"max {max_streams} concurrent streams", sid)
+                    else:
+                        ctx = msg.get("context") or None
+                        try:
+                            cid, events = open_turn(msg, ctx)
+                        except Exception as e:
+                            await _error("bad_request", str(e), sid)
+                            continue
+                        st = streams[sid] = _Stream(sid, window)
+                        metrics.inc("ws_streams_started")
+                        tg.start_soon(_run, st, cid, events)
+                elif op == "ack":
+                    n = msg.get("n")
+                    if type(n) is not int or n < 0:
+                        await _error("bad_frame", "n must be a non-negative integer", sid)
+                        continue
+                    st = streams.get(sid)
+                    if st:
+                        st.grant(n)
+                elif op == "cancel":
+                    st = streams.get(sid)
+                    if st:
+                        st.scope.cancel()
+                else:
+                    await _error("bad_frame", f"unknown op: {op}", sid)
+        except WebSocketDisconnect:
+            metrics.inc("ws_disconnects")
+        finally:
+            tg.cancel_scope.cancel()
@@ -0,0 +1,99 @@
+# bench/bench_router.py
+"""
+agent_stream 路由判定的微基准：旧的“逐个正则串行判断” vs 一趟分类（构造 PromptFeatures）+ 按分类直接定位路由。
+只测判定（不执行 handler、不调模型）。在 backend/ 下运行：
+    python -m bench.bench_router [--rounds 2000] [--repeat 5]
+两种实现交替跑 repeat 轮，各取最快一轮（减少机器噪声）。
+"""
+from __future__ import annotations
+import argparse
+import re
+import time
+
+from app import main, chart_specs
+
+# 线上常见问法（含附近流、计数、图表、直答与兜底）
+CORPUS = [
+    "北京有哪些基站", "上海几个是online的", "北京在线有多少个", "杭州维护的有几站",
+    "北京 柱状图", "上海 饼图 下载图片", "北京 图表总览 全部", "深圳 热力图",
+    "杭州 3D 密度", "北京 三维 覆盖模拟",
+    "万达广场附近的基站", "来福士附近有哪些5G基站", "国贸周边基站", "奥体中心附近 1公里",
+    "选1", "第2个", "朝阳的那个",
+    "它的坐标", "它的状态是什么", "厂商是哪家", "这个站的详细信息", "频段多少",
+    "上海的基站", "广州基站清单", "列出深圳所有站点",
+    "BJS-006 的状态", "北京-示例站3 的厂商是什么",
+    "最近掉话多的站有哪些原因", "hello world", "帮我总结一下今天的告警",
+]
+STATION = {"id": "BJS-001", "name": "北京-示例站1", "city": "北京", "lat": 39.9, "lng": 116.4}
+
+
+def legacy_route(prompt: str, station: dict | None) -> str:
+    """重构前 agent_stream 的判定顺序：每一步各自跑一遍抽取器/正则。"""
+    if main.extract_city_status_count(prompt):
+        return "city_status"
+    if re.search(r"(3d|三维|立体|体渲染|体积|等值面|等高|模拟)", prompt or "", re.I):
+        return "chart_3d"
+    if chart_specs.VIS_HINT_RE.search(prompt or ""):
+        return "chart"
+    city = main.extract_city(prompt or "")
+    if main.want_list(prompt) and city:
+        return "city_list"
+    if station:
+        p = prompt.strip()
+        for k in main.FIELD_ORDER:
+            if main._match_any(main.FIELD_RULES[k], p):
+                return "direct"
+    # 附近流入口：extract_poi_key 在 is_pure_city_query 与触发判断里各跑一次
+    main.extract_poi_key(prompt)
+    if main.is_pure_city_query(prompt):
+        return "fallback"
+    main.NEAR_WORDS_RE.search(prompt)
+    main.extract_poi_key(prompt)
+    return "nearby"
+
+
+def compiled_route(prompt: str, station: dict | None) -> str:
+    ctx = main.RouteCtx(prompt=prompt, features=main.PromptFeatures(prompt),
+                        station=station, conversation_id="bench")
+    for r in main.candidate_routes(ctx):
+        if r.name == "direct" and not ctx.features.fields:
+            continue
+        if r.name == "nearby":
+            # 与附近流的前置判定同等工作量
+            if ctx.features.pure_city:
+                continue
+            ctx.features.near_word
+        return r.name
+    return "fallback"
+
+
+def _bench(fn, rounds: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for q in CORPUS:
+            fn(q, STATION if "它" in q or "这个站" in q else None)
+    return (time.perf_counter() - t0) / (rounds * len(CORPUS)) * 1e6
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=2000)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    # 热身 + 判定一致性检查
+    for q in CORPUS:
+        st = STATION if "它" in q or "这个站" in q else None
+        a, b = legacy_route(q, st), compiled_route(q, st)
+        if a != b:
+            print(f"[mismatch] {q!r}: legacy={a} compiled={b}")
+    legacy = compiled = float("inf")
+    for _ in range(max(1, args.repeat)):
+        legacy = min(legacy, _bench(legacy_route, args.rounds))
+        compiled = min(compiled, _bench(compiled_route, args.rounds))
+    print(f"prompts={len(CORPUS)} rounds={args.rounds} repeat={args.repeat}")
+    print(f"legacy   : {legacy:8.2f} us/prompt")
+    print(f"compiled : {compiled:8.2f} us/prompt  ({legacy / compiled:.2f}x)")
+
+
+if __name__ == "__main__":
+    main_cli()
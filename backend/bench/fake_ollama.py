@@ -0,0 +1,116 @@
+# bench/fake_ollama.py
+"""
+本地假 Ollama：只实现 /api/generate 的 NDJSON 流式输出（外加 /api/tags 探活），用于离线压测。
+可调：首 token 延迟、吐字速率、回复长度、错误注入（HTTP 500 / 流中途断开）。在 backend/ 下运行：
+    python -m bench.fake_ollama [--port 11435] [--ttft-ms 300] [--tps 40] [--tokens 80]
+                                [--error-rate 0.0] [--drop-rate 0.0] [--jitter 0.2] [--seed 0]
+后端指向它：OLLAMA_HOST=http://127.0.0.1:11435 uvicorn app.main:app
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timezone
+
+from fastapi import Body, FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 回复语料：按 token 切好的中文片段（长度接近真实模型的一个 token）
+WORDS = ["该", "基站", "当前", "状态", "为", "在线", "，", "覆盖", "半径", "约", "800", "米", "。",
+         "厂商", "华为", "，", "频段", "n78", "；", "附近", "共有", "3", "个", "站点", "，",
+         "建议", "关注", "负载", "与", "告警", "历史", "。"]
+
+CONFIG = {
+    "ttft_s": 0.3,
+    "tps": 40.0,
+    "tokens": 80,
+    "error_rate": 0.0,
+    "drop_rate": 0.0,
+    "jitter": 0.2,
+}
+STATS = {"requests": 0, "errors": 0, "drops": 0, "tokens": 0, "active": 0}
+_RNG = random.Random(0)
+
+app = FastAPI(title="fake-ollama")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _sleep_s(base: float) -> float:
+    j = CONFIG["jitter"]
+    return max(0.0, base * (1.0 + _RNG.uniform(-j, j))) if j else base
+
+
+@app.get("/api/tags")
+def tags():
+    return {"models": [{"name": "fake:latest"}], "stats": STATS, "config": CONFIG}
+
+
+@app.post("/api/generate")
+async def generate(body: dict = Body(...)):
+    STATS["requests"] += 1
+    if _RNG.random() < CONFIG["error_rate"]:
+        STATS["errors"] += 1
+        return JSONResponse({"error": "injected failure"}, status_code=500)
+
+    model = body.get("model") or "fake"
+    n = max(1, int(CONFIG["tokens"] * (1.0 + _RNG.uniform(-0.3, 0.3))))
+    drop_at = _RNG.randrange(1, n + 1) if _RNG.random() < CONFIG["drop_rate"] else None
+    # 续用 context 时模型跳过前缀：首 token 更快（粗略按 1/3 模拟）
+    ttft = CONFIG["ttft_s"] / (3.0 if body.get("context") else 1.0)
+    prompt_tokens = len(body.get("prompt") or "")
+
+    async def stream():
+        STATS["active"] += 1
+        t0 = time.perf_counter()
+        try:
+            await asyncio.sleep(_sleep_s(ttft))
+            for i in range(n):
+                if drop_at is not None and i == drop_at:
+                    STATS["drops"] += 1
+                    return  # 不发 done 直接断流
+                tok = WORDS[i % len(WORDS)]
+                STATS["tokens"] += 1
+                yield json.dumps({"model": model, "created_at": _now(), "response": tok, "done": False},
+                                 ensure_ascii=False) + "\n"
+                if CONFIG["tps"] > 0:
+                    await asyncio.sleep(_sleep_s(1.0 / CONFIG["tps"]))
+            yield json.dumps({
+                "model": model, "created_at": _now(), "response": "", "done": True,
+                "context": list(range(min(2048, prompt_tokens + n))),
+                "total_duration": int((time.perf_counter() - t0) * 1e9),
+                "prompt_eval_count": prompt_tokens, "eval_count": n,
+            }) + "\n"
+        finally:
+            STATS["active"] -= 1
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="fake Ollama /api/generate for offline load tests")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11435)
+    ap.add_argument("--ttft-ms", type=float, default=300.0, help="首 token 延迟（毫秒）")
+    ap.add_argument("--tps", type=float, default=40.0, help="每秒吐出的 token 数（<=0 表示不限速）")
+    ap.add_argument("--tokens", type=int, default=80, help="平均回复长度（±30%%）")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="直接返回 500 的概率")
+    ap.add_argument("--drop-rate", type=float, default=0.0, help="流中途断开（不发 done）的概率")
+    ap.add_argument("--jitter", type=float, default=0.2, help="延迟随机抖动比例")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    CONFIG.update(ttft_s=args.ttft_ms / 1000.0, tps=args.tps, tokens=args.tokens,
+                  error_rate=args.error_rate, drop_rate=args.drop_rate, jitter=args.jitter)
+    _RNG.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
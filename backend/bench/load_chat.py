@@ -0,0 +1,338 @@
+# bench/load_chat.py
+"""
+端到端压测：按真实问法比例在目标并发下打 /api/chat/stream、/api/chat/sse、/api/geo/nearby，
+汇报吞吐、首 token 延迟（TTFT）p50/p99、总耗时与服务端 CPU。无需网络、无需真模型：
+    # 一键：自动拉起 fake_ollama + uvicorn（随机端口），压完自动退出
+    python -m bench.load_chat --spawn --concurrency 32 --duration 20
+    # 压已在跑的服务（CPU 需给出服务端 pid，仅 Linux /proc 可用）
+    python -m bench.load_chat --base-url http://127.0.0.1:8000 --server-pid 12345
+在 backend/ 下运行。
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+
+# (问法, 权重)：城市计数/清单走直出；图表/附近/兜底会调模型
+PROMPTS = [
+    ("上海几个是online的", 3), ("北京在线有多少个", 2), ("杭州维护的有几站", 1),
+    ("北京 柱状图", 3), ("上海 饼图", 2), ("深圳 热力图", 1),
+    ("万达广场附近的基站", 3), ("来福士附近有哪些5G基站", 2), ("国贸周边基站", 1),
+    ("BJS-006 的状态", 2), ("北京-示例站3 的厂商是什么", 1),
+    ("最近掉话多的站有哪些原因", 3), ("帮我总结一下今天的告警", 2), ("hello world", 1),
+]
+NEARBY_QUERIES = ["万达广场", "来福士", "国贸", "奥体中心", "西湖", "陆家嘴"]
+DEFAULT_MIX = "stream=5,sse=3,nearby=2"
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    ok: bool
+    ttft_ms: Optional[float]
+    total_ms: float
+    tokens: int = 0
+    error: str = ""
+
+
+@dataclass
+class Run:
+    samples: List[Sample] = field(default_factory=list)
+    started: float = 0.0
+    finished: float = 0.0
+
+
+def _pct(xs: List[float], q: float) -> Optional[float]:
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, int(round(q * len(xs) + 0.5)) - 1))]
+
+
+def _pick_prompt(rng: random.Random) -> str:
+    return rng.choices([p for p, _ in PROMPTS], weights=[w for _, w in PROMPTS])[0]
+
+
+def _parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, w = part.partition("=")
+        if name.strip():
+            mix[name.strip()] = float(w or 1)
+    unknown = set(mix) - {"stream", "sse", "nearby"}
+    if unknown:
+        raise SystemExit(f"unknown endpoint in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+# ---------- 单次请求 ----------
+
+async def _consume_sse(resp: httpx.Response, t0: float) -> tuple[Optional[float], int, str]:
+    """读 SSE 帧直到 end/断流；返回 (TTFT 毫秒, token 帧数, 错误码)。"""
+    ttft, n, err = None, 0, ""
+    async for line in resp.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        try:
+            ev = json.loads(line[5:])
+        except ValueError:
+            continue
+        if ev.get("type") == "token":
+            n += 1
+            if ttft is None:
+                ttft = (time.perf_counter() - t0) * 1000.0
+        elif ev.get("type") == "error":
+            err = ev.get("code") or "error"
+        elif ev.get("type") == "end":
+            break
+    return ttft, n, err
+
+
+async def hit_stream(client: httpx.AsyncClient, prompt: str, cid: str) -> Sample:
+    t0 = time.perf_counter()
+    body = {"conversation_id": cid, "message": prompt, "context": None}
+    async with client.stream("POST", "/api/chat/stream", json=body) as resp:
+        resp.raise_for_status()
+        ttft, n, err = await _consume_sse(resp, t0)
+    return Sample("stream", not err, ttft, (time.perf_counter() - t0) * 1000.0, n, err)
+
+
+async def hit_sse(client: httpx.AsyncClient, prompt: str, cid: str) -> Sample:
+    t0 = time.perf_counter()
+    params = {"conversation_id": cid, "q": prompt}
+    async with client.stream("GET", "/api/chat/sse", params=params) as resp:
+        resp.raise_for_status()
+        ttft, n, err = await _consume_sse(resp, t0)
+    return Sample("sse", not err, ttft, (time.perf_counter() - t0) * 1000.0, n, err)
+
+
+async def hit_nearby(client: httpx.AsyncClient, rng: random.Random) -> Sample:
+    t0 = time.perf_counter()
+    resp = await client.get("/api/geo/nearby", params={"q": rng.choice(NEARBY_QUERIES)})
+    resp.raise_for_status()
+    ms = (time.perf_counter() - t0) * 1000.0
+    return Sample("nearby", True, ms, ms)  # 非流式：TTFT 即整包耗时
+
+
+# ---------- 压测主体 ----------
+
+async def worker(idx: int, client: httpx.AsyncClient, mix: Dict[str, float], deadline: float,
+                 warmup_until: float, run: Run, seed: int):
+    rng = random.Random(seed * 1000 + idx)
+    names, weights = list(mix), list(mix.values())
+    cid = f"load-{idx}-{uuid.uuid4().hex[:8]}"  # 每个虚拟用户一条多轮对话
+    turns = 0
+    while time.perf_counter() < deadline:
+        ep = rng.choices(names, weights=weights)[0]
+        t0 = time.perf_counter()
+        try:
+            if ep == "stream":
+                s = await hit_stream(client, _pick_prompt(rng), cid)
+            elif ep == "sse":
+                s = await hit_sse(client, _pick_prompt(rng), cid)
+            else:
+                s = await hit_nearby(client, rng)
+        except Exception as e:
+            s = Sample(ep, False, None, (time.perf_counter() - t0) * 1000.0, error=type(e).__name__)
+        if t0 >= warmup_until:
+            run.samples.append(s)
+        turns += 1
+        if turns % 8 == 0:  # 对话不无限变长：隔几轮换一条新对话
+            cid = f"load-{idx}-{uuid.uuid4().hex[:8]}"
+
+
+def _cpu_ticks(pid: int) -> Optional[int]:
+    """Linux：/proc/<pid>/stat 的 utime+stime（含已回收子进程）。其它平台返回 None。"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return sum(int(x) for x in fields[11:15])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+async def run_load(base_url: str, concurrency: int, duration_s: float, warmup_s: float,
+                   mix: Dict[str, float], seed: int, pids: Dict[str, int]) -> dict:
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    timeout = httpx.Timeout(connect=5.0, read=120.0, write=10.0, pool=30.0)
+    run = Run()
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        now = time.perf_counter()
+        warmup_until, deadline = now + warmup_s, now + warmup_s + duration_s
+        cpu0 = {k: _cpu_ticks(p) for k, p in pids.items()}
+        tasks = [asyncio.create_task(worker(i, client, mix, deadline, warmup_until, run, seed))
+                 for i in range(concurrency)]
+        await asyncio.sleep(warmup_s)
+        run.started = time.perf_counter()
+        cpu_start = {k: _cpu_ticks(p) for k, p in pids.items()}
+        await asyncio.gather(*tasks)
+        run.finished = time.perf_counter()
+        cpu1 = {k: _cpu_ticks(p) for k, p in pids.items()}
+        try:
+            server_metrics = (await client.get("/metrics")).json()
+        except Exception:
+            server_metrics = {}
+
+    wall = max(1e-9, run.finished - run.started)
+    hz = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    cpu = {}
+    for k in pids:
+        a, b = cpu_start.get(k) or cpu0.get(k), cpu1.get(k)
+        cpu[k] = None if a is None or b is None else round((b - a) / hz / wall * 100.0, 1)
+    return _report(run, wall, cpu, server_metrics, concurrency)
+
+
+def _report(run: Run, wall: float, cpu: Dict[str, Optional[float]], server_metrics: dict, concurrency: int) -> dict:
+    by_ep: Dict[str, List[Sample]] = {}
+    for s in run.samples:
+        by_ep.setdefault(s.endpoint, []).append(s)
+    endpoints = {}
+    for ep, ss in sorted(by_ep.items()):
+        ok = [s for s in ss if s.ok]
+        ttft = [s.ttft_ms for s in ok if s.ttft_ms is not None]
+        total = [s.total_ms for s in ok]
+        errors: Dict[str, int] = {}
+        for s in ss:
+            if not s.ok:
+                errors[s.error] = errors.get(s.error, 0) + 1
+        endpoints[ep] = {
+            "requests": len(ss), "ok": len(ok), "errors": errors,
+            "rps": round(len(ok) / wall, 2),
+            "ttft_p50_ms": _pct(ttft, 0.50), "ttft_p99_ms": _pct(ttft, 0.99),
+            "total_p50_ms": _pct(total, 0.50), "total_p99_ms": _pct(total, 0.99),
+            "tokens_per_s": round(sum(s.tokens for s in ok) / wall, 1),
+        }
+    all_ok = [s for s in run.samples if s.ok]
+    all_ttft = [s.ttft_ms for s in all_ok if s.ttft_ms is not None]
+    return {
+        "concurrency": concurrency,
+        "duration_s": round(wall, 2),
+        "requests": len(run.samples),
+        "throughput_rps": round(len(all_ok) / wall, 2),
+        "ttft_p50_ms": _pct(all_ttft, 0.50),
+        "ttft_p99_ms": _pct(all_ttft, 0.99),
+        "cpu_percent": cpu,
+        "endpoints": endpoints,
+        "server": {k: server_metrics.get(k) for k in ("llm_scheduler", "counters") if k in server_metrics},
+    }
+
+
+def _fmt(v) -> str:
+    return "-" if v is None else (f"{v:.1f}" if isinstance(v, float) else str(v))
+
+
+def print_report(rep: dict):
+    print(f"\nconcurrency={rep['concurrency']}  duration={rep['duration_s']}s  "
+          f"requests={rep['requests']}  throughput={rep['throughput_rps']} req/s")
+    print(f"TTFT p50={_fmt(rep['ttft_p50_ms'])}ms  p99={_fmt(rep['ttft_p99_ms'])}ms  "
+          f"CPU%: " + ", ".join(f"{k}={_fmt(v)}" for k, v in rep["cpu_percent"].items()))
+    hdr = f"{'endpoint':<8} {'req':>6} {'ok':>6} {'rps':>7} {'ttft50':>8} {'ttft99':>8} {'tot50':>8} {'tot99':>8} {'tok/s':>8}  errors"
+    print(hdr)
+    print("-" * len(hdr))
+    for ep, r in rep["endpoints"].items():
+        print(f"{ep:<8} {r['requests']:>6} {r['ok']:>6} {r['rps']:>7} {_fmt(r['ttft_p50_ms']):>8} "
+              f"{_fmt(r['ttft_p99_ms']):>8} {_fmt(r['total_p50_ms']):>8} {_fmt(r['total_p99_ms']):>8} "
+              f"{r['tokens_per_s']:>8}  {r['errors'] or ''}")
+
+
+# ---------- 自动拉起 fake_ollama + 后端 ----------
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url: str, proc: subprocess.Popen, timeout_s: float = 90.0):
+    t_end = time.time() + timeout_s
+    while time.time() < t_end:
+        if proc.poll() is not None:
+            raise SystemExit(f"process exited early ({proc.returncode}) while waiting for {url}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise SystemExit(f"timeout waiting for {url}")
+
+
+def spawn(args) -> tuple[str, Dict[str, int], List[subprocess.Popen]]:
+    fake_port, app_port = _free_port(), _free_port()
+    fake = subprocess.Popen([
+        sys.executable, "-m", "bench.fake_ollama", "--port", str(fake_port),
+        "--ttft-ms", str(args.ttft_ms), "--tps", str(args.tps), "--tokens", str(args.tokens),
+        "--error-rate", str(args.error_rate), "--drop-rate", str(args.drop_rate), "--seed", str(args.seed),
+    ])
+    env = dict(os.environ, OLLAMA_HOST=f"http://127.0.0.1:{fake_port}")
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(app_port),
+        "--log-level", "warning", "--no-access-log",
+    ], env=env)
+    procs = [fake, server]
+    try:
+        _wait_http(f"http://127.0.0.1:{fake_port}/api/tags", fake)
+        _wait_http(f"http://127.0.0.1:{app_port}/metrics", server)
+    except BaseException:
+        for p in procs:
+            p.terminate()
+        raise
+    return f"http://127.0.0.1:{app_port}", {"server": server.pid, "fake_ollama": fake.pid}, procs
+
+
+def main():
+    ap = argparse.ArgumentParser(description="end-to-end load test for the chat endpoints")
+    ap.add_argument("--base-url", default="http://127.0.0.1:8000")
+    ap.add_argument("--spawn", action="store_true", help="自动拉起 fake_ollama 与后端（随机端口）")
+    ap.add_argument("--server-pid", type=int, help="外部后端的 pid（用于统计 CPU）")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--duration", type=float, default=20.0, help="计量时长（秒，不含预热）")
+    ap.add_argument("--warmup", type=float, default=3.0)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="各入口权重，如 stream=5,sse=3,nearby=2")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="把报告另存为 JSON")
+    g = ap.add_argument_group("fake_ollama（仅 --spawn）")
+    g.add_argument("--ttft-ms", type=float, default=300.0)
+    g.add_argument("--tps", type=float, default=40.0)
+    g.add_argument("--tokens", type=int, default=80)
+    g.add_argument("--error-rate", type=float, default=0.0)
+    g.add_argument("--drop-rate", type=float, default=0.0)
+    args = ap.parse_args()
+
+    mix = _parse_mix(args.mix)
+    procs: List[subprocess.Popen] = []
+    pids: Dict[str, int] = {}
+    base_url = args.base_url
+    if args.spawn:
+        base_url, pids, procs = spawn(args)
+    elif args.server_pid:
+        pids = {"server": args.server_pid}
+    try:
+        rep = asyncio.run(run_load(base_url, args.concurrency, args.duration, args.warmup, mix, args.seed, pids))
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+    print_report(rep)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rep, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()